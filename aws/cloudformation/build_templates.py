@@ -0,0 +1,9 @@
+# Generates every CloudFormation template in parallel.
+# Example:
+# python build_templates.py --Environment Dev,Stage,Prod --Purpose Platform --OutputDirectory ./build
+# See cfgen/build.py for details.
+from cfgen.build import main
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3 @@
+# Shared support code for the troposphere template generators.
+# The generators themselves remain standalone scripts; this package holds
+# the pieces that operate across all of them (batch build, output, ...).
@@ -0,0 +1,218 @@
+# Benchmarks of template generation.
+# Each case times generate_stack_template() and the JSON serialization of the
+# result, keeping the best of several repeats.  Besides one case per
+# generator, synthetic cases scale up the generators' module-level data
+# (office sites, regions in the AMI maps) and options (availability zones) to
+# show how generation grows with them.
+# A run can be stored as the baseline; later runs exit with status 1 when a
+# case is slower than its baseline by more than the tolerance, or when there
+# is no baseline for it, so that a CI job cannot pass ungated.  Record the
+# baseline on the machine that runs the comparison, e.g. the CI runner:
+# python -m cfgen.benchmark --UpdateBaseline
+# python -m cfgen.benchmark --Tolerance 0.5
+import json
+import os
+import sys
+from optparse import OptionParser
+from timeit import default_timer
+
+from cfgen.build import load_generator, root_directory
+from cfgen.output import write_template
+
+default_baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# Differences below this many seconds are timer noise, not regressions.
+minimum_regression = 0.002
+
+vpc_path = 'vpc/vpc.py'
+vpc_options = dict(environment='Dev', purpose='Platform')
+
+# Generators relative to the cloudformation directory, with the options to
+# generate them with and the names of their module-level AMI maps.
+generators = [
+    (vpc_path, vpc_options, ['region_attribute_map']),
+    ('postgres/single/postgres_single.py', dict(), ['environment_attribute_map']),
+    ('webserver/client.py', dict(), ['environment_attribute_map']),
+    ('generator/WebAuthor.py', dict(), ['region_map']),
+    ('generator/jenkins-linux-simple.py', dict(), ['region_map']),
+    ('elasticache/redis_cache.py', dict(), [])
+]
+
+
+def create_sites(count):
+    return dict(('Site%03d' % index, '198.18.%d.%d/32' % (index // 256, index % 256)) for index in range(count))
+
+
+def create_regions(region_map, count):
+    # Pad an AMI map with copies of its first region.
+    attributes = region_map[sorted(region_map.keys())[0]]
+    scaled_map = dict(region_map)
+    for index in range(count - len(region_map)):
+        scaled_map['synthetic-%d' % index] = dict(attributes)
+    return scaled_map
+
+
+def get_cases():
+    # A case is (name, generator module, options, {module attribute: replacement value}).
+    cases = []
+    for path, options, region_map_names in generators:
+        module = load_generator(os.path.join(root_directory, path))
+        name = os.path.splitext(os.path.basename(path))[0]
+        cases.append((name, module, options, {}))
+        if region_map_names:
+            cases.append(('%s-regions-100' % name, module, options, dict(
+                (map_name, create_regions(getattr(module, map_name), 100)) for map_name in region_map_names
+            )))
+
+    vpc_module = load_generator(os.path.join(root_directory, vpc_path))
+    # Each Dev site adds four ingress resources; beyond about 110 sites the
+    # VPC template passes the 500 resource limit.
+    for site_count in (30, 100):
+        cases.append(('vpc-sites-%d' % site_count, vpc_module, vpc_options,
+                      dict(home_network_cidr_dict=create_sites(site_count))))
+    # Compacted rules keep the resource count flat as sites are added.
+    for ingress_rule_mode in ('aggregate', 'prefix-list'):
+        cases.append(('vpc-sites-300-%s' % ingress_rule_mode, vpc_module,
+                      dict(vpc_options, ingress_rule_mode=ingress_rule_mode),
+                      dict(home_network_cidr_dict=create_sites(300))))
+    postgres_module = load_generator(os.path.join(root_directory, 'postgres/single/postgres_single.py'))
+    cases.append(('postgres_single-pgbouncer', postgres_module, dict(pgbouncer=True), {}))
+    cases.append(('postgres_single-replicas-3', postgres_module, dict(replica_count=3), {}))
+    cases.append(('postgres_single-replicas-3-volumes', postgres_module, dict(replica_count=3, ebs_volumes=True), {}))
+    cases.append(('postgres_single-replicas-3-placement', postgres_module,
+                  dict(replica_count=3, placement_group=True), {}))
+    cases.append(('postgres_single-monitoring', postgres_module, dict(ebs_volumes=True, monitoring=True), {}))
+    web_author_module = load_generator(os.path.join(root_directory, 'generator/WebAuthor.py'))
+    cases.append(('WebAuthor-application', web_author_module, dict(load_balancer_type='application'), {}))
+    cases.append(('WebAuthor-spot', web_author_module,
+                  dict(spot_instance_types=['t2.large', 'm3.large', 'm3.medium', 'c4.large']), {}))
+    cases.append(('WebAuthor-cloudfront', web_author_module, dict(load_balancer_type='application', cdn=True), {}))
+    cases.append(('WebAuthor-monitoring', web_author_module, dict(monitoring=True), {}))
+    client_module = load_generator(os.path.join(root_directory, 'webserver/client.py'))
+    cases.append(('client-cloudfront', client_module, dict(api_micro_cache=True, cdn=True), {}))
+    cases.append(('client-monitoring', client_module, dict(monitoring=True), {}))
+    jenkins_module = load_generator(os.path.join(root_directory, 'generator/jenkins-linux-simple.py'))
+    cases.append(('jenkins-linux-simple-agents', jenkins_module, dict(agent_fleet=True), {}))
+    cases.append(('jenkins-linux-simple-cache-raid0', jenkins_module, dict(agent_fleet=True, cache_volume_count=4), {}))
+    cases.append(('jenkins-linux-simple-monitoring', jenkins_module, dict(agent_fleet=True, monitoring=True), {}))
+    redis_module = load_generator(os.path.join(root_directory, 'elasticache/redis_cache.py'))
+    cases.append(('redis_cache-cluster-mode', redis_module, dict(cluster_mode=True), {}))
+    cases.append(('redis_cache-monitoring', redis_module, dict(cluster_mode=True, monitoring=True), {}))
+    cases.append(('vpc-zones-26', vpc_module, dict(vpc_options, zone_count=26), {}))
+    cases.append(('vpc-zones-26-nat-per-az', vpc_module, dict(vpc_options, zone_count=26, nat_gateway_per_az=True), {}))
+    cases.append(('vpc-zones-26-nat-monitoring', vpc_module,
+                  dict(vpc_options, zone_count=26, nat_gateway_per_az=True, monitoring=True), {}))
+    cases.append(('vpc-zones-26-data', vpc_module,
+                  dict(vpc_options, zone_count=26, tier_names=['Public', 'Private', 'Data']), {}))
+    cases.append(('vpc-interface-endpoints', vpc_module,
+                  dict(vpc_options, interface_endpoints=vpc_module.interface_endpoint_services), {}))
+    return cases
+
+
+def run_case(module, options, patches, repeat):
+    # Returns the best generate and serialize times in seconds and the resource count.
+    saved = dict((name, getattr(module, name)) for name in patches)
+    try:
+        for name, value in patches.items():
+            setattr(module, name, value)
+        generate_times = []
+        serialize_times = []
+        for index in range(repeat):
+            start = default_timer()
+            template = module.generate_stack_template(**options)
+            generate_times.append(default_timer() - start)
+
+            with open(os.devnull, 'w') as handle:
+                start = default_timer()
+                write_template(template, handle)
+                serialize_times.append(default_timer() - start)
+        return min(generate_times), min(serialize_times), len(template.resources)
+    finally:
+        for name, value in saved.items():
+            setattr(module, name, value)
+
+
+def find_regressions(results, baseline, tolerance):
+    # Returns a list of (case name, measurement, seconds, baseline seconds).
+    regressions = []
+    for name in sorted(results):
+        for measurement in ('generate', 'serialize'):
+            if name not in baseline:
+                continue
+            seconds = results[name][measurement]
+            baseline_seconds = baseline[name][measurement]
+            if seconds > baseline_seconds * (1 + tolerance) and seconds - baseline_seconds > minimum_regression:
+                regressions.append((name, measurement, seconds, baseline_seconds))
+    return regressions
+
+
+def main():
+    option_parser = OptionParser()
+
+    option_parser.add_option(
+        '-n', '--Repeat',
+        dest='repeat',
+        type='int',
+        help='The number of times each case is run; the best time is kept.',
+        default=5
+    )
+
+    option_parser.add_option(
+        '-b', '--Baseline',
+        dest='baseline',
+        help='The baseline file. (Default: cfgen/benchmark_baseline.json)',
+        default=default_baseline_path
+    )
+
+    option_parser.add_option(
+        '-t', '--Tolerance',
+        dest='tolerance',
+        type='float',
+        help='Allowed slowdown relative to the baseline, e.g. 0.5 for 50%.',
+        default=0.5
+    )
+
+    option_parser.add_option(
+        '--UpdateBaseline',
+        dest='update_baseline',
+        action='store_true',
+        help='Store this run as the baseline instead of comparing against it.',
+        default=False
+    )
+
+    (options, args) = option_parser.parse_args()
+
+    results = {}
+    print('%-32s %9s %12s %13s' % ('Case', 'Resources', 'Generate ms', 'Serialize ms'))
+    for name, module, generator_options, patches in get_cases():
+        generate_seconds, serialize_seconds, resource_count = run_case(
+            module, generator_options, patches, options.repeat)
+        results[name] = dict(generate=generate_seconds, serialize=serialize_seconds)
+        print('%-32s %9d %12.2f %13.2f' % (name, resource_count, generate_seconds * 1000, serialize_seconds * 1000))
+
+    if options.update_baseline:
+        with open(options.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=4, sort_keys=True, separators=(',', ': '))
+        print('Baseline stored in %s' % options.baseline)
+        return
+
+    if not os.path.isfile(options.baseline):
+        print('No baseline at %s; run with --UpdateBaseline to store one.' % options.baseline)
+        sys.exit(1)
+
+    with open(options.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = find_regressions(results, baseline, options.tolerance)
+    for name, measurement, seconds, baseline_seconds in regressions:
+        print('REGRESSION %s %s: %.2f ms, baseline %.2f ms' % (
+            name, measurement, seconds * 1000, baseline_seconds * 1000))
+    missing_cases = sorted(set(results) - set(baseline))
+    for name in missing_cases:
+        print('NO BASELINE %s; run with --UpdateBaseline to store one.' % name)
+    if regressions or missing_cases:
+        sys.exit(1)
+    print('No regressions against %s' % options.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+# Batch build of every CloudFormation template generator.
+# A generator is any script beneath the cloudformation directory that defines
+# generate_stack_template().  Each generator is rendered once for every
+# combination of the build dimensions (environment, purpose, region) that its
+# generate_stack_template() accepts, and the renders are fanned out over a
+# process pool so that a full release scales with the number of cores.
+# Besides the default template, a generator is rendered for each of its
+# variants below: the feature options of the templates actually deployed.
+# Templates whose inputs are unchanged are served from the cache in cache.py.
+# On Python 2 the process pool requires the futures backport:
+# pip install futures
+import imp
+import inspect
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+from optparse import OptionParser
+
+from cfgen.cache import evict_cache_entries, get_cache_settings, write_cached_template
+from cfgen.output import write_template_file
+
+# The generators live beneath the parent of this package.
+root_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Arguments of generate_stack_template() that a build fans out over.
+build_dimensions = ('environment', 'purpose', 'region')
+
+# Variants of the generators, as (name, generate_stack_template() keyword
+# arguments), keyed by the generator path beneath the cloudformation
+# directory.  A variant's template is named after the default template with
+# the variant name appended, e.g. WebAuthor-Alb.json.
+generator_variants = {
+    'elasticache/redis_cache.py': [
+        ('Monitoring', dict(monitoring=True)),
+        ('ClusterMode', dict(cluster_mode=True, monitoring=True))
+    ],
+    'generator/WebAuthor.py': [
+        ('Alb', dict(load_balancer_type='application', tls_termination=True, monitoring=True)),
+        ('AlbCloudFront', dict(load_balancer_type='application', tls_termination=True, cdn=True, monitoring=True))
+    ],
+    'generator/jenkins-linux-simple.py': [
+        ('Agents', dict(agent_fleet=True, cache_volume_count=2, monitoring=True))
+    ],
+    'postgres/single/postgres_single.py': [
+        ('Replicas', dict(pgbouncer=True, replica_count=2, ebs_volumes=True, monitoring=True))
+    ],
+    'vpc/vpc.py': [
+        ('NatPerAz', dict(nat_gateway_per_az=True, zone_count=3, monitoring=True))
+    ],
+    'webserver/client.py': [
+        ('CloudFront', dict(api_micro_cache=True, cdn=True, monitoring=True))
+    ]
+}
+
+# Generator modules already loaded by this process, keyed by path.
+_loaded_generators = {}
+
+
+def find_generators(directory=root_directory):
+    paths = []
+    for dir_path, dir_names, file_names in os.walk(directory):
+        # Skip this package and hidden directories; walk in a stable order.
+        dir_names[:] = sorted(d for d in dir_names if d != 'cfgen' and not d.startswith('.'))
+        for file_name in sorted(file_names):
+            if not file_name.endswith('.py'):
+                continue
+            path = os.path.join(dir_path, file_name)
+            # Check the source rather than importing: plain scripts run on import.
+            with open(path) as source:
+                if 'def generate_stack_template(' in source.read():
+                    paths.append(path)
+    return paths
+
+
+def load_generator(path):
+    if path not in _loaded_generators:
+        relative_path = os.path.splitext(os.path.relpath(path, root_directory))[0]
+        name = 'generator_%s' % relative_path.replace(os.sep, '_').replace('-', '_')
+        _loaded_generators[path] = imp.load_source(name, path)
+    return _loaded_generators[path]
+
+
+def get_generator_dimensions(module):
+    get_argspec = getattr(inspect, 'getfullargspec', None) or inspect.getargspec
+    args = get_argspec(module.generate_stack_template).args
+    return [dimension for dimension in build_dimensions if dimension in args]
+
+
+def get_template_file_name(path, module, options):
+    if hasattr(module, 'template_file_name'):
+        return module.template_file_name(**options)
+    return '%s.json' % os.path.splitext(os.path.basename(path))[0]
+
+
+def get_variants(path):
+    # Returns the variants of a generator, the default template first.
+    relative_path = os.path.relpath(path, root_directory).replace(os.sep, '/')
+    return [('', {})] + generator_variants.get(relative_path, [])
+
+
+def get_variant_file_name(file_name, variant):
+    if not variant:
+        return file_name
+    base_name, extension = os.path.splitext(file_name)
+    return '%s-%s%s' % (base_name, variant, extension)
+
+
+def create_jobs(paths, dimension_values, output_directory, variants=True):
+    # dimension_values maps each build dimension to the list of values to render.
+    # A job is (generator path, generate_stack_template() keyword arguments, output path).
+    # Without variants only the default template of each generator is rendered.
+    jobs = []
+    for path in paths:
+        module = load_generator(path)
+        dimensions = get_generator_dimensions(module)
+        generator_variants = get_variants(path) if variants else [('', {})]
+        for values in product(*[dimension_values[dimension] for dimension in dimensions]):
+            dimension_options = dict(zip(dimensions, values))
+            file_name = get_template_file_name(path, module, dimension_options)
+            for variant, variant_options in generator_variants:
+                output_path = os.path.join(output_directory, get_variant_file_name(file_name, variant))
+                jobs.append((path, dict(dimension_options, **variant_options), output_path))
+    return jobs
+
+
+def render_template(path, options, output_path, cache_settings=None, minify=False):
+    # Runs in a worker process.
+    # Returns the wall time of the render in seconds and whether it was generated.
+    start = time.time()
+    module = load_generator(path)
+    if cache_settings is None:
+        write_template_file(module.generate_stack_template(**options), output_path, minify=minify)
+        generated = True
+    else:
+        generated = write_cached_template(
+            path, module.generate_stack_template, options, output_path, cache_settings, minify=minify)
+    return time.time() - start, generated
+
+
+def build_templates(jobs, max_workers=None, cache_settings=None, minify=False):
+    # Returns a list of (output path, seconds or None, error or None) in completion order.
+    results = []
+    executor = ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        futures = dict(
+            (executor.submit(render_template, path, options, output_path, cache_settings, minify), output_path)
+            for path, options, output_path in jobs
+        )
+        for future in as_completed(futures):
+            output_path = futures[future]
+            try:
+                elapsed, generated = future.result()
+            except Exception as error:
+                print('FAILED    %s: %s' % (output_path, error))
+                results.append((output_path, None, error))
+            else:
+                print('%8.3fs  %s%s' % (elapsed, output_path, '' if generated else ' (cached)'))
+                results.append((output_path, elapsed, None))
+    finally:
+        executor.shutdown()
+    return results
+
+
+def split_option_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def main():
+    option_parser = OptionParser()
+
+    option_parser.add_option(
+        '-e', '--Environment',
+        dest='environment',
+        help='Comma separated environments (Prod, Stage, Dev) for which templates should be generated.',
+        default='Dev'
+    )
+
+    option_parser.add_option(
+        '-p', '--Purpose',
+        dest='purpose',
+        help='Comma separated purposes for which templates should be generated.',
+        default='Platform'
+    )
+
+    option_parser.add_option(
+        '-r', '--Region',
+        dest='region',
+        help='Comma separated regions for generators that are region specific.',
+        default='us-east-1'
+    )
+
+    option_parser.add_option(
+        '-o', '--OutputDirectory',
+        dest='output_directory',
+        help='The directory into which generated templates are written.',
+        default='./build'
+    )
+
+    option_parser.add_option(
+        '-j', '--Jobs',
+        dest='jobs',
+        type='int',
+        help='The number of worker processes. (Default: number of cores.)',
+        default=None
+    )
+
+    option_parser.add_option(
+        '-m', '--Minify',
+        dest='minify',
+        action='store_true',
+        help='Write compact JSON without indentation.',
+        default=False
+    )
+
+    option_parser.add_option(
+        '--NoVariants',
+        dest='no_variants',
+        action='store_true',
+        help='Render only the default template of each generator, not its variants.',
+        default=False
+    )
+
+    option_parser.add_option(
+        '--CacheDirectory',
+        dest='cache_directory',
+        help='The template cache directory. (Default: $CFGEN_CACHE_DIRECTORY or .cfgen-cache)',
+        default=None
+    )
+
+    option_parser.add_option(
+        '--CacheMaxSizeMB',
+        dest='cache_max_size_mb',
+        type='float',
+        help='Evict least recently used cache entries beyond this total size.',
+        default=None
+    )
+
+    option_parser.add_option(
+        '--CacheMaxAgeDays',
+        dest='cache_max_age_days',
+        type='float',
+        help='Evict cache entries not used for this many days.',
+        default=None
+    )
+
+    option_parser.add_option(
+        '--NoCache',
+        dest='no_cache',
+        action='store_true',
+        help='Regenerate every template, bypassing the cache.',
+        default=False
+    )
+
+    (options, args) = option_parser.parse_args()
+    dimension_values = dict(
+        environment=split_option_list(options.environment),
+        purpose=split_option_list(options.purpose),
+        region=split_option_list(options.region)
+    )
+
+    if not os.path.isdir(options.output_directory):
+        os.makedirs(options.output_directory)
+
+    cache_settings = None
+    if not options.no_cache:
+        cache_settings = get_cache_settings(
+            options.cache_directory, options.cache_max_size_mb, options.cache_max_age_days)
+
+    start = time.time()
+    jobs = create_jobs(find_generators(), dimension_values, options.output_directory,
+                       variants=not options.no_variants)
+    results = build_templates(jobs, max_workers=options.jobs, cache_settings=cache_settings, minify=options.minify)
+    if cache_settings is not None:
+        evict_cache_entries(cache_settings)
+    failures = [result for result in results if result[2] is not None]
+
+    print('Generated %d of %d CloudFormation templates in %.3fs' % (
+        len(results) - len(failures), len(jobs), time.time() - start))
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
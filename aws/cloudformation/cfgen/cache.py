@@ -0,0 +1,166 @@
+# On-disk cache of generated CloudFormation templates.
+# A cache entry is keyed on everything that determines the generated JSON:
+# - the generator's file name and the source of its directory (generator,
+#   mappings and any sibling helper modules) and of this package,
+# - the generator options (environment, purpose, ...),
+# - the troposphere version.
+# On a hit the template is not regenerated, and the output file is not
+# rewritten when it already holds the same content, so mtimes stay put and
+# downstream uploads/change sets are not triggered.
+# The cache is bounded by total size and entry age so that CI can keep it
+# between runs.  Settings come from the environment:
+# CFGEN_CACHE_DIRECTORY, CFGEN_CACHE_MAX_SIZE_MB, CFGEN_CACHE_MAX_AGE_DAYS.
+# Eviction lists the whole cache, so it runs once per run, after the
+# templates are written: at the end of a batch build or of a generator script.
+# Set CFGEN_CACHE_DIRECTORY to an empty string to disable the cache.
+import filecmp
+import hashlib
+import os
+import shutil
+import time
+
+import troposphere
+
+from cfgen.output import check_template_size, get_temporary_path, replace_if_changed, write_template, write_template_file
+
+package_directory = os.path.dirname(os.path.abspath(__file__))
+
+default_cache_directory = os.path.join(os.path.dirname(package_directory), '.cfgen-cache')
+default_max_size_mb = 100
+default_max_age_days = 30
+
+# Source digests already computed by this process, keyed by directory.
+_source_digests = {}
+
+
+def get_cache_settings(directory=None, max_size_mb=None, max_age_days=None):
+    # Returns None when caching is disabled.
+    if directory is None:
+        directory = os.environ.get('CFGEN_CACHE_DIRECTORY', default_cache_directory)
+    if not directory:
+        return None
+    if max_size_mb is None:
+        max_size_mb = float(os.environ.get('CFGEN_CACHE_MAX_SIZE_MB', default_max_size_mb))
+    if max_age_days is None:
+        max_age_days = float(os.environ.get('CFGEN_CACHE_MAX_AGE_DAYS', default_max_age_days))
+    return dict(
+        directory=directory,
+        max_size=int(max_size_mb * 1024 * 1024),
+        max_age=max_age_days * 24 * 60 * 60
+    )
+
+
+def get_source_digest(directory):
+    if directory not in _source_digests:
+        digest = hashlib.sha256()
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.endswith('.py'):
+                digest.update(file_name.encode('utf-8'))
+                with open(os.path.join(directory, file_name), 'rb') as source:
+                    digest.update(source.read())
+        _source_digests[directory] = digest.hexdigest()
+    return _source_digests[directory]
+
+
+def get_cache_key(generator_path, options):
+    digest = hashlib.sha256()
+    # Generators may share a directory, so the file name is part of the key.
+    digest.update(os.path.basename(generator_path).encode('utf-8'))
+    digest.update(get_source_digest(os.path.dirname(os.path.abspath(generator_path))).encode('utf-8'))
+    digest.update(get_source_digest(package_directory).encode('utf-8'))
+    digest.update(repr(sorted(options.items())).encode('utf-8'))
+    digest.update(troposphere.__version__.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def get_cache_entry_path(cache_settings, key):
+    return os.path.join(cache_settings['directory'], '%s.json' % key)
+
+
+def copy_cache_entry(cache_settings, key, output_path):
+    # Copies a cached template to output_path unless the file already matches.
+    # Returns False if there is no such entry.
+    entry_path = get_cache_entry_path(cache_settings, key)
+    try:
+        # Refresh the entry's age so that eviction is least recently used.
+        os.utime(entry_path, None)
+        if not (os.path.isfile(output_path) and filecmp.cmp(entry_path, output_path, shallow=False)):
+            shutil.copyfile(entry_path, output_path)
+    except (IOError, OSError):
+        # Not cached, or evicted by another build process.
+        return False
+    return True
+
+
+def write_cache_entry(cache_settings, key, template_path):
+    directory = cache_settings['directory']
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another build process created it first.
+            pass
+    entry_path = get_cache_entry_path(cache_settings, key)
+    temporary_path = get_temporary_path(entry_path)
+    shutil.copyfile(template_path, temporary_path)
+    try:
+        os.rename(temporary_path, entry_path)
+    except OSError:
+        # Another build process stored the same entry first.
+        os.remove(temporary_path)
+
+
+def evict_cache_entries(cache_settings=None):
+    if cache_settings is None:
+        cache_settings = get_cache_settings()
+    if cache_settings is None:
+        return
+    directory = cache_settings['directory']
+    if not os.path.isdir(directory):
+        return
+    oldest_allowed = time.time() - cache_settings['max_age']
+    entries = []
+    for file_name in os.listdir(directory):
+        if not file_name.endswith('.json'):
+            continue
+        path = os.path.join(directory, file_name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    # Drop expired entries, then the least recently used until under the size limit.
+    total_size = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if mtime >= oldest_allowed and total_size <= cache_settings['max_size']:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            # Already evicted by another build process.
+            pass
+        total_size -= size
+
+
+def write_cached_template(generator_path, generate_stack_template, options, output_path,
+                          cache_settings=None, minify=False):
+    # Returns True if the template had to be generated, False on a cache hit.
+    if cache_settings is None:
+        cache_settings = get_cache_settings()
+    if cache_settings is None:
+        write_template_file(generate_stack_template(**options), output_path, minify=minify)
+        return True
+
+    key = get_cache_key(generator_path, dict(options, minify=minify))
+    if copy_cache_entry(cache_settings, key, output_path):
+        return False
+
+    # Stream the template to a temporary file, then cache it and move it into place.
+    temporary_path = get_temporary_path(output_path)
+    with open(temporary_path, 'w') as handle:
+        write_template(generate_stack_template(**options), handle, minify=minify)
+    check_template_size(output_path, os.path.getsize(temporary_path))
+    write_cache_entry(cache_settings, key, temporary_path)
+    replace_if_changed(temporary_path, output_path)
+    return True
@@ -0,0 +1,230 @@
+# CloudFront distributions in front of the web tiers.
+# A distribution serves static content from an S3 bucket, which only the
+# distribution may read (through an origin access identity), and sends the
+# API paths to the dynamic origin: the load balancer or web server of the
+# stack.  Static content is kept at the edge for long; API responses only as
+# long as the origin allows with Cache-Control, per caller, so the origin
+# still sees every uncacheable request.  The edge compresses responses (gzip
+# and brotli), so the origin need not.
+# The TTLs of both cache policies are stack parameters.
+# CloudFront reaches the dynamic origin over HTTPS by its domain name, which
+# must match the certificate of the origin; a parameter may name a DNS alias
+# of the origin that does.  An origin without a certificate of its own, e.g.
+# a web server with a self-signed one, has no usable default, and the
+# parameter is required.
+from troposphere import Equals, GetAtt, If, Join, Output, Parameter, Ref
+import troposphere.cloudfront as cloudfront
+import troposphere.s3 as s3
+
+# Paths sent to the dynamic origin.
+api_path_patterns = ['/api', '/api/*']
+
+# Request headers the dynamic origin needs besides Authorization, which is
+# part of the cache key.  Headers forwarded but not in the key do not split
+# the cache.
+api_forwarded_headers = ['Accept', 'Accept-Language', 'Content-Type', 'Origin', 'Referer']
+
+price_classes = ['PriceClass_100', 'PriceClass_200', 'PriceClass_All']
+
+
+def add_ttl_parameters(template, prefix, description, default_ttl, max_ttl):
+    # Returns (default TTL parameter, maximum TTL parameter).
+    param_default_ttl = template.add_parameter(Parameter(
+        '%sDefaultTtl' % prefix,
+        Description='Seconds the edge keeps %s that carry no Cache-Control max-age.' % description,
+        Type='Number',
+        Default=default_ttl,
+        MinValue='0'
+    ))
+    param_max_ttl = template.add_parameter(Parameter(
+        '%sMaxTtl' % prefix,
+        Description='The most seconds the edge keeps %s, whatever their Cache-Control; '
+                    'at least the default TTL.' % description,
+        Type='Number',
+        Default=max_ttl,
+        MinValue='0'
+    ))
+    return param_default_ttl, param_max_ttl
+
+
+def add_cache_policy(template, title, name, param_default_ttl, param_max_ttl, query_strings, cookies, headers):
+    # A cache policy whose key holds the given request values; responses are
+    # compressed, and cached per encoding.
+    headers_config = cloudfront.CacheHeadersConfig(HeaderBehavior='none')
+    if headers:
+        headers_config = cloudfront.CacheHeadersConfig(HeaderBehavior='whitelist', Headers=headers)
+    return template.add_resource(cloudfront.CachePolicy(
+        title,
+        CachePolicyConfig=cloudfront.CachePolicyConfig(
+            # Cache policy names are unique per account.
+            Name=Join('-', [Ref('AWS::StackName'), name]),
+            MinTTL=0,
+            DefaultTTL=Ref(param_default_ttl),
+            MaxTTL=Ref(param_max_ttl),
+            ParametersInCacheKeyAndForwardedToOrigin=cloudfront.ParametersInCacheKeyAndForwardedToOrigin(
+                CookiesConfig=cloudfront.CacheCookiesConfig(CookieBehavior=cookies),
+                EnableAcceptEncodingBrotli=True,
+                EnableAcceptEncodingGzip=True,
+                HeadersConfig=headers_config,
+                QueryStringsConfig=cloudfront.CacheQueryStringsConfig(QueryStringBehavior=query_strings)
+            )
+        )
+    ))
+
+
+def add_static_bucket(template, prefix):
+    # Returns (bucket, origin access identity) of the static content.
+    bucket = template.add_resource(s3.Bucket(
+        '%sStaticBucket' % prefix,
+        PublicAccessBlockConfiguration=s3.PublicAccessBlockConfiguration(
+            BlockPublicAcls=True,
+            BlockPublicPolicy=True,
+            IgnorePublicAcls=True,
+            RestrictPublicBuckets=True
+        )
+    ))
+    origin_access_identity = template.add_resource(cloudfront.CloudFrontOriginAccessIdentity(
+        '%sOriginAccessIdentity' % prefix,
+        CloudFrontOriginAccessIdentityConfig=cloudfront.CloudFrontOriginAccessIdentityConfig(
+            Comment=Join(' ', ['Static content of', Ref('AWS::StackName')])
+        )
+    ))
+    template.add_resource(s3.BucketPolicy(
+        '%sStaticBucketPolicy' % prefix,
+        Bucket=Ref(bucket),
+        PolicyDocument={
+            'Statement': [
+                {
+                    'Effect': 'Allow',
+                    'Principal': {'CanonicalUser': GetAtt(origin_access_identity, 'S3CanonicalUserId')},
+                    'Action': 's3:GetObject',
+                    'Resource': Join('', [GetAtt(bucket, 'Arn'), '/*'])
+                }
+            ]
+        }
+    ))
+    return bucket, origin_access_identity
+
+
+def add_distribution(template, prefix, origin_domain_name=None, origin_https_port=443):
+    # Adds the distribution, its static bucket and their parameters.
+    # origin_domain_name is the domain name of the dynamic origin, unless the
+    # origin domain name parameter names another; if None, the parameter
+    # must name it.
+    # Returns (distribution, static bucket).
+    if origin_domain_name is None:
+        param_origin_domain_name = template.add_parameter(Parameter(
+            '%sOriginDomainName' % prefix,
+            Description='Domain name CloudFront reaches the API on, matching the certificate of the origin.',
+            Type='String',
+            MinLength=1,
+            ConstraintDescription='Must name the origin by a domain name its certificate matches'
+        ))
+        api_domain_name = Ref(param_origin_domain_name)
+    else:
+        param_origin_domain_name = template.add_parameter(Parameter(
+            '%sOriginDomainName' % prefix,
+            Description='Domain name CloudFront reaches the API on, matching the certificate of the origin. '
+                        '(Default: the DNS name of the origin)',
+            Type='String',
+            Default=''
+        ))
+        name_condition = '%sOriginDomainNameDefault' % prefix
+        template.add_condition(name_condition, Equals(Ref(param_origin_domain_name), ''))
+        api_domain_name = If(name_condition, origin_domain_name, Ref(param_origin_domain_name))
+    param_price_class = template.add_parameter(Parameter(
+        '%sPriceClass' % prefix,
+        Description='The edge locations serving the distribution: PriceClass_100 (North America, Europe), '
+                    'PriceClass_200 (and most of Asia) or PriceClass_All.',
+        Type='String',
+        Default='PriceClass_100',
+        AllowedValues=price_classes
+    ))
+    param_static_default_ttl, param_static_max_ttl = add_ttl_parameters(
+        template, '%sStatic' % prefix, 'static content', '86400', '31536000')
+    param_api_default_ttl, param_api_max_ttl = add_ttl_parameters(
+        template, '%sApi' % prefix, 'API responses', '0', '60')
+
+    bucket, origin_access_identity = add_static_bucket(template, prefix)
+
+    static_cache_policy = add_cache_policy(
+        template, '%sStaticCachePolicy' % prefix, 'static', param_static_default_ttl, param_static_max_ttl,
+        query_strings='none', cookies='none', headers=[])
+    # Keyed on the caller (Authorization, cookies) and the query.
+    api_cache_policy = add_cache_policy(
+        template, '%sApiCachePolicy' % prefix, 'api', param_api_default_ttl, param_api_max_ttl,
+        query_strings='all', cookies='all', headers=['Authorization'])
+    api_origin_request_policy = template.add_resource(cloudfront.OriginRequestPolicy(
+        '%sApiOriginRequestPolicy' % prefix,
+        OriginRequestPolicyConfig=cloudfront.OriginRequestPolicyConfig(
+            Name=Join('-', [Ref('AWS::StackName'), 'api']),
+            CookiesConfig=cloudfront.OriginRequestCookiesConfig(CookieBehavior='none'),
+            HeadersConfig=cloudfront.OriginRequestHeadersConfig(
+                HeaderBehavior='whitelist',
+                Headers=api_forwarded_headers
+            ),
+            QueryStringsConfig=cloudfront.OriginRequestQueryStringsConfig(QueryStringBehavior='none')
+        )
+    ))
+
+    distribution = template.add_resource(cloudfront.Distribution(
+        '%sDistribution' % prefix,
+        DistributionConfig=cloudfront.DistributionConfig(
+            Comment=Join(' ', [Ref('AWS::StackName'), prefix]),
+            Enabled=True,
+            HttpVersion='http2',
+            IPV6Enabled=True,
+            PriceClass=Ref(param_price_class),
+            Origins=[
+                cloudfront.Origin(
+                    Id='static',
+                    DomainName=GetAtt(bucket, 'RegionalDomainName'),
+                    S3OriginConfig=cloudfront.S3OriginConfig(
+                        OriginAccessIdentity=Join('', [
+                            'origin-access-identity/cloudfront/', Ref(origin_access_identity)])
+                    )
+                ),
+                cloudfront.Origin(
+                    Id='api',
+                    DomainName=api_domain_name,
+                    CustomOriginConfig=cloudfront.CustomOriginConfig(
+                        HTTPSPort=origin_https_port,
+                        OriginProtocolPolicy='https-only',
+                        OriginSSLProtocols=['TLSv1.2']
+                    )
+                )
+            ],
+            DefaultCacheBehavior=cloudfront.DefaultCacheBehavior(
+                TargetOriginId='static',
+                AllowedMethods=['GET', 'HEAD'],
+                CachePolicyId=Ref(static_cache_policy),
+                Compress=True,
+                ViewerProtocolPolicy='redirect-to-https'
+            ),
+            CacheBehaviors=[
+                cloudfront.CacheBehavior(
+                    PathPattern=path_pattern,
+                    TargetOriginId='api',
+                    AllowedMethods=['GET', 'HEAD', 'OPTIONS', 'PUT', 'PATCH', 'POST', 'DELETE'],
+                    CachedMethods=['GET', 'HEAD'],
+                    CachePolicyId=Ref(api_cache_policy),
+                    Compress=True,
+                    OriginRequestPolicyId=Ref(api_origin_request_policy),
+                    ViewerProtocolPolicy='redirect-to-https'
+                )
+                for path_pattern in api_path_patterns
+            ]
+        )
+    ))
+
+    template.add_output(Output(
+        '%sDistributionDomainName' % prefix,
+        Description='Domain name of the CloudFront distribution.',
+        Value=GetAtt(distribution, 'DomainName')
+    ))
+    template.add_output(Output(
+        '%sStaticBucket' % prefix,
+        Description='S3 bucket of the static content the distribution serves.',
+        Value=Ref(bucket)
+    ))
+    return distribution, bucket
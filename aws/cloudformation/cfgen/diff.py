@@ -0,0 +1,339 @@
+# Offline change-set preview.
+# Compares a freshly generated template with the JSON emitted last time and
+# classifies every changed resource property by the update behaviour
+# CloudFormation will apply, using the local table below rather than a call
+# to the CloudFormation API.
+# A property whose value goes through Fn::FindInMap or Ref is also treated as
+# changed when the mapping or the parameter default it reads has changed, so a
+# CIDR or AMI mapping edit is reported against the resources it replaces.
+# The comparison visits each resource and each value once, so the cost is
+# linear in the size of the two templates.
+# Example:
+# python -m cfgen.diff --Generator vpc/vpc.py --Previous VpcPlatformDev.json -e Dev -p Platform
+import json
+import sys
+from optparse import OptionParser
+
+replacement = 'Replacement'
+some_interruption = 'Some interruption'
+no_interruption = 'No interruption'
+
+# Update behaviour of resource properties, from the CloudFormation resource
+# reference.  Properties not listed update with no interruption; '*' covers
+# every property of a resource type that cannot be updated in place.
+update_behaviours = {
+    'AWS::AutoScaling::AutoScalingGroup': {
+        'AutoScalingGroupName': replacement
+    },
+    'AWS::AutoScaling::LaunchConfiguration': {
+        '*': replacement
+    },
+    'AWS::AutoScaling::ScheduledAction': {
+        'AutoScalingGroupName': replacement
+    },
+    'AWS::CloudWatch::Alarm': {
+        'AlarmName': replacement
+    },
+    'AWS::CloudWatch::Dashboard': {
+        'DashboardName': replacement
+    },
+    'AWS::EC2::EIP': {
+        'Domain': replacement
+    },
+    'AWS::EC2::Instance': {
+        'AvailabilityZone': replacement,
+        'EbsOptimized': some_interruption,
+        'ImageId': replacement,
+        'InstanceType': some_interruption,
+        'KeyName': replacement,
+        'NetworkInterfaces': replacement,
+        'PlacementGroupName': replacement,
+        'PrivateIpAddress': replacement,
+        'SecurityGroups': replacement,
+        'SubnetId': replacement,
+        'Tenancy': some_interruption,
+        'UserData': some_interruption
+    },
+    'AWS::EC2::LaunchTemplate': {
+        'LaunchTemplateName': replacement
+    },
+    'AWS::EC2::NatGateway': {
+        'AllocationId': replacement,
+        'SubnetId': replacement
+    },
+    'AWS::EC2::PlacementGroup': {
+        '*': replacement
+    },
+    'AWS::EC2::PrefixList': {
+        'AddressFamily': replacement
+    },
+    'AWS::EC2::Route': {
+        'DestinationCidrBlock': replacement,
+        'RouteTableId': replacement
+    },
+    'AWS::EC2::RouteTable': {
+        'VpcId': replacement
+    },
+    'AWS::EC2::SecurityGroup': {
+        'GroupDescription': replacement,
+        'GroupName': replacement,
+        'VpcId': replacement
+    },
+    'AWS::EC2::SecurityGroupEgress': {
+        '*': replacement,
+        'Description': no_interruption
+    },
+    'AWS::EC2::SecurityGroupIngress': {
+        '*': replacement,
+        'Description': no_interruption
+    },
+    'AWS::EC2::Subnet': {
+        'AvailabilityZone': replacement,
+        'CidrBlock': replacement,
+        'VpcId': replacement
+    },
+    'AWS::EC2::SubnetRouteTableAssociation': {
+        'SubnetId': replacement
+    },
+    'AWS::EC2::VPC': {
+        'CidrBlock': replacement,
+        'InstanceTenancy': replacement
+    },
+    'AWS::EC2::VPCEndpoint': {
+        'ServiceName': replacement,
+        'VpcEndpointType': replacement,
+        'VpcId': replacement
+    },
+    'AWS::EC2::Volume': {
+        'AvailabilityZone': replacement,
+        'Encrypted': replacement,
+        'KmsKeyId': replacement,
+        'SnapshotId': replacement
+    },
+    'AWS::EC2::VolumeAttachment': {
+        '*': replacement
+    },
+    'AWS::ElastiCache::ParameterGroup': {
+        'CacheParameterGroupFamily': replacement
+    },
+    'AWS::ElastiCache::ReplicationGroup': {
+        'AtRestEncryptionEnabled': replacement,
+        'CacheSubnetGroupName': replacement,
+        'Engine': replacement,
+        'KmsKeyId': replacement,
+        'Port': replacement,
+        'PreferredCacheClusterAZs': replacement,
+        'ReplicationGroupId': replacement,
+        'SnapshotArns': replacement,
+        'SnapshotName': replacement
+    },
+    'AWS::ElastiCache::SubnetGroup': {
+        'CacheSubnetGroupName': replacement
+    },
+    'AWS::ElasticLoadBalancing::LoadBalancer': {
+        'LoadBalancerName': replacement,
+        'Scheme': replacement
+    },
+    'AWS::ElasticLoadBalancingV2::Listener': {
+        'LoadBalancerArn': replacement
+    },
+    'AWS::ElasticLoadBalancingV2::LoadBalancer': {
+        'Name': replacement,
+        'Scheme': replacement,
+        'Type': replacement
+    },
+    'AWS::ElasticLoadBalancingV2::TargetGroup': {
+        'Name': replacement,
+        'Port': replacement,
+        'Protocol': replacement,
+        'TargetType': replacement,
+        'VpcId': replacement
+    },
+    'AWS::IAM::InstanceProfile': {
+        'InstanceProfileName': replacement,
+        'Path': replacement
+    },
+    'AWS::IAM::Role': {
+        'Path': replacement,
+        'RoleName': replacement
+    },
+    'AWS::S3::Bucket': {
+        'BucketName': replacement
+    },
+    'AWS::S3::BucketPolicy': {
+        'Bucket': replacement
+    }
+}
+
+# Ordered from least to most disruptive.
+behaviour_rank = {no_interruption: 0, some_interruption: 1, replacement: 2}
+
+
+def get_update_behaviour(resource_type, property_name):
+    behaviours = update_behaviours.get(resource_type, {})
+    return behaviours.get(property_name, behaviours.get('*', no_interruption))
+
+
+def find_changed_keys(previous, current):
+    # Names in either dict whose values differ.
+    return set(
+        name for name in set(previous) | set(current)
+        if previous.get(name) != current.get(name)
+    )
+
+
+def find_changed_parameters(previous, current):
+    # A parameter reads differently when its default changes.
+    return set(
+        name for name in set(previous) | set(current)
+        if previous.get(name, {}).get('Default') != current.get(name, {}).get('Default')
+    )
+
+
+def reads_changed_input(value, changed_mappings, changed_parameters):
+    # True if the value contains a FindInMap or Ref that reads a changed mapping or parameter.
+    if isinstance(value, dict):
+        if 'Fn::FindInMap' in value:
+            map_name = value['Fn::FindInMap'][0]
+            if not isinstance(map_name, dict) and map_name in changed_mappings:
+                return True
+        if value.get('Ref') in changed_parameters:
+            return True
+        return any(reads_changed_input(item, changed_mappings, changed_parameters) for item in value.values())
+    if isinstance(value, list):
+        return any(reads_changed_input(item, changed_mappings, changed_parameters) for item in value)
+    return False
+
+
+def diff_resource(resource_type, previous, current, changed_mappings, changed_parameters):
+    # Returns a list of (property name, update behaviour) for the properties that change.
+    property_changes = []
+    previous_properties = previous.get('Properties', {})
+    current_properties = current.get('Properties', {})
+    for name in sorted(set(previous_properties) | set(current_properties)):
+        previous_value = previous_properties.get(name)
+        current_value = current_properties.get(name)
+        if previous_value != current_value or reads_changed_input(current_value, changed_mappings, changed_parameters):
+            property_changes.append((name, get_update_behaviour(resource_type, name)))
+
+    # Resource attributes (Metadata, DependsOn, policies) update in place.
+    for name in sorted(find_changed_keys(previous, current) - set(['Type', 'Properties'])):
+        property_changes.append((name, no_interruption))
+    return property_changes
+
+
+def diff_templates(previous, current):
+    # Takes two template dicts and returns one dict per added, removed or changed resource:
+    # logical_id, action (Add, Remove, Modify, Replace), resource_type, and
+    # property_changes as a list of (property name, update behaviour).
+    changed_mappings = find_changed_keys(previous.get('Mappings', {}), current.get('Mappings', {}))
+    changed_parameters = find_changed_parameters(previous.get('Parameters', {}), current.get('Parameters', {}))
+    previous_resources = previous.get('Resources', {})
+    current_resources = current.get('Resources', {})
+
+    changes = []
+    for logical_id in sorted(set(previous_resources) | set(current_resources)):
+        previous_resource = previous_resources.get(logical_id)
+        current_resource = current_resources.get(logical_id)
+        if previous_resource is None:
+            changes.append(dict(logical_id=logical_id, action='Add',
+                                resource_type=current_resource['Type'], property_changes=[]))
+        elif current_resource is None:
+            changes.append(dict(logical_id=logical_id, action='Remove',
+                                resource_type=previous_resource['Type'], property_changes=[]))
+        elif previous_resource['Type'] != current_resource['Type']:
+            changes.append(dict(logical_id=logical_id, action='Replace',
+                                resource_type=current_resource['Type'],
+                                property_changes=[('Type', replacement)]))
+        else:
+            property_changes = diff_resource(current_resource['Type'], previous_resource, current_resource,
+                                             changed_mappings, changed_parameters)
+            if property_changes:
+                worst = max(behaviour_rank[behaviour] for name, behaviour in property_changes)
+                changes.append(dict(logical_id=logical_id,
+                                    action='Replace' if worst == behaviour_rank[replacement] else 'Modify',
+                                    resource_type=current_resource['Type'],
+                                    property_changes=property_changes))
+    return changes
+
+
+def format_changes(changes):
+    lines = []
+    for change in changes:
+        lines.append('%-8s %s (%s)' % (change['action'], change['logical_id'], change['resource_type']))
+        for name, behaviour in change['property_changes']:
+            lines.append('             %s: %s' % (name, behaviour))
+    return '\n'.join(lines)
+
+
+def main():
+    # Imported here so that the diff functions above do not depend on the build.
+    from cfgen.build import get_generator_dimensions, load_generator
+
+    option_parser = OptionParser()
+
+    option_parser.add_option(
+        '-g', '--Generator',
+        dest='generator',
+        help='The path of the generator script.'
+    )
+
+    option_parser.add_option(
+        '--Previous',
+        dest='previous',
+        help='The path of the previously generated template.'
+    )
+
+    option_parser.add_option(
+        '-e', '--Environment',
+        dest='environment',
+        help='The environment (Prod, Stage, Dev), for generators that take one.',
+        default='Dev'
+    )
+
+    option_parser.add_option(
+        '-p', '--Purpose',
+        dest='purpose',
+        help='The purpose, for generators that take one.',
+        default='Platform'
+    )
+
+    option_parser.add_option(
+        '-r', '--Region',
+        dest='region',
+        help='The region, for generators that take one.',
+        default='us-east-1'
+    )
+
+    option_parser.add_option(
+        '--AllowReplacement',
+        dest='allow_replacement',
+        action='store_true',
+        help='Exit successfully even if resources would be replaced.',
+        default=False
+    )
+
+    (options, args) = option_parser.parse_args()
+    if not options.generator or not options.previous:
+        option_parser.error('--Generator and --Previous are required.')
+
+    module = load_generator(options.generator)
+    generator_options = dict(
+        (dimension, getattr(options, dimension)) for dimension in get_generator_dimensions(module)
+    )
+    current = module.generate_stack_template(**generator_options).to_dict()
+    with open(options.previous) as previous_file:
+        previous = json.load(previous_file)
+
+    changes = diff_templates(previous, current)
+    if changes:
+        print(format_changes(changes))
+    else:
+        print('No changes.')
+
+    if not options.allow_replacement and any(change['action'] in ('Replace', 'Remove') for change in changes):
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# Compaction of security group ingress rules.
+# A rule is a tuple (protocol, from port, to port, IPv4 CIDR).  Compaction
+# merges the CIDRs of rules that share a protocol and port range into the
+# fewest covering CIDR blocks, then merges the port ranges of rules that share
+# a protocol and CIDR.  The result admits exactly the same traffic.
+
+
+def parse_cidr(cidr):
+    # Returns the first and last address of the block as integers.
+    address, prefix_length = cidr.split('/')
+    octets = [int(octet) for octet in address.split('.')]
+    value = (octets[0] << 24) | (octets[1] << 16) | (octets[2] << 8) | octets[3]
+    size = 1 << (32 - int(prefix_length))
+    first = value & ~(size - 1) & 0xffffffff
+    return first, first + size - 1
+
+
+def format_cidr(first, prefix_length):
+    return '%d.%d.%d.%d/%d' % (
+        (first >> 24) & 0xff, (first >> 16) & 0xff, (first >> 8) & 0xff, first & 0xff, prefix_length)
+
+
+def range_to_cidrs(first, last):
+    # The fewest aligned CIDR blocks that exactly cover first..last.
+    cidrs = []
+    while first <= last:
+        # Largest block aligned at first that does not run past last.
+        size = first & -first if first else 1 << 32
+        while size > last - first + 1:
+            size >>= 1
+        cidrs.append(format_cidr(first, 32 - size.bit_length() + 1))
+        first += size
+    return cidrs
+
+
+def merge_cidrs(cidrs):
+    # Merges adjacent and overlapping blocks; returns CIDRs in address order.
+    ranges = sorted(parse_cidr(cidr) for cidr in cidrs)
+    merged = []
+    for first, last in ranges:
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return [cidr for first, last in merged for cidr in range_to_cidrs(first, last)]
+
+
+def cidr_contains(outer, inner):
+    outer_first, outer_last = parse_cidr(outer)
+    inner_first, inner_last = parse_cidr(inner)
+    return outer_first <= inner_first and inner_last <= outer_last
+
+
+def merge_port_ranges(port_ranges):
+    # Merges adjacent and overlapping (from port, to port) ranges.
+    # A range of -1 (all ICMP types, or all ports) is kept as is.
+    if any(from_port == -1 for from_port, to_port in port_ranges):
+        return [(-1, -1)]
+    merged = []
+    for from_port, to_port in sorted(port_ranges):
+        if merged and from_port <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], to_port)
+        else:
+            merged.append([from_port, to_port])
+    return [(from_port, to_port) for from_port, to_port in merged]
+
+
+def compact_ingress_rules(rules):
+    # Returns the compacted rules, sorted.
+    cidrs_by_ports = {}
+    for protocol, from_port, to_port, cidr in rules:
+        cidrs_by_ports.setdefault((protocol, from_port, to_port), []).append(cidr)
+
+    port_ranges_by_cidr = {}
+    for (protocol, from_port, to_port), cidrs in cidrs_by_ports.items():
+        for cidr in merge_cidrs(cidrs):
+            port_ranges_by_cidr.setdefault((protocol, cidr), []).append((from_port, to_port))
+
+    compacted = []
+    for (protocol, cidr), port_ranges in port_ranges_by_cidr.items():
+        for from_port, to_port in merge_port_ranges(port_ranges):
+            compacted.append((protocol, from_port, to_port, cidr))
+    return sorted(compacted)
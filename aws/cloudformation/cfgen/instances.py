@@ -0,0 +1,105 @@
+# EC2 instance types offered by the generators.
+# Each generator takes the type of its instances from the EC2InstanceType
+# parameter added here, and the tables sized to the instance type
+# (postgres_tuning.py, nginx_config.py) cover every type listed.
+# The current generation types (t3, m5, c5, r5) are Nitro based, with ENA
+# enhanced networking and NVMe EBS volumes; they need an AMI with the ENA and
+# NVMe drivers, e.g. Amazon Linux 2017.09 or later, which also links the
+# /dev/sdX names to the NVMe devices.  They are offered only by generators
+# whose AMI maps hold such AMIs (nitro_ami=True).  AMIs baked by
+# cfgen/packer.py are flagged for ENA, which takes effect only when the
+# source AMI has the drivers.
+# An optional placement group packs the instances of a stack close together
+# (cluster) for low latency networking, or onto distinct hardware (spread).
+from troposphere import Equals, Parameter, Ref
+import troposphere.ec2 as ec2
+
+# Instance types as (instance type, hardware), in the order offered.
+# memory:  MiB
+# ena:  Elastic Network Adapter enhanced networking.
+# ebs_optimized:  Dedicated EBS bandwidth is available (by default from c4 on).
+# nitro:  Built on the Nitro system; needs the ENA and NVMe drivers in the AMI.
+# cluster_placement:  May be launched in a cluster placement group; burstable
+# and previous generation types other than c4 may not.
+# Source:  https://aws.amazon.com/ec2/instance-types/
+instance_types = [
+    ('t2.micro', dict(memory=1024, vcpus=1, ena=False, ebs_optimized=False, nitro=False, cluster_placement=False)),
+    ('t2.small', dict(memory=2048, vcpus=1, ena=False, ebs_optimized=False, nitro=False, cluster_placement=False)),
+    ('t2.medium', dict(memory=4096, vcpus=2, ena=False, ebs_optimized=False, nitro=False, cluster_placement=False)),
+    ('t2.large', dict(memory=8192, vcpus=2, ena=False, ebs_optimized=False, nitro=False, cluster_placement=False)),
+    ('t3.micro', dict(memory=1024, vcpus=2, ena=True, ebs_optimized=True, nitro=True, cluster_placement=False)),
+    ('t3.small', dict(memory=2048, vcpus=2, ena=True, ebs_optimized=True, nitro=True, cluster_placement=False)),
+    ('t3.medium', dict(memory=4096, vcpus=2, ena=True, ebs_optimized=True, nitro=True, cluster_placement=False)),
+    ('t3.large', dict(memory=8192, vcpus=2, ena=True, ebs_optimized=True, nitro=True, cluster_placement=False)),
+    ('m3.medium', dict(memory=3840, vcpus=1, ena=False, ebs_optimized=False, nitro=False, cluster_placement=False)),
+    ('m3.large', dict(memory=7680, vcpus=2, ena=False, ebs_optimized=True, nitro=False, cluster_placement=False)),
+    ('m5.large', dict(memory=8192, vcpus=2, ena=True, ebs_optimized=True, nitro=True, cluster_placement=True)),
+    ('m5.xlarge', dict(memory=16384, vcpus=4, ena=True, ebs_optimized=True, nitro=True, cluster_placement=True)),
+    ('m5.2xlarge', dict(memory=32768, vcpus=8, ena=True, ebs_optimized=True, nitro=True, cluster_placement=True)),
+    ('c4.large', dict(memory=3840, vcpus=2, ena=False, ebs_optimized=True, nitro=False, cluster_placement=True)),
+    ('c5.large', dict(memory=4096, vcpus=2, ena=True, ebs_optimized=True, nitro=True, cluster_placement=True)),
+    ('c5.xlarge', dict(memory=8192, vcpus=4, ena=True, ebs_optimized=True, nitro=True, cluster_placement=True)),
+    ('c5.2xlarge', dict(memory=16384, vcpus=8, ena=True, ebs_optimized=True, nitro=True, cluster_placement=True)),
+    ('r5.large', dict(memory=16384, vcpus=2, ena=True, ebs_optimized=True, nitro=True, cluster_placement=True)),
+    ('r5.xlarge', dict(memory=32768, vcpus=4, ena=True, ebs_optimized=True, nitro=True, cluster_placement=True)),
+    ('r5.2xlarge', dict(memory=65536, vcpus=8, ena=True, ebs_optimized=True, nitro=True, cluster_placement=True))
+]
+
+instance_type_hardware = dict(instance_types)
+
+
+def get_offered_instance_types(nitro_ami=False):
+    # Returns the instance types an AMI can launch on; the Nitro types only if it has their drivers.
+    return [instance_type for instance_type, hardware in instance_types if nitro_ami or not hardware['nitro']]
+
+
+def add_instance_type_parameter(template, default, nitro_ami=False):
+    return template.add_parameter(Parameter(
+        'EC2InstanceType',
+        Description='EC2 instance type, reference this parameter to insure consistency',
+        Type='String',
+        Default=default,
+        AllowedValues=get_offered_instance_types(nitro_ami),
+        ConstraintDescription='Must be a valid EC2 instance type'
+    ))
+
+
+def get_ebs_optimized_map():
+    # EbsOptimized as f(instance type), for the instance types that have dedicated EBS bandwidth.
+    return dict(
+        (instance_type, {'EbsOptimized': 'true' if hardware['ebs_optimized'] else 'false'})
+        for instance_type, hardware in instance_types
+    )
+
+
+def add_placement_group(template, param_instance_type, default_strategy='cluster', strategies=('cluster', 'spread')):
+    # Adds a placement group with the strategy given by a parameter; the
+    # generator puts its instances or AutoScaling group in it.  Instances in
+    # several availability zones need strategies=('spread',): a cluster group
+    # is confined to one.
+    param_strategy = template.add_parameter(Parameter(
+        'PlacementStrategy',
+        Description='cluster packs the instances in one availability zone for low latency, high throughput '
+                    'networking; spread places each on distinct hardware, at most 7 per availability zone.',
+        Type='String',
+        Default=default_strategy,
+        AllowedValues=list(strategies)
+    ))
+    if 'cluster' in strategies:
+        # Fail at stack creation rather than at instance launch.
+        template.add_rule('PlacementGroupInstanceType', {
+            'RuleCondition': Equals(Ref(param_strategy), 'cluster'),
+            'Assertions': [{
+                'Assert': {'Fn::Contains': [
+                    [instance_type for instance_type, hardware in instance_types if hardware['cluster_placement']],
+                    Ref(param_instance_type)
+                ]},
+                'AssertDescription': 'Cluster placement groups need an instance type with enhanced networking, '
+                                     'e.g. m5, c4, c5 or r5.'
+            }]
+        })
+
+    return template.add_resource(ec2.PlacementGroup(
+        'PlacementGroup',
+        Strategy=Ref(param_strategy)
+    ))
@@ -0,0 +1,87 @@
+# Launch templates and mixed instances policies of AutoScaling groups.
+# A group launched from a launch template may take a mixed instances
+# policy: a number of on-demand instances as a base, a percentage of
+# on-demand instances above it and spot instances for the rest, over several
+# instance types.  Spot instances come from the pools with the most spare
+# capacity (capacity-optimized), which are the least likely to be
+# interrupted, and the group replaces those at risk ahead of the interruption
+# (capacity rebalancing).  More instance types mean more pools to draw from.
+from troposphere import GetAtt, Parameter, Ref
+from troposphere.autoscaling import InstancesDistribution, LaunchTemplateOverrides, LaunchTemplateSpecification
+from troposphere.autoscaling import MixedInstancesPolicy
+import troposphere.autoscaling as autoscaling
+import troposphere.ec2 as ec2
+
+from cfgen.instances import get_offered_instance_types, instance_type_hardware
+
+spot_allocation_strategy = 'capacity-optimized'
+
+
+def parse_instance_types(value, nitro_ami=False):
+    # Returns the instance types of a comma separated list, which must be in cfgen/instances.py
+    # and, unless nitro_ami, not Nitro based.
+    instance_types = [instance_type.strip() for instance_type in value.split(',') if instance_type.strip()]
+    unknown_instance_types = [
+        instance_type for instance_type in instance_types if instance_type not in instance_type_hardware]
+    if unknown_instance_types:
+        raise ValueError('Unknown instance types: %s' % ', '.join(unknown_instance_types))
+    offered_instance_types = get_offered_instance_types(nitro_ami)
+    nitro_instance_types = [
+        instance_type for instance_type in instance_types if instance_type not in offered_instance_types]
+    if nitro_instance_types:
+        raise ValueError('Instance types need an AMI with the ENA and NVMe drivers: %s'
+                         % ', '.join(nitro_instance_types))
+    return instance_types
+
+
+def add_launch_template(template, title, **launch_template_data):
+    return template.add_resource(ec2.LaunchTemplate(
+        title,
+        LaunchTemplateData=ec2.LaunchTemplateData(**launch_template_data)
+    ))
+
+
+def get_launch_template_specification(launch_template):
+    return LaunchTemplateSpecification(
+        LaunchTemplateId=Ref(launch_template),
+        Version=GetAtt(launch_template, 'LatestVersionNumber')
+    )
+
+
+def add_mixed_instances_parameters(template, prefix, description, on_demand_base_capacity=1,
+                                   on_demand_percentage=0):
+    # Returns (on-demand base capacity parameter, on-demand percentage parameter).
+    param_on_demand_base_capacity = template.add_parameter(Parameter(
+        '%sOnDemandBaseCapacity' % prefix,
+        Description='The number of %s instances that are always on-demand.' % description,
+        Type='Number',
+        Default=str(on_demand_base_capacity),
+        MinValue='0'
+    ))
+    param_on_demand_percentage = template.add_parameter(Parameter(
+        '%sOnDemandPercentage' % prefix,
+        Description='The percentage of %s instances above the base that are on-demand; the rest are spot.'
+                    % description,
+        Type='Number',
+        Default=str(on_demand_percentage),
+        MinValue='0',
+        MaxValue='100'
+    ))
+    return param_on_demand_base_capacity, param_on_demand_percentage
+
+
+def set_mixed_instances_policy(autoscaling_group, launch_template, instance_types, param_on_demand_base_capacity,
+                               param_on_demand_percentage):
+    # Launches the group from launch_template with any of instance_types, on-demand or spot.
+    autoscaling_group.CapacityRebalance = True
+    autoscaling_group.MixedInstancesPolicy = MixedInstancesPolicy(
+        InstancesDistribution=InstancesDistribution(
+            OnDemandBaseCapacity=Ref(param_on_demand_base_capacity),
+            OnDemandPercentageAboveBaseCapacity=Ref(param_on_demand_percentage),
+            SpotAllocationStrategy=spot_allocation_strategy
+        ),
+        LaunchTemplate=autoscaling.LaunchTemplate(
+            LaunchTemplateSpecification=get_launch_template_specification(launch_template),
+            Overrides=[LaunchTemplateOverrides(InstanceType=instance_type) for instance_type in instance_types]
+        )
+    )
@@ -0,0 +1,105 @@
+# CloudWatch alarms and dashboards of the performance of a stack.
+# A generator adds an alarm on each metric it watches, with the threshold
+# from a stack parameter, and a dashboard named after the stack that graphs
+# the metric of each alarm with its threshold.  The alarms notify the SNS
+# topic of the AlarmTopicArn parameter, if one is given.
+import json
+
+from troposphere import Equals, If, Not, Parameter, Ref, Sub
+import troposphere.cloudwatch as cloudwatch
+
+name_alarm_topic_condition = 'AlarmTopicGiven'
+
+# Size of a dashboard graph in grid units; the grid is 24 units wide.
+dashboard_width = 24
+widget_width = 8
+widget_height = 6
+
+
+def add_alarm_topic_parameter(template):
+    param_alarm_topic = template.add_parameter(Parameter(
+        'AlarmTopicArn',
+        Description='ARN of the SNS topic the alarms notify, or empty for none.',
+        Type='String',
+        Default=''
+    ))
+    template.add_condition(name_alarm_topic_condition, Not(Equals(Ref(param_alarm_topic), '')))
+    return param_alarm_topic
+
+
+def add_threshold_parameter(template, name, description, default):
+    return template.add_parameter(Parameter(
+        '%sAlarmThreshold' % name,
+        Description=description,
+        Type='Number',
+        Default=default
+    ))
+
+
+def add_alarm(template, title, description, metric, threshold, param_alarm_topic,
+              comparison_operator='GreaterThanThreshold', period=60, evaluation_periods=5):
+    # metric holds the Namespace, MetricName, Dimensions and Statistic (or ExtendedStatistic) of the alarm.
+    # threshold is a number or a reference to a threshold parameter.
+    alarm_actions = If(name_alarm_topic_condition, [Ref(param_alarm_topic)], Ref('AWS::NoValue'))
+    return template.add_resource(cloudwatch.Alarm(
+        title,
+        AlarmActions=alarm_actions,
+        AlarmDescription=description,
+        ComparisonOperator=comparison_operator,
+        EvaluationPeriods=evaluation_periods,
+        OKActions=alarm_actions,
+        Period=period,
+        Threshold=threshold,
+        # No data, e.g. no traffic, raises no alarm.
+        TreatMissingData='notBreaching',
+        **metric
+    ))
+
+
+def add_instance_alarms(template, title, description, dimension_name, dimension_value, param_cpu_threshold,
+                        param_alarm_topic):
+    # Returns alarms on the CPU utilization and failed status checks of an
+    # instance (InstanceId) or of the instances of an AutoScaling group
+    # (AutoScalingGroupName).
+    dimensions = [cloudwatch.MetricDimension(Name=dimension_name, Value=dimension_value)]
+    return [
+        add_alarm(template, '%sCpuAlarm' % title, '%s CPU utilization' % description,
+                  dict(Namespace='AWS/EC2', MetricName='CPUUtilization', Dimensions=dimensions, Statistic='Average'),
+                  Ref(param_cpu_threshold), param_alarm_topic),
+        # Any failed check, of the instance or of the host under it.
+        add_alarm(template, '%sStatusCheckAlarm' % title, '%s failed status checks' % description,
+                  dict(Namespace='AWS/EC2', MetricName='StatusCheckFailed', Dimensions=dimensions,
+                       Statistic='Maximum'),
+                  0, param_alarm_topic, evaluation_periods=2)
+    ]
+
+
+def get_dashboard_body(alarms):
+    # Returns the dashboard body: a graph per alarm, left to right and top to bottom.
+    # The alarm ARNs and the region are substituted by Fn::Sub.
+    columns = dashboard_width // widget_width
+    widgets = []
+    for index, alarm in enumerate(alarms):
+        widgets.append({
+            'type': 'metric',
+            'x': index % columns * widget_width,
+            'y': index // columns * widget_height,
+            'width': widget_width,
+            'height': widget_height,
+            'properties': {
+                'title': alarm.AlarmDescription,
+                'region': '${AWS::Region}',
+                # The graph of an alarm shows its metric and threshold.
+                'annotations': {'alarms': ['${%s.Arn}' % alarm.title]},
+                'view': 'timeSeries'
+            }
+        })
+    return Sub(json.dumps({'widgets': widgets}, sort_keys=True))
+
+
+def add_dashboard(template, alarms):
+    return template.add_resource(cloudwatch.Dashboard(
+        'PerformanceDashboard',
+        DashboardBody=get_dashboard_body(alarms),
+        DashboardName=Ref('AWS::StackName')
+    ))
@@ -0,0 +1,59 @@
+# Output stage for generated CloudFormation templates.
+# Template.to_json() builds the whole pretty-printed document as one string;
+# here the template dict is streamed to the file handle by json.dump instead.
+# Keys are sorted by default, so a given template always produces
+# byte-identical output in both the pretty and the minified form.
+# Pretty output is byte-identical to Template.to_json().
+import filecmp
+import json
+import os
+
+# CloudFormation rejects a TemplateBody larger than this; bigger templates
+# must be uploaded to S3 and passed by TemplateURL.
+template_body_limit = 51200
+
+pretty_separators = (',', ': ')
+minified_separators = (',', ':')
+
+
+def write_template(template, handle, minify=False, sort_keys=True):
+    if minify:
+        json.dump(template.to_dict(), handle, sort_keys=sort_keys, separators=minified_separators)
+    else:
+        json.dump(template.to_dict(), handle, indent=4, sort_keys=sort_keys, separators=pretty_separators)
+
+
+def check_template_size(output_path, size):
+    # Returns True if a template of this size can be passed as a TemplateBody.
+    if size > template_body_limit:
+        print('WARNING: %s is %d bytes, over the %d byte CloudFormation template body limit. '
+              'Minify it or deploy it from S3 by TemplateURL.' % (output_path, size, template_body_limit))
+        return False
+    return True
+
+
+def replace_if_changed(source_path, output_path):
+    # Moves source_path over output_path unless they already match.
+    # Returns True if output_path was written.
+    if os.path.isfile(output_path) and filecmp.cmp(source_path, output_path, shallow=False):
+        os.remove(source_path)
+        return False
+    if os.path.exists(output_path):
+        # os.rename does not replace an existing file on Windows.
+        os.remove(output_path)
+    os.rename(source_path, output_path)
+    return True
+
+
+def get_temporary_path(path):
+    return '%s.%d.tmp' % (path, os.getpid())
+
+
+def write_template_file(template, output_path, minify=False):
+    # Streams the template to output_path, leaving the file untouched if the content is unchanged.
+    # Returns True if output_path was written.
+    temporary_path = get_temporary_path(output_path)
+    with open(temporary_path, 'w') as handle:
+        write_template(template, handle, minify=minify)
+    check_template_size(output_path, os.path.getsize(temporary_path))
+    return replace_if_changed(temporary_path, output_path)
@@ -0,0 +1,278 @@
+# Pre-baked AMIs for the Linux generators.
+# For each image below a Packer config is created from the builder in
+# aws/packer/packer.web_author_core.json, with one amazon-ebs builder per
+# region of the generator's AMI map, each starting from the AMI the map holds
+# now.  The provisioner installs the packages the instance would otherwise
+# install at boot: the cfn-init packages of the instance resource, read from
+# the generated template, plus any setup commands listed below.  cfn-init then
+# finds the packages installed and moves on.  Last, the provisioner writes
+# the marker file below; the UserData scripts skip their boot-time installs
+# on instances that find it.
+# Packer writes the new AMI IDs to a manifest; the update step writes them
+# back into the AMI map in the generator source, so that the next templates
+# launch from the baked AMIs.
+# Examples:
+# python -m cfgen.packer --Image postgres-single
+# packer build build/packer/postgres-single.packer.json
+# python -m cfgen.packer --Image postgres-single --Manifest build/packer/postgres-single.manifest.json
+# or, with packer on the PATH, all three steps:
+# python -m cfgen.packer --Image postgres-single --Run
+import io
+import json
+import os
+import re
+import subprocess
+from optparse import OptionParser
+
+from cfgen.build import load_generator, root_directory
+
+base_config_path = os.path.join(root_directory, '..', 'packer', 'packer.web_author_core.json')
+
+# Written at the end of provisioning, so it exists only on a completed image.
+baked_image_marker_path = '/etc/baked-image'
+
+# Images: name, generator, the instance resource whose cfn-init packages are
+# baked in (or None), the module-level AMI map and its AMI attribute, and
+# setup commands run after the packages are installed.
+images = [
+    dict(
+        name='postgres-single',
+        generator='postgres/single/postgres_single.py',
+        resource='DatabaseServer',
+        ami_map='environment_attribute_map',
+        ami_attribute='DatabaseServerAmi',
+        commands=[]
+    ),
+    dict(
+        name='webserver-client',
+        generator='webserver/client.py',
+        resource='WebServer',
+        ami_map='environment_attribute_map',
+        ami_attribute='WebServerAmi',
+        commands=[]
+    ),
+    dict(
+        name='jenkins-linux',
+        generator='generator/jenkins-linux-simple.py',
+        # Jenkins is installed by the UserData script rather than cfn-init.
+        # The agents launch from the same image, so the service is left for
+        # the controller's UserData to enable.
+        resource=None,
+        ami_map='region_map',
+        ami_attribute='AMI',
+        commands=[
+            'sudo yum -y install java',
+            'sudo wget -O /etc/yum.repos.d/jenkins.repo http://pkg.jenkins-ci.org/redhat/jenkins.repo',
+            'sudo rpm --import https://jenkins-ci.org/redhat/jenkins-ci.org.key',
+            'sudo yum -y install jenkins'
+        ]
+    )
+]
+
+ami_id_pattern = re.compile(r'^ami-[0-9a-f]{8,17}$')
+
+
+def get_image(name):
+    for image in images:
+        if image['name'] == name:
+            return image
+    raise ValueError('Unknown image %s; the images are %s.' % (name, ', '.join(i['name'] for i in images)))
+
+
+def get_init_packages(template, resource_name):
+    # Returns the rpm URLs and yum package names of every cfn-init config of the resource.
+    rpms = []
+    yum_packages = []
+    init = template['Resources'][resource_name].get('Metadata', {}).get('AWS::CloudFormation::Init', {})
+    for config_name in sorted(init):
+        if config_name == 'configSets':
+            continue
+        packages = init[config_name].get('packages', {})
+        for name in sorted(packages.get('rpm', {})):
+            if packages['rpm'][name] not in rpms:
+                rpms.append(packages['rpm'][name])
+        for name in sorted(packages.get('yum', {})):
+            if name not in yum_packages:
+                yum_packages.append(name)
+    return rpms, yum_packages
+
+
+def get_provision_commands(image, template):
+    commands = ['sudo yum -y update']
+    if image['resource'] is not None:
+        rpms, yum_packages = get_init_packages(template, image['resource'])
+        if rpms:
+            commands.append('sudo yum -y install %s' % ' '.join(rpms))
+        if yum_packages:
+            commands.append('sudo yum -y install %s' % ' '.join(yum_packages))
+    return commands + image['commands'] + [
+        "echo %s | sudo tee %s" % (image['name'], baked_image_marker_path)
+    ]
+
+
+def get_unless_baked_user_data(lines):
+    # Returns UserData lines that run the given lines only on an instance
+    # launched from an AMI that was not baked by this module.
+    return ['if [ ! -f %s ]; then \n' % baked_image_marker_path] + list(lines) + ['fi \n']
+
+
+def get_source_amis(module, image):
+    # Returns {region: AMI ID} for the regions whose map entry holds a real AMI ID.
+    ami_map = getattr(module, image['ami_map'])
+    return dict(
+        (region, attributes[image['ami_attribute']]) for region, attributes in ami_map.items()
+        if ami_id_pattern.match(attributes.get(image['ami_attribute'], ''))
+    )
+
+
+def create_packer_config(image, base_config, manifest_path):
+    module = load_generator(os.path.join(root_directory, image['generator']))
+    template = module.generate_stack_template().to_dict()
+
+    # The base builder is a Windows one; keep its settings but talk ssh to Amazon Linux.
+    base_builder = dict(base_config['builders'][0])
+    for key in ('user_data_file', 'winrm_username'):
+        base_builder.pop(key, None)
+    # Flag the AMIs for enhanced networking, so that they launch on the ENA
+    # (Nitro) and SR-IOV (c4) instance types of cfgen/instances.py.
+    base_builder.update(
+        communicator='ssh',
+        ssh_username='ec2-user',
+        instance_type='t2.micro',
+        ena_support=True,
+        sriov_support=True
+    )
+
+    builders = []
+    for region, source_ami in sorted(get_source_amis(module, image).items()):
+        builder = dict(base_builder)
+        builder.update(
+            name=region,
+            region=region,
+            source_ami=source_ami,
+            ami_name='%s {{isotime "2006-01-02-1504"}}' % image['name'],
+            tags=dict(Image=image['name'], SourceAmi=source_ami)
+        )
+        builders.append(builder)
+
+    return {
+        'builders': builders,
+        'provisioners': [
+            {
+                'type': 'shell',
+                'inline': get_provision_commands(image, template)
+            }
+        ],
+        'post-processors': [
+            {
+                'type': 'manifest',
+                'output': manifest_path
+            }
+        ]
+    }
+
+
+def read_manifest_ami_ids(manifest_path):
+    # Returns {region: AMI ID} for the builds of the last Packer run in the manifest.
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    ami_ids = {}
+    for build in manifest['builds']:
+        if build.get('packer_run_uuid') != manifest.get('last_run_uuid'):
+            continue
+        for artifact in build['artifact_id'].split(','):
+            region, ami_id = artifact.split(':')
+            ami_ids[region] = ami_id
+    return ami_ids
+
+
+def write_ami_ids(generator_path, ami_map_name, ami_attribute, ami_ids):
+    # Rewrites the AMI IDs of the regions in ami_ids in the map literal in the generator source.
+    # Returns the regions updated.
+    # Keep the line endings of the source as they are.
+    with io.open(generator_path, encoding='utf-8', newline='') as source_file:
+        source = source_file.read()
+
+    map_start = re.search(r'^%s = \{' % re.escape(ami_map_name), source, re.MULTILINE)
+    if map_start is None:
+        raise ValueError('No %s map in %s.' % (ami_map_name, generator_path))
+    map_end = re.compile(r'^\}', re.MULTILINE).search(source, map_start.end()).end()
+
+    map_source = source[map_start.start():map_end]
+    updated_regions = []
+    for region, ami_id in sorted(ami_ids.items()):
+        entry = re.compile(r"('%s': \{[^}]*?'%s': ')ami-[0-9a-zx]+(')" % (re.escape(region), re.escape(ami_attribute)))
+        map_source, count = entry.subn(lambda match: match.group(1) + ami_id + match.group(2), map_source)
+        if count:
+            updated_regions.append(region)
+
+    with io.open(generator_path, 'w', encoding='utf-8', newline='') as source_file:
+        source_file.write(source[:map_start.start()] + map_source + source[map_end:])
+    return updated_regions
+
+
+def main():
+    option_parser = OptionParser()
+
+    option_parser.add_option(
+        '-i', '--Image',
+        dest='images',
+        help='Comma separated images to bake: %s. (Default: all)' % ', '.join(image['name'] for image in images),
+        default=','.join(image['name'] for image in images)
+    )
+
+    option_parser.add_option(
+        '-o', '--OutputDirectory',
+        dest='output_directory',
+        help='The directory for the Packer configs and manifests. (Default: ./build/packer)',
+        default=os.path.join('.', 'build', 'packer')
+    )
+
+    option_parser.add_option(
+        '--Manifest',
+        dest='manifest',
+        help='Write the AMI IDs in this Packer manifest back into the generator of the (single) image.'
+    )
+
+    option_parser.add_option(
+        '--Run',
+        dest='run',
+        action='store_true',
+        help='Run packer build on each config and write the new AMI IDs back into the generators.',
+        default=False
+    )
+
+    (options, args) = option_parser.parse_args()
+    selected_images = [get_image(name.strip()) for name in options.images.split(',') if name.strip()]
+
+    if options.manifest:
+        if len(selected_images) != 1:
+            option_parser.error('--Manifest takes a single --Image.')
+        image = selected_images[0]
+        regions = write_ami_ids(os.path.join(root_directory, image['generator']), image['ami_map'],
+                                image['ami_attribute'], read_manifest_ami_ids(options.manifest))
+        print('Updated %s in %s for %s' % (image['ami_map'], image['generator'], ', '.join(regions) or 'no regions'))
+        return
+
+    if not os.path.isdir(options.output_directory):
+        os.makedirs(options.output_directory)
+    with open(base_config_path) as base_config_file:
+        base_config = json.load(base_config_file)
+
+    for image in selected_images:
+        config_path = os.path.join(options.output_directory, '%s.packer.json' % image['name'])
+        manifest_path = os.path.join(options.output_directory, '%s.manifest.json' % image['name'])
+        with open(config_path, 'w') as config_file:
+            json.dump(create_packer_config(image, base_config, manifest_path), config_file,
+                      indent=4, sort_keys=True, separators=(',', ': '))
+        print('Packer config for %s is available in %s' % (image['name'], config_path))
+
+        if options.run:
+            subprocess.check_call(['packer', 'build', config_path])
+            regions = write_ami_ids(os.path.join(root_directory, image['generator']), image['ami_map'],
+                                    image['ami_attribute'], read_manifest_ami_ids(manifest_path))
+            print('Updated %s in %s for %s' % (image['ami_map'], image['generator'], ', '.join(regions)))
+
+
+if __name__ == '__main__':
+    main()
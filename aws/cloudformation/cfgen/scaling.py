@@ -0,0 +1,161 @@
+# Scaling of AutoScaling groups.
+# Generators use these to give a group capacity parameters, target tracking
+# policies, step policies driven by CloudWatch alarms, and scheduled actions.
+# Target tracking keeps a metric near a target by itself; the step policies
+# react to a metric leaving a band, e.g. latency, which is not proportional to
+# the size of the group and so cannot be tracked.
+from troposphere import Equals, Not, Parameter, Ref
+from troposphere.autoscaling import PredefinedMetricSpecification, ScalingPolicy, ScheduledAction
+from troposphere.autoscaling import StepAdjustments, TargetTrackingConfiguration
+import troposphere.cloudwatch as cloudwatch
+
+# Seconds before a new instance counts towards the group metrics.
+default_instance_warmup = 300
+
+
+def add_capacity_parameters(template, prefix, description, min_size=2, max_size=6, desired_capacity=2):
+    # Adds the size parameters of a group.
+    # Returns (minimum size parameter, maximum size parameter, desired capacity parameter).
+    param_min_size = template.add_parameter(Parameter(
+        '%sMinSize' % prefix,
+        Description='The minimum number of %s instances.' % description,
+        Type='Number',
+        Default=str(min_size),
+        MinValue='0'
+    ))
+    param_max_size = template.add_parameter(Parameter(
+        '%sMaxSize' % prefix,
+        Description='The maximum number of %s instances.' % description,
+        Type='Number',
+        Default=str(max_size),
+        MinValue='1'
+    ))
+    param_desired_capacity = template.add_parameter(Parameter(
+        '%sDesiredCapacity' % prefix,
+        Description='The number of %s instances to start with; the scaling policies adjust it.' % description,
+        Type='Number',
+        Default=str(desired_capacity),
+        MinValue='0'
+    ))
+    return param_min_size, param_max_size, param_desired_capacity
+
+
+def add_target_tracking_policy(template, title, autoscaling_group, predefined_metric_type, target_value,
+                               resource_label=None):
+    # Adds a policy keeping a predefined metric of the group at target_value.
+    # ALBRequestCountPerTarget needs the resource_label of the target group.
+    metric_specification = PredefinedMetricSpecification(PredefinedMetricType=predefined_metric_type)
+    if resource_label is not None:
+        metric_specification.ResourceLabel = resource_label
+    return template.add_resource(ScalingPolicy(
+        title,
+        AutoScalingGroupName=Ref(autoscaling_group),
+        EstimatedInstanceWarmup=default_instance_warmup,
+        PolicyType='TargetTrackingScaling',
+        TargetTrackingConfiguration=TargetTrackingConfiguration(
+            PredefinedMetricSpecification=metric_specification,
+            TargetValue=target_value
+        )
+    ))
+
+
+def add_step_scaling_policies(template, prefix, autoscaling_group, metric, high_threshold, low_threshold,
+                              scale_out_steps):
+    # Adds a scale out policy run by an alarm on the metric going above
+    # high_threshold, and a scale in policy removing one instance run by an
+    # alarm on it staying below low_threshold.
+    # metric holds the Namespace, MetricName, Dimensions and Statistic of the alarms.
+    # scale_out_steps is a list of (amount over high_threshold, instances to add).
+    scale_out_adjustments = []
+    for index, (lower_bound, adjustment) in enumerate(scale_out_steps):
+        step = StepAdjustments(MetricIntervalLowerBound=lower_bound, ScalingAdjustment=adjustment)
+        if index + 1 < len(scale_out_steps):
+            step.MetricIntervalUpperBound = scale_out_steps[index + 1][0]
+        scale_out_adjustments.append(step)
+
+    scale_out_policy = template.add_resource(ScalingPolicy(
+        '%sScaleOutPolicy' % prefix,
+        AdjustmentType='ChangeInCapacity',
+        AutoScalingGroupName=Ref(autoscaling_group),
+        EstimatedInstanceWarmup=default_instance_warmup,
+        MetricAggregationType='Average',
+        PolicyType='StepScaling',
+        StepAdjustments=scale_out_adjustments
+    ))
+    template.add_resource(cloudwatch.Alarm(
+        '%sHighAlarm' % prefix,
+        AlarmActions=[Ref(scale_out_policy)],
+        AlarmDescription='Scale out when %s is high.' % metric['MetricName'],
+        ComparisonOperator='GreaterThanThreshold',
+        EvaluationPeriods=3,
+        Period=60,
+        Threshold=high_threshold,
+        **metric
+    ))
+
+    scale_in_policy = template.add_resource(ScalingPolicy(
+        '%sScaleInPolicy' % prefix,
+        AdjustmentType='ChangeInCapacity',
+        AutoScalingGroupName=Ref(autoscaling_group),
+        MetricAggregationType='Average',
+        PolicyType='StepScaling',
+        StepAdjustments=[StepAdjustments(MetricIntervalUpperBound=0, ScalingAdjustment=-1)]
+    ))
+    template.add_resource(cloudwatch.Alarm(
+        '%sLowAlarm' % prefix,
+        AlarmActions=[Ref(scale_in_policy)],
+        AlarmDescription='Scale in when %s stays low.' % metric['MetricName'],
+        ComparisonOperator='LessThanThreshold',
+        # Scale in slower than out.
+        EvaluationPeriods=15,
+        Period=60,
+        Threshold=low_threshold,
+        **metric
+    ))
+    return scale_out_policy, scale_in_policy
+
+
+def add_scheduled_actions(template, prefix, autoscaling_group, param_min_size, description):
+    # Adds parameters and actions raising the minimum size of the group on a
+    # schedule, e.g. ahead of business hours, and restoring it afterwards.
+    # An empty scale out recurrence, the default, leaves the actions out.
+    param_scale_out_recurrence = template.add_parameter(Parameter(
+        '%sScheduledScaleOutRecurrence' % prefix,
+        Description='Cron expression (UTC) of the time to raise the minimum number of %s instances, '
+                    'e.g. 0 7 * * 1-5, or empty for no scheduled scaling.' % description,
+        Type='String',
+        Default=''
+    ))
+    param_scale_in_recurrence = template.add_parameter(Parameter(
+        '%sScheduledScaleInRecurrence' % prefix,
+        Description='Cron expression (UTC) of the time to restore the minimum number of %s instances.'
+                    % description,
+        Type='String',
+        Default='0 19 * * 1-5'
+    ))
+    param_scheduled_min_size = template.add_parameter(Parameter(
+        '%sScheduledMinSize' % prefix,
+        Description='The minimum number of %s instances between the scheduled scale out and scale in. '
+                    'Must not exceed the maximum size.' % description,
+        Type='Number',
+        Default='4',
+        MinValue='0'
+    ))
+
+    name_condition = '%sScheduledScalingEnabled' % prefix
+    template.add_condition(name_condition, Not(Equals(Ref(param_scale_out_recurrence), '')))
+
+    template.add_resource(ScheduledAction(
+        '%sScheduledScaleOut' % prefix,
+        Condition=name_condition,
+        AutoScalingGroupName=Ref(autoscaling_group),
+        MinSize=Ref(param_scheduled_min_size),
+        Recurrence=Ref(param_scale_out_recurrence)
+    ))
+    template.add_resource(ScheduledAction(
+        '%sScheduledScaleIn' % prefix,
+        Condition=name_condition,
+        AutoScalingGroupName=Ref(autoscaling_group),
+        MinSize=Ref(param_min_size),
+        Recurrence=Ref(param_scale_in_recurrence)
+    ))
@@ -0,0 +1,93 @@
+# Subnet layout of a VPC.
+# A layout has one subnet per tier (public, private, ...) and availability
+# zone, carved out of the VPC CIDR block.  Each subnet is sized for the hosts
+# its tier expects per zone times a growth headroom, plus the five addresses
+# AWS reserves in every subnet, rounded up to a CIDR block.
+# Subnets are allocated zone by zone, in tier order, each to the tightest
+# free range it fits in (best fit), which keeps large ranges free for later
+# blocks.  Because the allocation of the first zones does not depend on the
+# later ones, raising the zone count adds subnets without moving existing
+# ones; CloudFormation replaces a subnet whose CIDR block changes.  Adding a
+# tier does move the subnets allocated after its first one, so pin those of a
+# deployed VPC first.  Pinned subnets keep the CIDR blocks they have.
+import math
+
+from cfgen.ingress import cidr_contains, format_cidr, parse_cidr
+
+# Addresses AWS reserves in each subnet: network, router, DNS, future use and broadcast.
+aws_reserved_addresses = 5
+
+# The smallest subnet AWS allows.
+maximum_prefix_length = 28
+
+
+def get_zone_letter(zone_index):
+    if zone_index >= 26:
+        raise ValueError('At most 26 availability zones are supported, not %d.' % (zone_index + 1))
+    return chr(ord('A') + zone_index)
+
+
+def get_zone_index(subnet_name):
+    return ord(subnet_name[0]) - ord('A')
+
+
+def get_prefix_length(hosts, headroom):
+    # The longest prefix whose block holds hosts * headroom hosts and the reserved addresses.
+    addresses = int(math.ceil(hosts * headroom)) + aws_reserved_addresses
+    return min(32 - (addresses - 1).bit_length(), maximum_prefix_length)
+
+
+def reserve_range(free_ranges, first, last):
+    # Removes first..last from the free (first, last) ranges.
+    # Returns False, leaving the ranges as they are, unless it lies within one of them.
+    for index, (free_first, free_last) in enumerate(free_ranges):
+        if free_first <= first and last <= free_last:
+            remainder = []
+            if free_first < first:
+                remainder.append((free_first, first - 1))
+            if last < free_last:
+                remainder.append((last + 1, free_last))
+            free_ranges[index:index + 1] = remainder
+            return True
+    return False
+
+
+def allocate_block(free_ranges, prefix_length):
+    # Allocates an aligned block from the smallest free range that holds it; returns its CIDR.
+    size = 1 << (32 - prefix_length)
+    best = None
+    for first, last in free_ranges:
+        start = (first + size - 1) // size * size
+        if start + size - 1 <= last and (best is None or last - first < best[2] - best[1]):
+            best = (start, first, last)
+    if best is None:
+        raise ValueError('No free /%d block is left in the VPC.' % prefix_length)
+    reserve_range(free_ranges, best[0], best[0] + size - 1)
+    return format_cidr(best[0], prefix_length)
+
+
+def plan_subnets(vpc_cidr, zone_count, tiers, headroom, pinned_subnets=None):
+    # Returns the layout as a list of (tier, subnet name, zone index, CIDR) in allocation order.
+    # tiers is a list of (tier, subnet name suffix, hosts per zone); a subnet
+    # is named by its zone letter and the suffix of its tier, e.g. A1.
+    # pinned_subnets is {(tier, subnet name): CIDR} for subnets that keep their
+    # CIDR block; pins of subnets outside the layout or the VPC are ignored.
+    free_ranges = [parse_cidr(vpc_cidr)]
+    pinned = {}
+    for (tier, name), cidr in sorted((pinned_subnets or {}).items()):
+        if tier in [t[0] for t in tiers] and get_zone_index(name) < zone_count and cidr_contains(vpc_cidr, cidr):
+            if not reserve_range(free_ranges, *parse_cidr(cidr)):
+                raise ValueError('Pinned subnet %s %s overlaps another pinned subnet.' % (name, cidr))
+            pinned[(tier, name)] = cidr
+
+    layout = []
+    for zone_index in range(zone_count):
+        zone = get_zone_letter(zone_index)
+        for tier, suffix, hosts in tiers:
+            name = zone + suffix
+            cidr = pinned.get((tier, name))
+            if cidr is None:
+                cidr = allocate_block(free_ranges, get_prefix_length(hosts, headroom))
+            layout.append((tier, name, zone_index, cidr))
+    return layout
+
@@ -0,0 +1,309 @@
+# This script generates CloudFormation JSON with the troposphere library.
+# Advantages:  Clean, allows comments in code, examples included.
+# Disadvantages:  JSON section implemented alphabetical order,
+# not in 'traditional' order.  (Order is irrelevant in JSON.)
+# To use troposphere:
+# Install python 2.7.10 or later
+# The pip utility is in Python27/Scripts.
+# pip install troposphere
+# pip install awacs
+# Optional but quite helpful:  Install PyCharm Community Edition (Cost=0)
+# The Redis cache tier: an ElastiCache replication group in the private
+# subnets of a VPC from vpc/vpc.py, for session data and query results that
+# would otherwise be read from the database server on every request.
+# Without cluster mode the group has one shard, a primary and its replicas,
+# reached on the primary endpoint for writes and the reader endpoint, which
+# spreads connections over the replicas, for reads.  With cluster mode the
+# keys are partitioned over several shards, and cluster aware clients find
+# them from the configuration endpoint.
+from optparse import OptionParser
+import os
+import sys
+# Make the shared cfgen package (aws/cloudformation/cfgen) importable.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cfgen.cache import evict_cache_entries, write_cached_template
+from cfgen.monitoring import add_alarm, add_alarm_topic_parameter, add_dashboard, add_threshold_parameter
+from troposphere import Equals, Export, GetAtt, If, Join, Not, Sub, Tags
+from troposphere import Output
+from troposphere import Parameter, Ref, Template
+import troposphere.cloudwatch as cloudwatch
+import troposphere.ec2 as ec2
+import troposphere.elasticache as elasticache
+
+redis_engine_version = '6.2'
+redis_parameter_group_family = 'redis6.x'
+redis_port = 6379
+
+# Cache node types offered, in the order offered.
+# Source:  https://aws.amazon.com/elasticache/pricing/
+cache_node_types = [
+    'cache.t3.micro',
+    'cache.t3.small',
+    'cache.t3.medium',
+    'cache.m5.large',
+    'cache.m5.xlarge',
+    'cache.m5.2xlarge',
+    'cache.r5.large',
+    'cache.r5.xlarge',
+    'cache.r5.2xlarge'
+]
+
+# Alarms on the Redis engine, as (name, metric, statistic, description,
+# default threshold).  Redis runs commands on one thread, so the engine CPU
+# saturates long before the host CPU does.
+redis_alarms = [
+    ('EngineCpu', 'EngineCPUUtilization', 'Average', 'Redis engine CPU utilization (percent)', '90'),
+    ('MemoryUsage', 'DatabaseMemoryUsagePercentage', 'Average', 'Redis memory usage (percent of maxmemory)', '80'),
+    ('Evictions', 'Evictions', 'Sum', 'Redis keys evicted per minute', '100')
+]
+
+# Keys evicted when memory runs out.  Session keys carry a TTL, so
+# volatile-lru evicts sessions and cached results but never keys kept for good.
+max_memory_policies = ['volatile-lru', 'allkeys-lru', 'volatile-ttl', 'noeviction']
+
+
+def generate_description(template):
+    template.add_description('Creates an ElastiCache Redis replication group in the private subnets of a VPC')
+
+def generate_version(template):
+    template.add_version(version='2010-09-09')
+
+def template_file_name():
+    return 'RedisCacheStack.json'
+
+def add_endpoint_output(template, name, description, resource, attribute):
+    # Outputs and exports address:port of an endpoint of the replication group.
+    template.add_output(
+        Output(name,
+               Description=description,
+               Value=Join(':', [
+                   GetAtt(resource, '%s.Address' % attribute),
+                   GetAtt(resource, '%s.Port' % attribute)
+               ]),
+               Export=Export(Sub('${AWS::StackName}-%s' % name))
+        )
+    )
+
+def add_redis_alarms(template, resource_replication_group, cluster_mode):
+    # Adds alarms on the first node of the replication group, and the dashboard graphing them.
+    # Node IDs are those of the replication group with a node number, or with
+    # a shard and a node number in cluster mode.  Without cluster mode every
+    # node holds all the keys; in cluster mode the first shard stands in for the others.
+    node_id = Sub('${%s}-%s' % (resource_replication_group.title, '0001-001' if cluster_mode else '001'))
+    param_alarm_topic = add_alarm_topic_parameter(template)
+    alarms = []
+    for name, metric_name, statistic, description, default_threshold in redis_alarms:
+        param_threshold = add_threshold_parameter(
+            template, name, 'The %s that raises an alarm.' % description, default_threshold)
+        alarms.append(add_alarm(
+            template, 'Redis%sAlarm' % name, description,
+            dict(Namespace='AWS/ElastiCache', MetricName=metric_name,
+                 Dimensions=[cloudwatch.MetricDimension(Name='CacheClusterId', Value=node_id)],
+                 Statistic=statistic),
+            Ref(param_threshold), param_alarm_topic))
+    add_dashboard(template, alarms)
+
+def generate_stack_template(cluster_mode=False, monitoring=False):
+    template = Template()
+
+    generate_description(template)
+
+    generate_version(template)
+
+    # ---Parameters------------------------------------------------------------
+    param_vpc_id = Parameter(
+        'VpcIdentifer',
+        Description='The identity of the VPC (vpc-abcdwxyz) in which this stack shall be created.',
+        Type='AWS::EC2::VPC::Id',
+    )
+    template.add_parameter(param_vpc_id)
+
+    param_vpc_cidr_block = Parameter(
+        'VpcCidrBlock',
+        Description='The CIDR block of the VPC (w.x.y.z/n), the only addresses allowed to connect.',
+        Type='String',
+        Default='10.0.0.0/16'
+    )
+    template.add_parameter(param_vpc_cidr_block)
+
+    param_subnet_ids = Parameter(
+        'VpcSubnetIdentifiers',
+        Description='The private subnets (subnet-abcdwxyz), one per availability zone, in which the cache nodes '
+                    'shall be created, e.g. the Private subnet outputs of the VPC stack.',
+        Type='List<AWS::EC2::Subnet::Id>'
+    )
+    template.add_parameter(param_subnet_ids)
+
+    param_node_type = Parameter(
+        'CacheNodeType',
+        Description='The ElastiCache node type of every node.',
+        Type='String',
+        Default='cache.t3.small',
+        AllowedValues=cache_node_types
+    )
+    template.add_parameter(param_node_type)
+
+    # Cluster mode needs a replica per shard, for automatic failover.
+    param_replicas = Parameter(
+        'ReplicasPerShard',
+        Description='The number of read replicas of each shard; with at least one, a replica in another '
+                    'availability zone takes over when the primary fails.',
+        Type='Number',
+        Default='1',
+        MinValue='1' if cluster_mode else '0',
+        MaxValue='5'
+    )
+    template.add_parameter(param_replicas)
+
+    if cluster_mode:
+        param_shards = Parameter(
+            'Shards',
+            Description='The number of shards the keys are partitioned over.',
+            Type='Number',
+            Default='2',
+            MinValue='1',
+            MaxValue='90'
+        )
+        template.add_parameter(param_shards)
+
+    param_max_memory_policy = Parameter(
+        'MaxMemoryPolicy',
+        Description='The keys Redis evicts when its memory is full.',
+        Type='String',
+        Default='volatile-lru',
+        AllowedValues=max_memory_policies
+    )
+    template.add_parameter(param_max_memory_policy)
+
+    # ---Resources-------------------------------------------------------------
+    # Create a security group for the cache nodes.
+    # This must be internal to the VPC only.
+    name_security_group_cache = 'VpcCacheSecurityGroup'
+    resource_cache_security_group = ec2.SecurityGroup(
+        name_security_group_cache,
+        GroupDescription=Join(' ', ['Security group for VPC cache', Ref(param_vpc_id)]),
+        Tags=Tags(Name=name_security_group_cache),
+        VpcId=Ref(param_vpc_id)
+    )
+    template.add_resource(resource_cache_security_group)
+
+    template.add_output(
+        Output(
+            'SecurityGroupForCache',
+            Description='Security group created for the cache in VPC.',
+            Value=Ref(resource_cache_security_group)
+        )
+    )
+
+    # Add ingress rule from VPC to cache security group for Redis traffic.
+    template.add_resource(ec2.SecurityGroupIngress(
+        'CacheSecurityGroupRedisIngress',
+        CidrIp=Ref(param_vpc_cidr_block),
+        FromPort=str(redis_port),
+        GroupId=Ref(resource_cache_security_group),
+        IpProtocol='tcp',
+        ToPort=str(redis_port)
+    ))
+
+    resource_subnet_group = template.add_resource(elasticache.SubnetGroup(
+        'RedisSubnetGroup',
+        Description=Join(' ', ['Private subnets of the Redis cache in VPC', Ref(param_vpc_id)]),
+        SubnetIds=Ref(param_subnet_ids)
+    ))
+
+    resource_parameter_group = template.add_resource(elasticache.ParameterGroup(
+        'RedisParameterGroup',
+        CacheParameterGroupFamily=redis_parameter_group_family,
+        Description=Join(' ', ['Redis settings of', Ref('AWS::StackName')]),
+        Properties={
+            'cluster-enabled': 'yes' if cluster_mode else 'no',
+            'maxmemory-policy': Ref(param_max_memory_policy)
+        }
+    ))
+
+    resource_replication_group = elasticache.ReplicationGroup(
+        'RedisReplicationGroup',
+        AtRestEncryptionEnabled=True,
+        AutomaticFailoverEnabled=True,
+        CacheNodeType=Ref(param_node_type),
+        CacheParameterGroupName=Ref(resource_parameter_group),
+        CacheSubnetGroupName=Ref(resource_subnet_group),
+        Engine='redis',
+        EngineVersion=redis_engine_version,
+        MultiAZEnabled=True,
+        Port=redis_port,
+        ReplicasPerNodeGroup=Ref(param_replicas),
+        ReplicationGroupDescription=Join(' ', ['Redis cache of', Ref('AWS::StackName')]),
+        SecurityGroupIds=[Ref(resource_cache_security_group)],
+        Tags=Tags(Name=Ref('AWS::StackName'))
+    )
+    if cluster_mode:
+        resource_replication_group.NumNodeGroups = Ref(param_shards)
+    else:
+        # Automatic failover needs a replica to fail over to.
+        name_condition_replicas = 'HasReplicas'
+        template.add_condition(name_condition_replicas, Not(Equals(Ref(param_replicas), '0')))
+        resource_replication_group.AutomaticFailoverEnabled = If(name_condition_replicas, True, False)
+        resource_replication_group.MultiAZEnabled = If(name_condition_replicas, True, False)
+    template.add_resource(resource_replication_group)
+
+    if monitoring:
+        add_redis_alarms(template, resource_replication_group, cluster_mode)
+
+    # ---Outputs---------------------------------------------------------------
+    if cluster_mode:
+        add_endpoint_output(template, 'ConfigurationEndpoint',
+                            'Address and port cluster aware Redis clients discover the shards from',
+                            resource_replication_group, 'ConfigurationEndPoint')
+    else:
+        add_endpoint_output(template, 'PrimaryEndpoint', 'Address and port of the Redis primary, for writes',
+                            resource_replication_group, 'PrimaryEndPoint')
+        add_endpoint_output(template, 'ReaderEndpoint',
+                            'Address and port spreading connections over the Redis replicas, for reads',
+                            resource_replication_group, 'ReaderEndPoint')
+
+    return template
+
+# ---Generate CloudFormation template------------------------------------------
+def main():
+    option_parser = OptionParser()
+
+    option_parser.add_option(
+        '-m', '--Minify',
+        dest='minify',
+        action='store_true',
+        help='Write compact JSON without indentation.',
+        default=False
+    )
+
+    option_parser.add_option(
+        '--ClusterMode',
+        dest='cluster_mode',
+        action='store_true',
+        help='Partition the keys over several shards (Redis cluster mode).',
+        default=False
+    )
+
+    option_parser.add_option(
+        '--Monitoring',
+        dest='monitoring',
+        action='store_true',
+        help='Add a CloudWatch dashboard and alarms on the engine CPU, memory usage and evictions of Redis.',
+        default=False
+    )
+
+    (options, args) = option_parser.parse_args()
+
+    template_path = './%s' % template_file_name()
+    generator_options = dict(cluster_mode=options.cluster_mode, monitoring=options.monitoring)
+
+    # Regenerate only when the inputs changed; rewrite only when the content changed.
+    if write_cached_template(__file__, generate_stack_template, generator_options,
+                             template_path, minify=options.minify):
+        print 'Generated CloudFormation template is available in %s' % template_path
+    else:
+        print 'Cached CloudFormation template is available in %s' % template_path
+    evict_cache_entries()
+
+if __name__ == '__main__':
+    main()
@@ -8,234 +8,559 @@
 # pip install troposphere
 # pip install awacs
 # Optional but helpful:  Install PyCharm Community Edition (Cost=0)
+from optparse import OptionParser
+import os
+import sys
+# Make the shared cfgen package (aws/cloudformation/cfgen) importable.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cfgen.cache import evict_cache_entries, write_cached_template
+from cfgen.cdn import add_distribution
+from cfgen.instances import add_instance_type_parameter, add_placement_group
+from cfgen.launch import add_launch_template, add_mixed_instances_parameters, parse_instance_types
+from cfgen.launch import set_mixed_instances_policy
+from cfgen.monitoring import add_alarm, add_alarm_topic_parameter, add_dashboard, add_threshold_parameter
+from cfgen.scaling import add_capacity_parameters, add_scheduled_actions, add_step_scaling_policies
+from cfgen.scaling import add_target_tracking_policy
 from troposphere import Base64, FindInMap, GetAtt, Join
 from troposphere import Output, Parameter, Ref, Template
 from troposphere.autoscaling import AutoScalingGroup, LaunchConfiguration, Tag
 from troposphere.elasticloadbalancing import LoadBalancer
 import troposphere.elasticloadbalancing as elb
+import troposphere.elasticloadbalancingv2 as elbv2
+import troposphere.cloudwatch as cloudwatch
 import troposphere.ec2 as ec2
 
-out_path = './WebAuthor.json'
-
-template = Template()
-
-#---Description----------------------------------------------------------------
-template.add_description('Configures an autoscaling group for WebAuthor (AKA Huxley)')
-
-#---Version--------------------------------------------------------------------
-template.add_version(version='2010-09-09')
-
-#---Parameters-----------------------------------------------------------------
-param_keyname = template.add_parameter(
-    Parameter(
-        'KeyName',
-        Description='Name of an existing EC2 KeyPair file (.pem) to use to create EC2 instances',
-        Type='AWS::EC2::KeyPair::KeyName'
-    )
-)
-
-param_instance_type = template.add_parameter(
-    Parameter(
-        'EC2InstanceType',
-        Description='EC2 instance type, reference this parameter to insure consistency',
-        Type='String',
-        Default='t2.micro',     # Prices from (2015-12-03)
-        AllowedValues=[         # Source :  https://aws.amazon.com/ec2/pricing/
-            't2.small',         # $0.036/hour
-            't2.micro',         # $0.018/hour
-            't2.medium',        # $0.072/hour
-            't2.large',         # $0.134/hour
-            'm3.medium',        # $0.130/hour
-            'm3.large'          # $0.259/hour
-        ],
-        ConstraintDescription='Must be a valid EC2 instance type'
-    )
-)
-
-param_environment = template.add_parameter(
-    Parameter(
-        'Environment',
-        Description='The environment name with which to associate this.',
-        Type='String',
-        AllowedValues=[
-            'Corp',
-            'Dev',
-            'Prod'
-        ],
-        Default='Dev'
-    )
-)
-
-#---Mappings-------------------------------------------------------------------
-# Get Windows Server 2012 AMI as f(region).
-mapping_region_map = template.add_mapping(
-    'RegionMap',
-    {
-        'ap-northeast-1': {
-            'AMI': 'ami-3e93fe3e'
-        },
-        'ap-southeast-1': {
-            'AMI': 'ami-faedfea8'
-        },
-        'ap-southeast-2': {
-            'AMI': 'ami-7bda9041'
-        },
-        'eu-central-1': {
-            'AMI': 'ami-f2f5f9ef'
-        },
-        'eu-west-1': {
-            'AMI': 'ami-2fcbf458'
-        },
-        'sa-east-1': {
-            'AMI': 'ami-02952d6e'
-        },
-        'us-east-1': {
-            'AMI': 'ami-1df0ac78'
-        },
-        'us-west-1': {
-            'AMI': 'ami-91f93ad5'
-        },
-        'us-west-2': {
-            'AMI': 'ami-xxxxxxxx'
-        }
+# Windows Server 2012 AMI as f(region).
+region_map = {
+    'ap-northeast-1': {
+        'AMI': 'ami-3e93fe3e'
+    },
+    'ap-southeast-1': {
+        'AMI': 'ami-faedfea8'
+    },
+    'ap-southeast-2': {
+        'AMI': 'ami-7bda9041'
+    },
+    'eu-central-1': {
+        'AMI': 'ami-f2f5f9ef'
+    },
+    'eu-west-1': {
+        'AMI': 'ami-2fcbf458'
+    },
+    'sa-east-1': {
+        'AMI': 'ami-02952d6e'
+    },
+    'us-east-1': {
+        'AMI': 'ami-1df0ac78'
+    },
+    'us-west-1': {
+        'AMI': 'ami-91f93ad5'
+    },
+    'us-west-2': {
+        'AMI': 'ami-xxxxxxxx'
     }
-);
+}
+
+# Windows Server 2012 images before 2018 lack the ENA and NVMe drivers of the
+# Nitro instance types; set this when the AMIs above are updated.
+nitro_ami = False
 
 # Map attributes to environment.
-mapping_environment_attribute_map = template.add_mapping(
-    'EnvironmentAttributeMap',
-    {
-        'Corp': {
-            'VpcId': 'vcp-xxxxxxxx',
-            'PublicSubnetArray': ['subnet-xxxxxxxx','subnet-xxxxxxxx'],
-            'SSLCertificateId': 'arn:aws:iam::724037942444:server-certificate/GodaddyChainCert'
-        },
-        'Dev': {
-            'VpcId': 'vpc-79af551c',
-            'PublicSubnetArray': ['subnet-054e9c60','subnet-0fbcae49'],
-            'SSLCertificateId': 'arn:aws:iam::724037942444:server-certificate/GodaddyChainCert'
-        },
-        'Prod': {
-            'VpcId': 'vcp-xxxxxxxx',
-            'PublicSubnetArray': ['subnet-xxxxxxxx','subnet-xxxxxxxx'],
-            'SSLCertificateId': 'arn:aws:iam::724037942444:server-certificate/GodaddyChainCert'
-        }
+environment_attribute_map = {
+    'Corp': {
+        'VpcId': 'vcp-xxxxxxxx',
+        'PublicSubnetArray': ['subnet-xxxxxxxx','subnet-xxxxxxxx'],
+        'SSLCertificateId': 'arn:aws:iam::724037942444:server-certificate/GodaddyChainCert'
+    },
+    'Dev': {
+        'VpcId': 'vpc-79af551c',
+        'PublicSubnetArray': ['subnet-054e9c60','subnet-0fbcae49'],
+        'SSLCertificateId': 'arn:aws:iam::724037942444:server-certificate/GodaddyChainCert'
+    },
+    'Prod': {
+        'VpcId': 'vcp-xxxxxxxx',
+        'PublicSubnetArray': ['subnet-xxxxxxxx','subnet-xxxxxxxx'],
+        'SSLCertificateId': 'arn:aws:iam::724037942444:server-certificate/GodaddyChainCert'
     }
-)
-
-#---Resources------------------------------------------------------------------
-# Allow SSH, http, https, and Jenkins on 8080
-load_balancer_security_group = template.add_resource(ec2.SecurityGroup(
-        'WebAuthorLoadBalancerSecurityGroup',
-        GroupDescription='Security Group for WebAuthor (Windows).',
-        SecurityGroupIngress=
-        [
-            ec2.SecurityGroupRule(
-                IpProtocol='tcp',
-                FromPort=80,
-                ToPort=80,
-                CidrIp='0.0.0.0/0'
+}
+
+
+def template_file_name():
+    return 'WebAuthor.json'
+
+
+def add_classic_load_balancer(template, param_environment, scheme):
+    # HTTPS listener re-encrypting to HTTPS on the instances.
+    load_balancer = template.add_resource(LoadBalancer(
+            'WebAuthorLoadBalancer',
+            ConnectionDrainingPolicy=elb.ConnectionDrainingPolicy(
+                Enabled=True,
+                Timeout=120
             ),
-            ec2.SecurityGroupRule(
-                IpProtocol='tcp',
-                FromPort=443,
-                ToPort=443,
-                CidrIp='0.0.0.0/0'
+            CrossZone=True,
+
+            HealthCheck=elb.HealthCheck(
+                HealthyThreshold='5',
+                Interval='20',
+                Target='HTTPS:443/',
+                Timeout='15',
+                UnhealthyThreshold='2',
+            ),
+            Listeners=[
+                elb.Listener(
+                    LoadBalancerPort='443',
+                    InstancePort='443',
+                    InstanceProtocol='HTTPS',
+                    Protocol='HTTPS',
+                    SSLCertificateId=FindInMap('EnvironmentAttributeMap', Ref(param_environment), 'SSLCertificateId')
+                )
+            ],
+            SecurityGroups=[Ref('WebAuthorLoadBalancerSecurityGroup')],
+            Scheme=scheme,
+            Subnets=FindInMap('EnvironmentAttributeMap', Ref(param_environment), 'PublicSubnetArray')
+        )
+    )
+    return load_balancer
+
+
+def add_application_load_balancer(template, param_environment, load_balancer_security_group, tls_termination,
+                                  scheme):
+    # HTTPS listener with HTTP/2, forwarding to HTTPS on the instances, or to
+    # HTTP when tls_termination is set, which saves the instances the TLS work.
+    # Returns the load balancer and its target group.
+    param_idle_timeout = template.add_parameter(
+        Parameter(
+            'LoadBalancerIdleTimeout',
+            Description='Seconds a connection may be idle before the load balancer closes it. '
+                        'Keep the keep-alive timeout of the web servers above this.',
+            Type='Number',
+            Default='60',
+            MinValue='1',
+            MaxValue='4000'
+        )
+    )
+
+    param_slow_start = template.add_parameter(
+        Parameter(
+            'SlowStartDuration',
+            Description='Seconds over which a new instance is ramped up to its full share of requests (0 disables).',
+            Type='Number',
+            Default='60',
+            AllowedValues=['0'] + [str(seconds) for seconds in range(30, 901, 30)]
+        )
+    )
+
+    param_deregistration_delay = template.add_parameter(
+        Parameter(
+            'DeregistrationDelay',
+            Description='Seconds in-flight requests may take to complete on an instance being removed.',
+            Type='Number',
+            Default='120',
+            MinValue='0',
+            MaxValue='3600'
+        )
+    )
+
+    load_balancer = template.add_resource(elbv2.LoadBalancer(
+            'WebAuthorLoadBalancer',
+            LoadBalancerAttributes=[
+                elbv2.LoadBalancerAttributes(Key='routing.http2.enabled', Value='true'),
+                elbv2.LoadBalancerAttributes(Key='idle_timeout.timeout_seconds', Value=Ref(param_idle_timeout))
+            ],
+            Scheme=scheme,
+            SecurityGroups=[Ref(load_balancer_security_group)],
+            Subnets=FindInMap('EnvironmentAttributeMap', Ref(param_environment), 'PublicSubnetArray'),
+            Type='application'
+        )
+    )
+
+    instance_protocol, instance_port = ('HTTP', 80) if tls_termination else ('HTTPS', 443)
+    target_group = template.add_resource(elbv2.TargetGroup(
+            'WebAuthorTargetGroup',
+            HealthCheckIntervalSeconds=20,
+            HealthCheckPath='/',
+            HealthCheckProtocol=instance_protocol,
+            HealthCheckTimeoutSeconds=15,
+            HealthyThresholdCount=5,
+            Port=instance_port,
+            Protocol=instance_protocol,
+            TargetGroupAttributes=[
+                elbv2.TargetGroupAttribute(
+                    Key='deregistration_delay.timeout_seconds', Value=Ref(param_deregistration_delay)),
+                elbv2.TargetGroupAttribute(Key='slow_start.duration_seconds', Value=Ref(param_slow_start))
+            ],
+            UnhealthyThresholdCount=2,
+            VpcId=FindInMap('EnvironmentAttributeMap', Ref(param_environment), 'VpcId')
+        )
+    )
+
+    template.add_resource(elbv2.Listener(
+            'WebAuthorHttpsListener',
+            Certificates=[elbv2.Certificate(
+                CertificateArn=FindInMap('EnvironmentAttributeMap', Ref(param_environment), 'SSLCertificateId')
+            )],
+            DefaultActions=[elbv2.Action(Type='forward', TargetGroupArn=Ref(target_group))],
+            LoadBalancerArn=Ref(load_balancer),
+            Port=443,
+            Protocol='HTTPS'
+        )
+    )
+    return load_balancer, target_group
+
+
+def generate_stack_template(load_balancer_type='classic', tls_termination=False, placement_group=False,
+                            spot_instance_types=None, cdn=False, monitoring=False):
+    template = Template()
+
+    #---Description-------------------------------------------------------------
+    template.add_description('Configures an autoscaling group for WebAuthor (AKA Huxley)')
+
+    #---Version-----------------------------------------------------------------
+    template.add_version(version='2010-09-09')
+
+    #---Parameters--------------------------------------------------------------
+    param_keyname = template.add_parameter(
+        Parameter(
+            'KeyName',
+            Description='Name of an existing EC2 KeyPair file (.pem) to use to create EC2 instances',
+            Type='AWS::EC2::KeyPair::KeyName'
+        )
+    )
+
+    param_instance_type = add_instance_type_parameter(template, 't2.micro', nitro_ami)
+
+    param_environment = template.add_parameter(
+        Parameter(
+            'Environment',
+            Description='The environment name with which to associate this.',
+            Type='String',
+            AllowedValues=[
+                'Corp',
+                'Dev',
+                'Prod'
+            ],
+            Default='Dev'
+        )
+    )
+
+    param_min_size, param_max_size, param_desired_capacity = add_capacity_parameters(
+        template, 'WebAuthor', 'WebAuthor', min_size=2, max_size=6, desired_capacity=2)
+
+    param_cpu_target = template.add_parameter(
+        Parameter(
+            'CpuTargetUtilization',
+            Description='The average CPU utilization (%) the autoscaling group is scaled to keep.',
+            Type='Number',
+            Default='50',
+            MinValue='10',
+            MaxValue='90'
+        )
+    )
+
+    param_high_latency = template.add_parameter(
+        Parameter(
+            'HighLatencyThreshold',
+            Description='Load balancer latency (seconds) above which instances are added.',
+            Type='Number',
+            Default='1'
+        )
+    )
+
+    param_low_latency = template.add_parameter(
+        Parameter(
+            'LowLatencyThreshold',
+            Description='Load balancer latency (seconds) below which instances are removed.',
+            Type='Number',
+            Default='0.2'
+        )
+    )
+
+    #---Mappings----------------------------------------------------------------
+    mapping_region_map = template.add_mapping('RegionMap', region_map)
+
+    mapping_environment_attribute_map = template.add_mapping('EnvironmentAttributeMap', environment_attribute_map)
+
+    #---Resources---------------------------------------------------------------
+    # Allow SSH, http, https, and Jenkins on 8080
+    load_balancer_security_group = template.add_resource(ec2.SecurityGroup(
+            'WebAuthorLoadBalancerSecurityGroup',
+            GroupDescription='Security Group for WebAuthor (Windows).',
+            SecurityGroupIngress=
+            [
+                ec2.SecurityGroupRule(
+                    IpProtocol='tcp',
+                    FromPort=80,
+                    ToPort=80,
+                    CidrIp='0.0.0.0/0'
+                ),
+                ec2.SecurityGroupRule(
+                    IpProtocol='tcp',
+                    FromPort=443,
+                    ToPort=443,
+                    CidrIp='0.0.0.0/0'
+                )
+            ],
+            VpcId=FindInMap('EnvironmentAttributeMap', Ref(param_environment), 'VpcId'),
+        )
+    )
+
+    # CloudFront reaches only internet-facing load balancers.
+    scheme = 'internet-facing' if cdn else 'internal'
+    if load_balancer_type == 'application':
+        load_balancer, target_group = add_application_load_balancer(
+            template, param_environment, load_balancer_security_group, tls_termination, scheme)
+        load_balancer_properties = dict(TargetGroupARNs=[Ref(target_group)])
+        latency_metric = dict(
+            Namespace='AWS/ApplicationELB',
+            MetricName='TargetResponseTime',
+            Dimensions=[cloudwatch.MetricDimension(
+                Name='LoadBalancer', Value=GetAtt(load_balancer, 'LoadBalancerFullName'))],
+            Statistic='Average'
+        )
+        # Connections refused because every target was busy: the ALB has no
+        # surge queue, so this is where queued requests end up.
+        saturation_metric = dict(
+            Namespace='AWS/ApplicationELB',
+            MetricName='RejectedConnectionCount',
+            Dimensions=latency_metric['Dimensions'],
+            Statistic='Sum'
+        )
+        saturation_description = 'connections rejected per minute'
+    else:
+        load_balancer = add_classic_load_balancer(template, param_environment, scheme)
+        load_balancer_properties = dict(LoadBalancerNames=[Ref(load_balancer)])
+        latency_metric = dict(
+            Namespace='AWS/ELB',
+            MetricName='Latency',
+            Dimensions=[cloudwatch.MetricDimension(Name='LoadBalancerName', Value=Ref(load_balancer))],
+            Statistic='Average'
+        )
+        # Requests waiting for a free instance.
+        saturation_metric = dict(
+            Namespace='AWS/ELB',
+            MetricName='SurgeQueueLength',
+            Dimensions=latency_metric['Dimensions'],
+            Statistic='Maximum'
+        )
+        saturation_description = 'requests in the surge queue'
+
+    autoscaling_group = AutoScalingGroup(
+            'WebAuthorAutoscalingGroup',
+            DesiredCapacity=Ref(param_desired_capacity),
+            HealthCheckGracePeriod=300,
+            HealthCheckType='EC2',
+            MaxSize=Ref(param_max_size),
+            MinSize=Ref(param_min_size),
+            Tags=[
+                Tag('Purpose', 'WebAuthor', True),
+                Tag('Environment', Ref(param_environment), True)
+            ],
+            VPCZoneIdentifier=FindInMap('EnvironmentAttributeMap', Ref(param_environment), 'PublicSubnetArray'),
+            **load_balancer_properties
+        )
+    if spot_instance_types:
+        # Launch on-demand and spot instances of several types, so that
+        # scaling out costs less.
+        launch_template = add_launch_template(
+            template,
+            'WebAuthorLaunchTemplate',
+            ImageId=FindInMap('RegionMap', Ref('AWS::Region'), 'AMI'),
+            InstanceType=Ref(param_instance_type),
+            KeyName=Ref(param_keyname),
+            SecurityGroupIds=[Ref(load_balancer_security_group)]
+        )
+        param_on_demand_base_capacity, param_on_demand_percentage = add_mixed_instances_parameters(
+            template, 'WebAuthor', 'WebAuthor')
+        set_mixed_instances_policy(autoscaling_group, launch_template, spot_instance_types,
+                                   param_on_demand_base_capacity, param_on_demand_percentage)
+    else:
+        launch_configuration = template.add_resource(LaunchConfiguration(
+                'WebAuthorLaunchConfiguration',
+                ImageId=FindInMap('RegionMap', Ref('AWS::Region'), 'AMI'),
+                InstanceType=Ref(param_instance_type),
+                KeyName=Ref(param_keyname),
+                SecurityGroups=[Ref(load_balancer_security_group)]
             )
-        ],
-        VpcId=FindInMap('EnvironmentAttributeMap', Ref(param_environment), 'VpcId'),
-    )
-)
-
-load_balancer = template.add_resource(LoadBalancer(
-        'WebAuthorLoadBalancer',
-        ConnectionDrainingPolicy=elb.ConnectionDrainingPolicy(
-            Enabled=True,
-            Timeout=120
-        ),
-        CrossZone=True,
-
-        HealthCheck=elb.HealthCheck(
-            HealthyThreshold='5',
-            Interval='20',
-            Target='HTTPS:443/',
-            Timeout='15',
-            UnhealthyThreshold='2',
-        ),
-        Listeners=[
-            elb.Listener(
-                LoadBalancerPort='443',
-                InstancePort='443',
-                InstanceProtocol='HTTPS',
-                Protocol='HTTPS',
-                SSLCertificateId=FindInMap('EnvironmentAttributeMap', Ref(param_environment), 'SSLCertificateId')
+        )
+        autoscaling_group.LaunchConfigurationName = Ref(launch_configuration)
+    template.add_resource(autoscaling_group)
+    if placement_group:
+        # The group spans availability zones, which a cluster placement group cannot.
+        autoscaling_group.PlacementGroup = Ref(add_placement_group(template, param_instance_type, 'spread'))
+
+    # Track CPU utilization, and add instances faster when latency climbs,
+    # which it can do before the CPUs are busy, e.g. when requests queue.
+    add_target_tracking_policy(
+        template, 'WebAuthorCpuTargetTrackingPolicy', autoscaling_group,
+        'ASGAverageCPUUtilization', Ref(param_cpu_target)
+    )
+
+    if load_balancer_type == 'application':
+        # Requests per instance, which the Classic ELB does not report.
+        param_request_count_target = template.add_parameter(
+            Parameter(
+                'RequestCountTarget',
+                Description='The requests per instance per minute the autoscaling group is scaled to keep.',
+                Type='Number',
+                Default='1000',
+                MinValue='1'
             )
-        ],
-        SecurityGroups=[Ref('WebAuthorLoadBalancerSecurityGroup')],
-        Scheme='internal',
-        Subnets=FindInMap('EnvironmentAttributeMap', Ref(param_environment), 'PublicSubnetArray')
+        )
+        add_target_tracking_policy(
+            template, 'WebAuthorRequestCountTargetTrackingPolicy', autoscaling_group,
+            'ALBRequestCountPerTarget', Ref(param_request_count_target),
+            resource_label=Join('/', [
+                GetAtt(load_balancer, 'LoadBalancerFullName'),
+                GetAtt(target_group, 'TargetGroupFullName')
+            ])
+        )
+
+    add_step_scaling_policies(
+        template, 'WebAuthorLatency', autoscaling_group, latency_metric,
+        Ref(param_high_latency), Ref(param_low_latency),
+        # One more instance, or two when latency is a second over the threshold.
+        scale_out_steps=[(0, 1), (1, 2)]
     )
-)
 
-launch_configuration = template.add_resource(LaunchConfiguration(
-        'WebAuthorLaunchConfiguration',
-        ImageId=FindInMap('RegionMap', Ref('AWS::Region'), 'AMI'),
-        InstanceType=Ref(param_instance_type),
-        KeyName=Ref(param_keyname),
-        SecurityGroups=[Ref(load_balancer_security_group)]
+    add_scheduled_actions(template, 'WebAuthor', autoscaling_group, param_min_size, 'WebAuthor')
+
+    if cdn:
+        # Static content is published to the bucket (WebAuthorStaticBucket
+        # output) by the deployment, e.g. with aws s3 sync.
+        add_distribution(template, 'WebAuthor', GetAtt(load_balancer, 'DNSName'))
+
+    if monitoring:
+        # Alarm on the slowest requests, which the average latency the group
+        # scales on hides, and on requests queueing at the load balancer.
+        param_alarm_topic = add_alarm_topic_parameter(template)
+        param_latency_threshold = add_threshold_parameter(
+            template, 'LatencyP99', 'The p99 latency (seconds) of the load balancer that raises an alarm.', '2')
+        param_saturation_threshold = add_threshold_parameter(
+            template, saturation_metric['MetricName'],
+            'The %s of the load balancer that raises an alarm.' % saturation_description,
+            '100' if load_balancer_type == 'classic' else '0')
+        latency_p99_metric = dict(latency_metric, ExtendedStatistic='p99')
+        del latency_p99_metric['Statistic']
+        alarms = [
+            add_alarm(template, 'WebAuthorLatencyP99Alarm', 'WebAuthor load balancer p99 latency',
+                      latency_p99_metric, Ref(param_latency_threshold), param_alarm_topic),
+            add_alarm(template, 'WebAuthor%sAlarm' % saturation_metric['MetricName'],
+                      'WebAuthor load balancer %s' % saturation_description,
+                      saturation_metric, Ref(param_saturation_threshold), param_alarm_topic)
+        ]
+        add_dashboard(template, alarms)
+
+    #---Outputs-----------------------------------------------------------------
+
+    template.add_output(Output(
+            'DNSName',
+            Description='The DNS name for the load balancer.',
+            Value=GetAtt(load_balancer, 'DNSName')
+        )
     )
-)
 
-autoscaling_group = template.add_resource(AutoScalingGroup(
-        'WebAuthorAutoscalingGroup',
-        DesiredCapacity=2,
-        HealthCheckGracePeriod=300,
-        HealthCheckType='EC2',
-        LaunchConfigurationName=Ref(launch_configuration),
-        LoadBalancerNames=[Ref(load_balancer)],
-        MaxSize=2,
-        MinSize=2,
-        Tags=[
-            Tag('Purpose', 'WebAuthor', True),
-            Tag('Environment', Ref(param_environment), True)
-        ],
-        VPCZoneIdentifier=FindInMap('EnvironmentAttributeMap', Ref(param_environment), 'PublicSubnetArray')
+    template.add_output(Output(
+            'AWSRegion',
+            Description='AWS Region used for instantiation',
+            Value=Ref('AWS::Region')
+        )
     )
-)
 
-#---Outputs--------------------------------------------------------------------
 
-template.add_output(Output(
-        'DNSName',
-        Description='The DNS name for the load balancer.',
-        Value=GetAtt(load_balancer, 'DNSName')
+    template.add_output(Output(
+            'Environment',
+            Description='Value of the Environment parameter',
+            Value=Ref(param_environment)
+        )
     )
-)
 
-template.add_output(Output(
-        'AWSRegion',
-        Description='AWS Region used for instantiation',
-        Value=Ref('AWS::Region')
+    return template
+
+
+#---Generate CloudFormation template-------------------------------------------
+def main():
+    option_parser = OptionParser()
+
+    option_parser.add_option(
+        '-m', '--Minify',
+        dest='minify',
+        action='store_true',
+        help='Write compact JSON without indentation.',
+        default=False
     )
-)
 
+    option_parser.add_option(
+        '-l', '--LoadBalancer',
+        dest='load_balancer_type',
+        type='choice',
+        choices=['classic', 'application'],
+        help='The load balancer: classic (Classic ELB) or application (ALB). (Default: classic)',
+        default='classic'
+    )
 
-template.add_output(Output(
-        'Environment',
-        Description='Value of the Environment parameter',
-        Value=Ref(param_environment)
+    option_parser.add_option(
+        '--TlsTermination',
+        dest='tls_termination',
+        action='store_true',
+        help='With the ALB, terminate TLS at the load balancer and forward HTTP to the instances.',
+        default=False
     )
-)
 
-#---Generate CloudFormation template-------------------------------------------
-# Generate JSON.
-json = template.to_json()
-# Write JSON to console.
-print json
+    option_parser.add_option(
+        '--PlacementGroup',
+        dest='placement_group',
+        action='store_true',
+        help='Launch the instances in a placement group, spread by default.',
+        default=False
+    )
+
+    option_parser.add_option(
+        '--Spot',
+        dest='spot_instance_types',
+        help='Comma separated instance types to launch on-demand and spot instances of, from a launch template '
+             'with a mixed instances policy, e.g. t2.large,m3.large,c4.large.',
+        default=None
+    )
+
+    option_parser.add_option(
+        '--CloudFront',
+        dest='cdn',
+        action='store_true',
+        help='Serve the site through a CloudFront distribution: static content from an S3 bucket, /api from '
+             'the load balancer, which becomes internet-facing.',
+        default=False
+    )
+
+    option_parser.add_option(
+        '--Monitoring',
+        dest='monitoring',
+        action='store_true',
+        help='Add a CloudWatch dashboard and alarms on the p99 latency and queued requests of the load balancer.',
+        default=False
+    )
+
+    (options, args) = option_parser.parse_args()
+    spot_instance_types = None
+    if options.spot_instance_types:
+        try:
+            spot_instance_types = parse_instance_types(options.spot_instance_types, nitro_ami)
+        except ValueError as error:
+            option_parser.error(str(error))
+
+    template_path = './%s' % template_file_name()
+    generator_options = dict(load_balancer_type=options.load_balancer_type,
+                             tls_termination=options.tls_termination, placement_group=options.placement_group,
+                             spot_instance_types=spot_instance_types, cdn=options.cdn,
+                             monitoring=options.monitoring)
+
+    # Regenerate only when the inputs changed; rewrite only when the content changed.
+    if write_cached_template(__file__, generate_stack_template, generator_options,
+                             template_path, minify=options.minify):
+        print 'Generated CloudFormation template is available in %s' % template_path
+    else:
+        print 'Cached CloudFormation template is available in %s' % template_path
+    evict_cache_entries()
 
-# Write JSON to a file.
-file = open(out_path, mode='w')
-file.writelines(json)
-file.close()
 
-print 'Generated CloudFormation template is available in %s' % out_path
\ No newline at end of file
+if __name__ == '__main__':
+    main()
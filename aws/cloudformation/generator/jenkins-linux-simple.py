@@ -14,201 +14,715 @@
 # cd cloudtools
 # git clone https://github.com/cloudtools/troposphere.git
 # Optional but helpful:  Install PyCharm Community Edition (Cost=0)
+from optparse import OptionParser
+import os
+import sys
+# Make the shared cfgen package (aws/cloudformation/cfgen) importable.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cfgen.cache import evict_cache_entries, write_cached_template
+from cfgen.instances import add_instance_type_parameter
+from cfgen.launch import add_launch_template, add_mixed_instances_parameters, get_launch_template_specification
+from cfgen.launch import parse_instance_types, set_mixed_instances_policy
+from cfgen.monitoring import add_alarm, add_alarm_topic_parameter, add_dashboard, add_instance_alarms
+from cfgen.monitoring import add_threshold_parameter
+from cfgen.packer import get_unless_baked_user_data
+from cfgen.scaling import add_capacity_parameters, add_step_scaling_policies
 from troposphere import Base64, FindInMap, GetAtt, Join
 from troposphere import Output, Parameter, Ref, Template
+from troposphere.autoscaling import AutoScalingGroup, Tag
+from awacs.aws import (Allow,
+                       Statement,
+                       Principal,
+                       Policy)
+from awacs.sts import AssumeRole
+import troposphere.cloudwatch as cloudwatch
 import troposphere.ec2 as ec2
+import troposphere.iam as iam
 
-out_path = './jenkins_linux_simple.json'
+# Jenkins AMI and availability zone as f(region).
+region_map = {
+    'ap-northeast-1': {
+        'AMI': 'ami-383c1956',
+        'RegionAvailabilityZone': 'ap-northeast-1c'
+    },
+    'ap-southeast-1': {
+        'AMI': 'ami-c9b572aa',
+        'RegionAvailabilityZone': 'ap-southeast-1b'
+    },
+    'ap-southeast-2': {
+        'AMI': 'ami-48d38c2b',
+        'RegionAvailabilityZone': 'ap-southeast-2b'
+    },
+    'eu-central-1': {
+        'AMI': 'ami-bc5b48d0',
+        'RegionAvailabilityZone': 'eu-central-1b'
+    },
+    'eu-west-1': {
+        'AMI': 'ami-bff32ccc',
+        'RegionAvailabilityZone': 'eu-west-1c'
+    },
+    'sa-east-1': {
+        'AMI': 'ami-6817af04',
+        'RegionAvailabilityZone': 'sa-east-1c'
+    },
+    'us-east-1': {
+        'AMI': 'ami-60b6c60a',
+        'RegionAvailabilityZone': 'us-east-1e'
+    },
+    'us-west-1': {
+        'AMI': 'ami-d5ea86b5',
+        'RegionAvailabilityZone': 'us-west-1c'
+    },
+    'us-west-2': {
+        'AMI': 'ami-f0091d91',
+        'RegionAvailabilityZone': 'us-west-2c'
+    }
+}
 
-template = Template()
+# The controller and agents launch from the AMIs above, which lack the ENA
+# and NVMe drivers of the Nitro instance types.
+nitro_ami = False
 
-#---Parameters-----------------------------------------------------------------
-param_keyname = template.add_parameter(
-    Parameter(
-        'KeyName',
-        Description='Name of an existing EC2 KeyPair file (.pem) to use to create EC2 instances',
-        Type='AWS::EC2::KeyPair::KeyName'
-    )
-)
 
-param_instance_type = template.add_parameter(
-    Parameter(
-        'EC2InstanceType',
-        Description='EC2 instance type, reference this parameter to insure consistency',
-        Type='String',
-        Default='t2.micro',
-        AllowedValues=[
-            't2.small',
-            't2.micro',
-            't2.medium',
-            't2.large',
-            'm3.medium',
-            'm3.large'
-        ],
-        ConstraintDescription='Must be a valid EC2 instance type'
-    )
-)
-
-param_environment = template.add_parameter(
-    Parameter(
-        'Environment',
-        Description='The environment name with which to associate this.',
+# With the agent fleet, the controller publishes the length of its build
+# queue every minute as this CloudWatch metric, with a StackName dimension.
+build_queue_metric_namespace = 'Jenkins'
+build_queue_metric_name = 'BuildQueueLength'
+
+# The port inbound agents connect to the controller on; set it as the TCP
+# port for inbound agents in the Jenkins security settings.
+jenkins_agent_port = 50000
+
+# Build caches and workspaces may live on cache volumes, which a new instance
+# restores from the most recent snapshot set taken by another, so that it
+# starts with warm Maven, npm, pip and Gradle caches.  Several volumes are
+# striped as RAID0 for throughput.  The volumes are created at boot in the
+# zone of the instance and deleted with it; the snapshots, tagged with the
+# stack name, outlive both.
+cache_mount_point = '/var/lib/jenkins-cache'
+cache_tag_key = 'JenkinsCache'
+
+# Directories under the home directory of the build user kept on the cache volumes.
+cache_home_directories = ['.m2', '.npm', '.cache/pip', '.gradle']
+
+# Actions the instance holding the cache volumes takes on them.
+cache_volume_actions = [
+    'ec2:AttachVolume',
+    'ec2:CreateSnapshots',
+    'ec2:CreateTags',
+    'ec2:CreateVolume',
+    'ec2:DeleteSnapshot',
+    'ec2:DescribeSnapshots',
+    'ec2:DescribeVolumes',
+    'ec2:ModifyInstanceAttribute'
+]
+
+
+def template_file_name():
+    return 'jenkins_linux_simple.json'
+
+
+def add_instance_role(template, title, actions):
+    # Adds an instance profile with a role allowed actions on any resource.
+    resource_role = template.add_resource(iam.Role(
+        '%sRole' % title,
+        AssumeRolePolicyDocument=Policy(
+            Statement=[
+                Statement(
+                    Action=[AssumeRole],
+                    Effect=Allow,
+                    Principal=Principal(
+                        'Service', ['ec2.amazonaws.com']
+                    )
+                )
+            ]
+        ),
+        Path='/',
+        Policies=[
+            iam.Policy(
+                PolicyName=title,
+                PolicyDocument={
+                    'Statement': [
+                        {
+                            'Effect': 'Allow',
+                            'Action': actions,
+                            'Resource': '*'
+                        }
+                    ]
+                }
+            )
+        ]
+    ))
+    return template.add_resource(iam.InstanceProfile(
+        '%sInstanceProfile' % title,
+        Path='/',
+        Roles=[Ref(resource_role)]
+    ))
+
+
+def add_cache_volume_parameters(template):
+    # Returns (volume size parameter, volume type parameter, snapshot interval parameter, snapshot sets parameter).
+    param_volume_size = template.add_parameter(Parameter(
+        'JenkinsCacheVolumeSize',
+        Description='Size in GiB of each new Jenkins cache volume; volumes restored from a snapshot take its size.',
+        Type='Number',
+        Default='50',
+        MinValue='1'
+    ))
+    param_volume_type = template.add_parameter(Parameter(
+        'JenkinsCacheVolumeType',
+        Description='EBS volume type of the Jenkins cache volumes; st1 volumes are at least 125 GiB.',
         Type='String',
-        AllowedValues=[
-            'TestAws',
-            'Dev',
-            'DevOps'
-        ],
-        Default='DevOps'
-    )
-)
-
-#---Mappings-------------------------------------------------------------------
-mapping_region_map = template.add_mapping(
-    'RegionMap',
-    {
-        'ap-northeast-1': {
-            'AMI': 'ami-383c1956',
-            'RegionAvailabilityZone': 'ap-northeast-1c'
-        },
-        'ap-southeast-1': {
-            'AMI': 'ami-c9b572aa',
-            'RegionAvailabilityZone': 'ap-southeast-1b'
-        },
-        'ap-southeast-2': {
-            'AMI': 'ami-48d38c2b',
-            'RegionAvailabilityZone': 'ap-southeast-2b'
-        },
-        'eu-central-1': {
-            'AMI': 'ami-bc5b48d0',
-            'RegionAvailabilityZone': 'eu-central-1b'
-        },
-        'eu-west-1': {
-            'AMI': 'ami-bff32ccc',
-            'RegionAvailabilityZone': 'eu-west-1c'
-        },
-        'sa-east-1': {
-            'AMI': 'ami-6817af04',
-            'RegionAvailabilityZone': 'sa-east-1c'
-        },
-        'us-east-1': {
-            'AMI': 'ami-60b6c60a',
-            'RegionAvailabilityZone': 'us-east-1e'
-        },
-        'us-west-1': {
-            'AMI': 'ami-d5ea86b5',
-            'RegionAvailabilityZone': 'us-west-1c'
-        },
-        'us-west-2': {
-            'AMI': 'ami-f0091d91',
-            'RegionAvailabilityZone': 'us-west-2c'
-        }
-    }
-)
-
-#---Resources------------------------------------------------------------------
-# Allow SSH, http, https, and Jenkins on 8080
-jenkins_linux_security_group = template.add_resource(ec2.SecurityGroup(
-        'JenkinsLinuxSecurityGroup',
-        GroupDescription='Security Group for Jenkins on Linux.',
-        SecurityGroupIngress=
-        [
+        Default='gp3',
+        AllowedValues=['gp3', 'gp2', 'st1']
+    ))
+    param_snapshot_interval = template.add_parameter(Parameter(
+        'JenkinsCacheSnapshotInterval',
+        Description='Hours between snapshots of the Jenkins cache volumes.',
+        Type='Number',
+        Default='6',
+        AllowedValues=['1', '2', '3', '4', '6', '8', '12', '24']
+    ))
+    param_snapshot_sets = template.add_parameter(Parameter(
+        'JenkinsCacheSnapshotSets',
+        Description='The number of most recent snapshot sets of the Jenkins cache volumes kept.',
+        Type='Number',
+        Default='3',
+        MinValue='1'
+    ))
+    return param_volume_size, param_volume_type, param_snapshot_interval, param_snapshot_sets
+
+
+def get_cache_volume_user_data(cache_volume_count, cache_volume_parameters, user, home_directory,
+                               workspace_directory):
+    # UserData lines attaching the cache volumes, mounting the caches of user
+    # and the workspace directory on them, and installing the snapshot job.
+    # A snapshot set is taken of all the volumes of the instance at once, with
+    # the file system frozen, and is tagged with a name of its own; the
+    # volumes are restored from the newest set that completed for each of them.
+    param_volume_size, param_volume_type, param_snapshot_interval, param_snapshot_sets = cache_volume_parameters
+    devices = ' '.join('/dev/sd%s' % chr(ord('f') + index) for index in range(cache_volume_count))
+    if cache_volume_count > 1:
+        file_system_device = '/dev/md0'
+        create_array = [
+            'yum -y install mdadm\n',
+            'if [ -n "$snapshot_ids" ]; then mdadm --assemble %s %s\n' % (file_system_device, devices),
+            'else mdadm --create %s --run --level=0 --raid-devices=%d %s; fi\n'
+            % (file_system_device, cache_volume_count, devices),
+            'mdadm --detail --scan > /etc/mdadm.conf\n'
+        ]
+    else:
+        file_system_device = devices
+        create_array = []
+    cache_directories = [workspace_directory] + [
+        '%s/%s' % (home_directory, directory) for directory in cache_home_directories]
+    region = Ref('AWS::Region')
+    stack_name = Ref('AWS::StackName')
+
+    return [
+        "cat > /usr/local/bin/attach-cache-volumes <<'EOF'\n",
+        '#!/bin/bash -ex\n',
+        'instance_id=$(curl -s http://169.254.169.254/latest/meta-data/instance-id)\n',
+        'zone=$(curl -s http://169.254.169.254/latest/meta-data/placement/availability-zone)\n',
+        # Completed snapshots as (start time, set, device index, ID), newest first.
+        'snapshot_ids=$(aws ec2 describe-snapshots --region ', region, ' --owner-ids self',
+        ' --filters Name=tag:%s,Values=' % cache_tag_key, stack_name, ' Name=status,Values=completed',
+        " --query 'Snapshots[].[StartTime,Tags[?Key==`%sSet`]|[0].Value,Tags[?Key==`%sDevice`]|[0].Value,SnapshotId]'"
+        % (cache_tag_key, cache_tag_key),
+        ' --output text | sort -r | awk -v count=%d' % cache_volume_count,
+        " '{ if (!($2 in members)) sets[++set_count] = $2; members[$2]++; ids[$2, $3] = $4 }",
+        ' END { for (i = 1; i <= set_count; i++) if (members[sets[i]] == count) {',
+        ' for (d = 0; d < count; d++) printf "%s ", ids[sets[i], d]; exit } }\')\n',
+        'snapshots=($snapshot_ids)\n',
+        'index=0\n',
+        'for device in %s; do\n' % devices,
+        '  if [ -n "$snapshot_ids" ]; then source="--snapshot-id ${snapshots[$index]}"; ',
+        'else source="--size ', Ref(param_volume_size), '"; fi\n',
+        '  volume_id=$(aws ec2 create-volume --region ', region, ' --availability-zone $zone $source',
+        ' --volume-type ', Ref(param_volume_type),
+        ' --tag-specifications "ResourceType=volume,Tags=[{Key=%s,Value=' % cache_tag_key, stack_name,
+        '},{Key=%sDevice,Value=$index}]" --query VolumeId --output text)\n' % cache_tag_key,
+        '  aws ec2 wait volume-available --region ', region, ' --volume-ids $volume_id\n',
+        '  aws ec2 attach-volume --region ', region,
+        ' --volume-id $volume_id --instance-id $instance_id --device $device\n',
+        '  aws ec2 wait volume-in-use --region ', region, ' --volume-ids $volume_id\n',
+        '  aws ec2 modify-instance-attribute --region ', region, ' --instance-id $instance_id',
+        ' --block-device-mappings "DeviceName=$device,Ebs={DeleteOnTermination=true}"\n',
+        '  while [ ! -e $device ]; do sleep 1; done\n',
+        '  index=$((index + 1))\n',
+        'done\n'
+    ] + create_array + [
+        '[ -n "$snapshot_ids" ] || mkfs -t ext4 %s\n' % file_system_device,
+        'mkdir -p %s\n' % cache_mount_point,
+        'echo "UUID=$(blkid -s UUID -o value %s) %s ext4 defaults,noatime,nofail 0 2" >> /etc/fstab\n'
+        % (file_system_device, cache_mount_point),
+        'mount %s\n' % cache_mount_point,
+        'EOF\n',
+        'chmod 700 /usr/local/bin/attach-cache-volumes \n',
+        '/usr/local/bin/attach-cache-volumes \n'
+    ] + [
+        # Each directory is bind mounted from the same path under the mount point.
+        'mkdir -p %s%s %s && echo "%s%s %s none bind 0 0" >> /etc/fstab && mount %s \n'
+        % (cache_mount_point, directory, directory, cache_mount_point, directory, directory, directory)
+        for directory in cache_directories
+    ] + [
+        'chown -R %s: %s %s \n' % (user, cache_mount_point, ' '.join(cache_directories)),
+        "cat > /usr/local/bin/snapshot-cache-volumes <<'EOF'\n",
+        '#!/bin/bash -e\n',
+        'instance_id=$(curl -s http://169.254.169.254/latest/meta-data/instance-id)\n',
+        "trap 'fsfreeze -u %s' EXIT\n" % cache_mount_point,
+        'fsfreeze -f %s\n' % cache_mount_point,
+        'aws ec2 create-snapshots --region ', region,
+        ' --instance-specification InstanceId=$instance_id,ExcludeBootVolume=true --copy-tags-from-source volume',
+        ' --tag-specifications "ResourceType=snapshot,Tags=[{Key=%sSet,Value=$instance_id-$(date +%%s)}]"'
+        % cache_tag_key,
+        ' --description "Jenkins cache of ', stack_name, '" > /dev/null\n',
+        'fsfreeze -u %s\n' % cache_mount_point,
+        'trap - EXIT\n',
+        # Delete the snapshots of all but the newest sets.
+        'for snapshot_id in $(aws ec2 describe-snapshots --region ', region, ' --owner-ids self',
+        ' --filters Name=tag:%s,Values=' % cache_tag_key, stack_name,
+        " --query 'Snapshots[].[StartTime,Tags[?Key==`%sSet`]|[0].Value,SnapshotId]'" % cache_tag_key,
+        " --output text | sort -r | awk -v keep=", Ref(param_snapshot_sets),
+        " '{ if (!($2 in seen)) { seen[$2] = 1; set_count++ } if (set_count > keep) print $3 }'); do\n",
+        '  aws ec2 delete-snapshot --region ', region, ' --snapshot-id $snapshot_id\n',
+        'done\n',
+        'EOF\n',
+        'chmod 700 /usr/local/bin/snapshot-cache-volumes \n',
+        "echo '0 */", Ref(param_snapshot_interval),
+        " * * * root /usr/local/bin/snapshot-cache-volumes' > /etc/cron.d/jenkins-cache-snapshots \n"
+    ]
+
+
+def get_build_queue_metric_user_data(param_api_user, param_api_token):
+    # UserData lines installing a cron job on the controller that publishes the build queue length.
+    return [
+        "cat > /usr/local/bin/publish-build-queue-length <<'EOF'\n",
+        '#!/bin/bash\n',
+        "length=$(curl -sf -u '", Ref(param_api_user), ':', Ref(param_api_token), "' ",
+        "'http://localhost:8080/queue/api/json?tree=items[id]' | ",
+        'python -c \'import json, sys; print(len(json.load(sys.stdin)["items"]))\') || exit 0\n',
+        'aws cloudwatch put-metric-data --region ', Ref('AWS::Region'),
+        ' --namespace %s --metric-name %s' % (build_queue_metric_namespace, build_queue_metric_name),
+        ' --dimensions StackName=', Ref('AWS::StackName'), ' --value $length\n',
+        'EOF\n',
+        'chmod 700 /usr/local/bin/publish-build-queue-length \n',
+        "echo '* * * * * root /usr/local/bin/publish-build-queue-length' > /etc/cron.d/jenkins-build-queue \n"
+    ]
+
+
+def get_agent_user_data(controller_url, param_api_user, param_api_token, param_executors, cache_user_data=()):
+    # Agents join the controller with the Swarm plugin client, named by
+    # their instance ID.  While an agent runs a build a cron job protects its
+    # instance from scale in, so the group only removes idle agents.
+    return Base64(Join('', [
+        '#!/bin/bash -ex \n'
+    ] + get_unless_baked_user_data([
+        'yum -y install java \n'
+    ]) + [
+        'instance_id=$(curl -s http://169.254.169.254/latest/meta-data/instance-id) \n',
+        'mkdir -p /var/lib/jenkins-agent \n'
+    ] + list(cache_user_data) + [
+        'curl -sf -o /var/lib/jenkins-agent/swarm-client.jar ', controller_url, '/swarm/swarm-client.jar \n',
+        "cat > /usr/local/bin/protect-busy-agent <<'EOF'\n",
+        '#!/bin/bash\n',
+        'instance_id=$(curl -s http://169.254.169.254/latest/meta-data/instance-id)\n',
+        "idle=$(curl -sf -u '", Ref(param_api_user), ':', Ref(param_api_token), "' ",
+        '"', controller_url, '/computer/$instance_id/api/json?tree=idle" | ',
+        'python -c \'import json, sys; print(json.load(sys.stdin)["idle"])\') || exit 0\n',
+        'group=$(aws autoscaling describe-auto-scaling-instances --region ', Ref('AWS::Region'),
+        ' --instance-ids $instance_id --query "AutoScalingInstances[0].AutoScalingGroupName" --output text)\n',
+        'if [ "$idle" = True ]; then protection=--no-protected-from-scale-in; ',
+        'else protection=--protected-from-scale-in; fi\n',
+        'aws autoscaling set-instance-protection --region ', Ref('AWS::Region'),
+        ' --auto-scaling-group-name $group --instance-ids $instance_id $protection\n',
+        'EOF\n',
+        'chmod 700 /usr/local/bin/protect-busy-agent \n',
+        "echo '* * * * * root /usr/local/bin/protect-busy-agent' > /etc/cron.d/jenkins-agent-protection \n",
+        "JENKINS_API_TOKEN='", Ref(param_api_token), "' nohup java -jar /var/lib/jenkins-agent/swarm-client.jar",
+        ' -url ', controller_url, ' -fsroot /var/lib/jenkins-agent',
+        ' -username ', Ref(param_api_user), ' -passwordEnvVariable JENKINS_API_TOKEN',
+        ' -name $instance_id -disableClientsUniqueId -executors ', Ref(param_executors), ' -labels linux',
+        ' > /var/log/jenkins-agent.log 2>&1 & \n'
+    ]))
+
+
+def add_agent_fleet(template, param_keyname, param_instance_type, param_api_user, param_api_token,
+                    jenkins_linux_security_group, ec2_instance, spot_instance_types=None, cache_volume_count=0,
+                    cache_volume_parameters=None):
+    # Adds the AutoScaling group of build agents, scaled on the build queue length.
+    # Returns the AutoScaling group.
+    param_executors = template.add_parameter(Parameter(
+        'JenkinsAgentExecutors',
+        Description='The number of builds each Jenkins agent runs at once.',
+        Type='Number',
+        Default='2',
+        MinValue='1'
+    ))
+    # The queue length is averaged per minute, so it may be fractional.  The
+    # thresholds leave a band between them in which neither alarm fires.
+    param_high_queue_length = template.add_parameter(Parameter(
+        'HighBuildQueueLength',
+        Description='Average build queue length above which agents are added. '
+                    'Must be above LowBuildQueueLength.',
+        Type='Number',
+        Default='0.5',
+        MinValue='0'
+    ))
+    param_low_queue_length = template.add_parameter(Parameter(
+        'LowBuildQueueLength',
+        Description='Average build queue length below which idle agents are removed. '
+                    'Must be below HighBuildQueueLength, or the agents are added and removed in turn.',
+        Type='Number',
+        Default='0.1',
+        MinValue='0'
+    ))
+    param_min_size, param_max_size, param_desired_capacity = add_capacity_parameters(
+        template, 'JenkinsAgent', 'Jenkins agent', min_size=0, max_size=8, desired_capacity=1)
+
+    agent_security_group = template.add_resource(ec2.SecurityGroup(
+        'JenkinsAgentSecurityGroup',
+        GroupDescription='Security Group for Jenkins agents on Linux.',
+        SecurityGroupIngress=[
             ec2.SecurityGroupRule(
                 IpProtocol='tcp',
                 FromPort=22,
                 ToPort=22,
                 CidrIp='0.0.0.0/0'
-            ),
-            ec2.SecurityGroupRule(
-                IpProtocol='tcp',
-                FromPort=80,
-                ToPort=80,
-                CidrIp='0.0.0.0/0'
-            ),
-            ec2.SecurityGroupRule(
-                IpProtocol='tcp',
-                FromPort=443,
-                ToPort=443,
-                CidrIp='0.0.0.0/0'
-            ),
-            ec2.SecurityGroupRule(
-                IpProtocol='tcp',
-                FromPort=8080,
-                ToPort=8080,
-                CidrIp='0.0.0.0/0'
             )
         ]
-    )
-)
+    ))
+    template.add_resource(ec2.SecurityGroupIngress(
+        'JenkinsLinuxSecurityGroupIngressAgents',
+        GroupName=Ref(jenkins_linux_security_group),
+        IpProtocol='tcp',
+        FromPort=jenkins_agent_port,
+        ToPort=jenkins_agent_port,
+        SourceSecurityGroupName=Ref(agent_security_group)
+    ))
 
-ec2_instance = template.add_resource(ec2.Instance
-    (
-        'EC2Instance',
+    agent_actions = ['autoscaling:DescribeAutoScalingInstances', 'autoscaling:SetInstanceProtection']
+    cache_user_data = []
+    if cache_volume_count:
+        agent_actions += cache_volume_actions
+        cache_user_data = get_cache_volume_user_data(
+            cache_volume_count, cache_volume_parameters, 'root', '/root', '/var/lib/jenkins-agent/workspace')
+    agent_instance_profile = add_instance_role(template, 'JenkinsAgent', agent_actions)
+    controller_url = Join('', ['http://', GetAtt(ec2_instance, 'PrivateIp'), ':8080'])
+    launch_template = add_launch_template(
+        template,
+        'JenkinsAgentLaunchTemplate',
+        IamInstanceProfile=ec2.IamInstanceProfile(Arn=GetAtt(agent_instance_profile, 'Arn')),
         ImageId=FindInMap('RegionMap', Ref('AWS::Region'), 'AMI'),
         InstanceType=Ref(param_instance_type),
         KeyName=Ref(param_keyname),
-        SecurityGroups=[Ref(jenkins_linux_security_group)],
-        UserData=Base64(Join('',
-                [
-                    '#!/bin/bash -ex \n',
-                    'y      um -y install java \n',
-                    'wget -O /etc/yum.repos.d/jenkins.repo http://pkg.jenkins-ci.org/redhat/jenkins.repo \n',
-                    'rpm --import https://jenkins-ci.org/redhat/jenkins-ci.org.key \n',
-                    'yum -y install jenkins \n',
-                    'service jenkins start \n',
-                    'chkconfig jenkins on \n'
-                ]
-            )
+        SecurityGroupIds=[GetAtt(agent_security_group, 'GroupId')],
+        UserData=get_agent_user_data(controller_url, param_api_user, param_api_token, param_executors,
+                                     cache_user_data)
+    )
+
+    autoscaling_group = AutoScalingGroup(
+        'JenkinsAgentAutoScalingGroup',
+        AvailabilityZones=[FindInMap('RegionMap', Ref('AWS::Region'), 'RegionAvailabilityZone')],
+        DesiredCapacity=Ref(param_desired_capacity),
+        MaxSize=Ref(param_max_size),
+        MinSize=Ref(param_min_size),
+        Tags=[Tag('Purpose', 'JenkinsAgent', True)]
+    )
+    if spot_instance_types:
+        param_on_demand_base_capacity, param_on_demand_percentage = add_mixed_instances_parameters(
+            template, 'JenkinsAgent', 'Jenkins agent', on_demand_base_capacity=0)
+        set_mixed_instances_policy(autoscaling_group, launch_template, spot_instance_types,
+                                   param_on_demand_base_capacity, param_on_demand_percentage)
+    else:
+        autoscaling_group.LaunchTemplate = get_launch_template_specification(launch_template)
+    template.add_resource(autoscaling_group)
+
+    add_step_scaling_policies(
+        template, 'JenkinsAgent', autoscaling_group,
+        dict(
+            Namespace=build_queue_metric_namespace,
+            MetricName=build_queue_metric_name,
+            Dimensions=[cloudwatch.MetricDimension(Name='StackName', Value=Ref('AWS::StackName'))],
+            Statistic='Average'
+        ),
+        Ref(param_high_queue_length), Ref(param_low_queue_length),
+        # Add more agents the longer the queue.
+        [(0, 1), (4, 2), (10, 4)]
+    )
+
+    template.add_output(Output(
+        'JenkinsAgentAutoScalingGroup',
+        Description='AutoScaling group of the Jenkins agents.',
+        Value=Ref(autoscaling_group)
+    ))
+    return autoscaling_group
+
+
+def add_jenkins_alarms(template, ec2_instance, agent_autoscaling_group=None):
+    # Adds alarms on the CPU and status checks of the controller and of the
+    # agents, if any, and the dashboard graphing them.  Busy agents scale out;
+    # a build queue that stays long means the fleet is at its maximum size.
+    param_alarm_topic = add_alarm_topic_parameter(template)
+    param_cpu_threshold = add_threshold_parameter(
+        template, 'Cpu', 'The CPU utilization (percent) of the Jenkins controller or agents that raises an alarm.',
+        '80')
+    alarms = add_instance_alarms(template, 'JenkinsController', 'Jenkins controller', 'InstanceId',
+                                 Ref(ec2_instance), param_cpu_threshold, param_alarm_topic)
+    if agent_autoscaling_group is not None:
+        alarms += add_instance_alarms(template, 'JenkinsAgent', 'Jenkins agents', 'AutoScalingGroupName',
+                                      Ref(agent_autoscaling_group), param_cpu_threshold, param_alarm_topic)
+        param_queue_threshold = add_threshold_parameter(
+            template, 'BuildQueue', 'The build queue length that raises an alarm when it lasts 15 minutes.', '10')
+        alarms.append(add_alarm(
+            template, 'JenkinsBuildQueueAlarm', 'Jenkins build queue length',
+            dict(Namespace=build_queue_metric_namespace, MetricName=build_queue_metric_name,
+                 Dimensions=[cloudwatch.MetricDimension(Name='StackName', Value=Ref('AWS::StackName'))],
+                 Statistic='Maximum'),
+            Ref(param_queue_threshold), param_alarm_topic, evaluation_periods=15))
+    add_dashboard(template, alarms)
+
+
+def generate_stack_template(agent_fleet=False, spot_instance_types=None, cache_volume_count=0, monitoring=False):
+    template = Template()
+
+    #---Parameters--------------------------------------------------------------
+    param_keyname = template.add_parameter(
+        Parameter(
+            'KeyName',
+            Description='Name of an existing EC2 KeyPair file (.pem) to use to create EC2 instances',
+            Type='AWS::EC2::KeyPair::KeyName'
         )
     )
-)
 
-#---Outputs--------------------------------------------------------------------
-template.add_output(Output(
-        'JenkinsURL',
-        Description='URL of the Jenkins instance.',
-        Value=Join('',
+    param_instance_type = add_instance_type_parameter(template, 't2.micro', nitro_ami)
+
+    param_environment = template.add_parameter(
+        Parameter(
+            'Environment',
+            Description='The environment name with which to associate this.',
+            Type='String',
+            AllowedValues=[
+                'TestAws',
+                'Dev',
+                'DevOps'
+            ],
+            Default='DevOps'
+        )
+    )
+
+    if agent_fleet:
+        param_api_user = template.add_parameter(
+            Parameter(
+                'JenkinsApiUser',
+                Description='Jenkins user the agents and the build queue metric authenticate as.',
+                Type='String',
+                Default='agent'
+            )
+        )
+
+        param_api_token = template.add_parameter(
+            Parameter(
+                'JenkinsApiToken',
+                Description='API token of the Jenkins user.',
+                Type='String',
+                NoEcho=True
+            )
+        )
+
+    cache_volume_parameters = None
+    if cache_volume_count:
+        cache_volume_parameters = add_cache_volume_parameters(template)
+
+    #---Mappings----------------------------------------------------------------
+    mapping_region_map = template.add_mapping('RegionMap', region_map)
+
+    #---Resources---------------------------------------------------------------
+    # Allow SSH, http, https, and Jenkins on 8080
+    jenkins_linux_security_group = template.add_resource(ec2.SecurityGroup(
+            'JenkinsLinuxSecurityGroup',
+            GroupDescription='Security Group for Jenkins on Linux.',
+            SecurityGroupIngress=
             [
-                'http://',
-                GetAtt(ec2_instance, 'PublicIp'),
-                ':8080'
+                ec2.SecurityGroupRule(
+                    IpProtocol='tcp',
+                    FromPort=22,
+                    ToPort=22,
+                    CidrIp='0.0.0.0/0'
+                ),
+                ec2.SecurityGroupRule(
+                    IpProtocol='tcp',
+                    FromPort=80,
+                    ToPort=80,
+                    CidrIp='0.0.0.0/0'
+                ),
+                ec2.SecurityGroupRule(
+                    IpProtocol='tcp',
+                    FromPort=443,
+                    ToPort=443,
+                    CidrIp='0.0.0.0/0'
+                ),
+                ec2.SecurityGroupRule(
+                    IpProtocol='tcp',
+                    FromPort=8080,
+                    ToPort=8080,
+                    CidrIp='0.0.0.0/0'
+                )
             ]
         )
     )
-)
 
-template.add_output(Output(
-        'Region',
-        Description='AWS Region used for instantiation',
-        Value=Ref('AWS::Region')
+    user_data = ['#!/bin/bash -ex \n'] + get_unless_baked_user_data([
+        'yum -y install java \n',
+        'wget -O /etc/yum.repos.d/jenkins.repo http://pkg.jenkins-ci.org/redhat/jenkins.repo \n',
+        'rpm --import https://jenkins-ci.org/redhat/jenkins-ci.org.key \n',
+        'yum -y install jenkins \n'
+    ])
+    if cache_volume_count and not agent_fleet:
+        # Without agents the controller runs the builds, as the jenkins user.
+        user_data += get_cache_volume_user_data(
+            cache_volume_count, cache_volume_parameters, 'jenkins', '/var/lib/jenkins', '/var/lib/jenkins/workspace')
+    user_data += [
+        'service jenkins start \n',
+        'chkconfig jenkins on \n'
+    ]
+    if agent_fleet:
+        # The controller runs no builds itself (set its executors to 0), and
+        # needs the Swarm plugin for the agents to join.
+        user_data += get_build_queue_metric_user_data(param_api_user, param_api_token)
+
+    ec2_instance = template.add_resource(ec2.Instance
+        (
+            'EC2Instance',
+            ImageId=FindInMap('RegionMap', Ref('AWS::Region'), 'AMI'),
+            InstanceType=Ref(param_instance_type),
+            KeyName=Ref(param_keyname),
+            SecurityGroups=[Ref(jenkins_linux_security_group)],
+            UserData=Base64(Join('', user_data))
+        )
+    )
+    agent_autoscaling_group = None
+    if agent_fleet:
+        ec2_instance.IamInstanceProfile = Ref(
+            add_instance_role(template, 'JenkinsController', ['cloudwatch:PutMetricData']))
+        agent_autoscaling_group = add_agent_fleet(
+            template, param_keyname, param_instance_type, param_api_user, param_api_token,
+            jenkins_linux_security_group, ec2_instance, spot_instance_types, cache_volume_count,
+            cache_volume_parameters)
+    elif cache_volume_count:
+        ec2_instance.IamInstanceProfile = Ref(add_instance_role(template, 'JenkinsController', cache_volume_actions))
+
+    if monitoring:
+        add_jenkins_alarms(template, ec2_instance, agent_autoscaling_group)
+
+    #---Outputs-----------------------------------------------------------------
+    template.add_output(Output(
+            'JenkinsURL',
+            Description='URL of the Jenkins instance.',
+            Value=Join('',
+                [
+                    'http://',
+                    GetAtt(ec2_instance, 'PublicIp'),
+                    ':8080'
+                ]
+            )
+        )
+    )
+
+    template.add_output(Output(
+            'Region',
+            Description='AWS Region used for instantiation',
+            Value=Ref('AWS::Region')
 
+        )
     )
-)
 
-template.add_output(Output(
-        'AvailabilityZone',
-        Description='Availability zone used with AWS region',
-        Value=FindInMap('RegionMap', Ref('AWS::Region'), 'RegionAvailabilityZone')
+    template.add_output(Output(
+            'AvailabilityZone',
+            Description='Availability zone used with AWS region',
+            Value=FindInMap('RegionMap', Ref('AWS::Region'), 'RegionAvailabilityZone')
+        )
     )
-)
 
-template.add_output(Output(
-        'Environment',
-        Description='Value of the Environment parameter',
-        Value=Ref(param_environment)
+    template.add_output(Output(
+            'Environment',
+            Description='Value of the Environment parameter',
+            Value=Ref(param_environment)
+        )
     )
-)
+
+    return template
+
 
 #---Generate CloudFormation template-------------------------------------------
-# Generate JSON.
-json = template.to_json()
+def main():
+    option_parser = OptionParser()
+
+    option_parser.add_option(
+        '-m', '--Minify',
+        dest='minify',
+        action='store_true',
+        help='Write compact JSON without indentation.',
+        default=False
+    )
+
+    option_parser.add_option(
+        '--Agents',
+        dest='agent_fleet',
+        action='store_true',
+        help='Run builds on an AutoScaling group of agents scaled on the build queue length.',
+        default=False
+    )
+
+    option_parser.add_option(
+        '--Spot',
+        dest='spot_instance_types',
+        help='With --Agents, comma separated instance types to launch on-demand and spot agents of, '
+             'e.g. t2.large,m3.large,c4.large.',
+        default=None
+    )
+
+    option_parser.add_option(
+        '--CacheVolumes',
+        dest='cache_volume_count',
+        type='int',
+        help='Keep build caches and workspaces on this many EBS volumes (RAID0 if more than one), restored '
+             'from the most recent snapshot set and snapshotted on a schedule; on the agents with --Agents. '
+             '(Default: 0, none)',
+        default=0
+    )
+
+    option_parser.add_option(
+        '--Monitoring',
+        dest='monitoring',
+        action='store_true',
+        help='Add a CloudWatch dashboard and alarms on the CPU and status checks of the controller and agents, '
+             'and on the build queue length with --Agents.',
+        default=False
+    )
+
+    (options, args) = option_parser.parse_args()
+    if not 0 <= options.cache_volume_count <= 8:
+        option_parser.error('--CacheVolumes takes 0 to 8 volumes.')
+    spot_instance_types = None
+    if options.spot_instance_types:
+        try:
+            spot_instance_types = parse_instance_types(options.spot_instance_types, nitro_ami)
+        except ValueError as error:
+            option_parser.error(str(error))
+
+    template_path = './%s' % template_file_name()
+    generator_options = dict(agent_fleet=options.agent_fleet, spot_instance_types=spot_instance_types,
+                             cache_volume_count=options.cache_volume_count, monitoring=options.monitoring)
 
-# Write JSON to console.
-print json
+    # Regenerate only when the inputs changed; rewrite only when the content changed.
+    if write_cached_template(__file__, generate_stack_template, generator_options,
+                             template_path, minify=options.minify):
+        print 'Generated CloudFormation template is available in %s' % template_path
+    else:
+        print 'Cached CloudFormation template is available in %s' % template_path
+    evict_cache_entries()
 
-# Write JSON to a file.
-file = open(out_path, mode='w')
-file.writelines(json)
-file.close()
 
-print 'Generated CloudFormation template is available in %s' % out_path
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -10,10 +10,24 @@
 # This script uses the boto3 library to get build versions from S3.
 # pip install boto3
 # Optional but quite helpful:  Install PyCharm Community Edition (Cost=0)
-from troposphere import Base64, FindInMap, Join, Tags
+from optparse import OptionParser
+import os
+import sys
+# Make the shared cfgen package (aws/cloudformation/cfgen) importable.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+# Make the sibling modules importable when loaded by the batch build.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from cfgen.cache import evict_cache_entries, write_cached_template
+from cfgen.instances import add_instance_type_parameter, add_placement_group, get_ebs_optimized_map
+from cfgen.monitoring import add_alarm, add_alarm_topic_parameter, add_dashboard, add_instance_alarms
+from cfgen.monitoring import add_threshold_parameter
+from cfgen.packer import get_unless_baked_user_data
+from postgres_tuning import fixed_settings, get_replication_settings, get_tuning_map, tuned_settings
+from troposphere import Base64, Equals, FindInMap, GetAtt, If, Join, Not, Select, Tags
 from troposphere import Output
 from troposphere import Parameter, Ref, Template
 import troposphere.cloudformation as cloudformation
+import troposphere.cloudwatch as cloudwatch
 import troposphere.ec2 as ec2
 from awacs.aws import (Allow,
                        Statement,
@@ -22,13 +36,528 @@ from awacs.aws import (Allow,
 from awacs.sts import AssumeRole
 import troposphere.iam as iam
 
+# Database server AMI as f(region).
+environment_attribute_map = {
+    'ap-southeast-1': {
+        'DatabaseServerAmi': 'ami-1ddc0b7e'
+    },
+    'ap-southeast-2': {
+        'DatabaseServerAmi': 'ami-0c95b86f'
+    },
+    'us-east-1': {
+        'DatabaseServerAmi': 'ami-a4827dc9'
+    },
+    'us-west-1': {
+        'DatabaseServerAmi': 'ami-f5f41398'
+    }
+}
+
+# The AMIs above predate the ENA and NVMe drivers, so the Nitro instance
+# types of cfgen/instances.py are not offered.
+nitro_ami = False
+
+
 def generate_description(template):
     template.add_description('Creates a single instance of a PostgreSql server')
 
 def generate_version(template):
     template.add_version(version='2010-09-09')
 
-def generate_stack_template():
+def template_file_name():
+    return 'PostgresqlSingleInstanceStack.json'
+
+def get_database_packages():
+    # PostgreSQL 9.5 from the PGDG repository.
+    return {
+        'rpm': {
+            'postgresql': 'https://download.postgresql.org/pub/repos/yum/9.5/redhat/rhel-6-x86_64/pgdg-ami201503-95-9.5-2.noarch.rpm'
+        },
+        'yum': {
+            'postgresql95': [],
+            'postgresql95-libs': [],
+            'postgresql95-server': [],
+            'postgresql95-devel': [],
+            'postgresql95-contrib': [],
+            'postgresql95-docs': []
+        }
+    }
+
+
+# The service the PostgreSQL packages install, and the data directory it
+# serves, set in its sysconfig file in place of the PGDG default.
+postgresql_service = 'postgresql-9.5'
+path_data_directory = '/var/lib/pgsql9/data'
+
+
+def get_postgresql_sysconfig_files():
+    return {
+        '/etc/sysconfig/pgsql/%s' % postgresql_service: cloudformation.InitFile(
+            content='PGDATA=%s\n' % path_data_directory,
+            mode='000644',
+            owner='root',
+            group='root'
+        )
+    }
+
+
+def get_cfn_hup_files(resource_name):
+    # cfn-hup configuration that reruns cfn-init for the resource on stack updates.
+    return {
+        # cfn-hup.conf initialization
+        '/etc/cfn/cfn-hup.conf': cloudformation.InitFile(
+            content=Join('',
+            [
+                '[main]\n',
+                'stack=', Ref('AWS::StackId'), '\n',
+                'region=', Ref('AWS::Region'), '\n',
+                'interval=2', '\n',
+                'verbose=true', '\n'
+
+            ]),
+            mode='000400',
+            owner='root',
+            group='root'
+        ),
+        # cfn-auto-reloader.conf initialization
+        '/etc/cfn/cfn-auto-reloader.conf': cloudformation.InitFile(
+            content=Join('', [
+                '[cfn-auto-reloader-hook]\n',
+                'triggers=post.update\n',
+                'path=Resources.%s.Metadata.AWS::CloudFormation::Init\n' % resource_name,
+                'action=cfn-init.exe ',
+                ' --verbose '
+                ' --stack ', Ref('AWS::StackName'),
+                ' --resource %s ' % resource_name,  # resource that defines the Metadata
+                ' --region ', Ref('AWS::Region'), '\n'
+            ]),
+            mode='000400',
+            owner='root',
+            group='root'
+        )
+    }
+
+
+def get_database_services():
+    return {
+        # start cfn-hup service -
+        # required for CloudFormation stack update
+        'cfn-hup': cloudformation.InitService(
+            enabled=True,
+            ensureRunning=True,
+            files=[
+                '/etc/cfn/cfn-hup.conf',
+                '/etc/cfn/hooks.d/cfn-auto-reloader.conf'
+            ]
+        ),
+        # start postgresql service
+        postgresql_service: cloudformation.InitService(
+            enabled=True,
+            ensureRunning=True
+        ),
+        # Disable sendmail service - not required.
+        'sendmail': cloudformation.InitService(
+            enabled=False,
+            ensureRunning=False
+        )
+    }
+
+
+def get_cfn_init_user_data(resource_name, resource_wait_handle=None):
+    # Runs cfn-init for the resource at first boot and signals the result,
+    # to the wait condition handle if one is given.
+    if resource_wait_handle is None:
+        signal_target = [' --stack ', Ref('AWS::StackName'), ' --resource ', resource_name]
+    else:
+        signal_target = [" '", Ref(resource_wait_handle), "'"]
+    return Base64(
+        Join(
+            '',
+            ['#!/bin/bash -xe\n'] + get_unless_baked_user_data([
+                'yum update -y aws-cfn-bootstrap\n'
+            ]) + [
+                '/opt/aws/bin/cfn-init --verbose ',
+                ' --stack ', Ref('AWS::StackName'),
+                ' --resource %s ' % resource_name,
+                ' --region ', Ref('AWS::Region'), '\n',
+
+                '/opt/aws/bin/cfn-signal --exit-code $? '
+            ] + signal_target + ['\n']
+        )
+    )
+
+
+# PgBouncer pools client connections in front of the database server, so that
+# many short-lived application connections share a few server backends.
+pgbouncer_port = 6432
+
+
+def add_pgbouncer(template, param_vpc_cidr_block, resource_database_security_group,
+                  param_database_admin_password, database_packages, database_files, database_services):
+    # Adds the PgBouncer parameters and ingress rule to the template and its
+    # package, configuration files and service to the database server metadata.
+    param_pool_mode = Parameter(
+        'PgBouncerPoolMode',
+        Description='When a server connection is returned to the pool: after the session, transaction or statement.',
+        Type='String',
+        Default='transaction',
+        AllowedValues=['session', 'transaction', 'statement']
+    )
+    template.add_parameter(param_pool_mode)
+
+    param_default_pool_size = Parameter(
+        'PgBouncerDefaultPoolSize',
+        Description='Server connections per database and user pair. '
+                    'Keep the sum of the pools below the server max_connections.',
+        Type='Number',
+        Default='20',
+        MinValue='1'
+    )
+    template.add_parameter(param_default_pool_size)
+
+    param_reserve_pool_size = Parameter(
+        'PgBouncerReservePoolSize',
+        Description='Additional server connections a pool may open when clients wait too long.',
+        Type='Number',
+        Default='5',
+        MinValue='0'
+    )
+    template.add_parameter(param_reserve_pool_size)
+
+    param_max_client_connections = Parameter(
+        'PgBouncerMaxClientConnections',
+        Description='Client connections PgBouncer accepts in total.',
+        Type='Number',
+        Default='1000',
+        MinValue='1'
+    )
+    template.add_parameter(param_max_client_connections)
+
+    # Add ingress rule from VPC to database security group for pooled database traffic.
+    template.add_resource(ec2.SecurityGroupIngress(
+        'DatabaseSecurityGroupPgBouncerIngress',
+        CidrIp=Ref(param_vpc_cidr_block),
+        FromPort=str(pgbouncer_port),
+        GroupId=Ref(resource_database_security_group),
+        IpProtocol='tcp',
+        ToPort=str(pgbouncer_port)
+    ))
+
+    database_packages['yum']['pgbouncer'] = []
+
+    database_files['/etc/pgbouncer/pgbouncer.ini'] = cloudformation.InitFile(
+        content=Join('', [
+            '[databases]\n',
+            '* = host=127.0.0.1 port=5432\n',
+            '\n',
+            '[pgbouncer]\n',
+            'listen_addr = *\n',
+            'listen_port = %d\n' % pgbouncer_port,
+            'auth_type = md5\n',
+            'auth_file = /etc/pgbouncer/userlist.txt\n',
+            # Clients other than those in the auth file, i.e. the application
+            # users, are looked up in the server as the auth user.
+            'auth_user = postgres\n',
+            'auth_query = SELECT usename, passwd FROM pg_shadow WHERE usename = $1\n',
+            'admin_users = postgres\n',
+            'pool_mode = ', Ref(param_pool_mode), '\n',
+            'default_pool_size = ', Ref(param_default_pool_size), '\n',
+            'reserve_pool_size = ', Ref(param_reserve_pool_size), '\n',
+            'max_client_conn = ', Ref(param_max_client_connections), '\n',
+            # Clear session state before a server connection is reused.
+            'server_reset_query = DISCARD ALL\n',
+            'logfile = /var/log/pgbouncer/pgbouncer.log\n',
+            'pidfile = /var/run/pgbouncer/pgbouncer.pid\n'
+        ]),
+        mode='000640',
+        owner='pgbouncer',
+        group='pgbouncer'
+    )
+
+    # The auth file holds only the auth user, which may read pg_shadow.
+    database_files['/etc/pgbouncer/userlist.txt'] = cloudformation.InitFile(
+        content=Join('', [
+            '"postgres" "', Ref(param_database_admin_password), '"\n'
+        ]),
+        mode='000600',
+        owner='pgbouncer',
+        group='pgbouncer'
+    )
+
+    # start pgbouncer service, restarting it when its configuration changes.
+    database_services['pgbouncer'] = cloudformation.InitService(
+        enabled=True,
+        ensureRunning=True,
+        files=[
+            '/etc/pgbouncer/pgbouncer.ini',
+            '/etc/pgbouncer/userlist.txt'
+        ]
+    )
+
+
+# Dedicated EBS volumes keep the database files and the WAL off the root volume,
+# so their I/O is provisioned independently of the instance.
+# (name, description, device, mount point, default size GiB, default IOPS)
+database_volumes = [
+    ('Data', 'data', '/dev/sdf', '/var/lib/pgsql9/data', '100', '1000'),
+    ('Wal', 'WAL', '/dev/sdg', '/var/lib/pgsql9/wal', '20', '1000')
+]
+path_wal_directory = '/var/lib/pgsql9/wal/pg_xlog'
+
+
+def add_volume_parameters(template):
+    # Adds the type, size and IOPS parameters of the database volumes.
+    # Returns {volume name: (type parameter, size parameter, IOPS parameter, provisioned IOPS condition)}.
+    volume_parameters = {}
+    for name, description, device, mount_point, default_size, default_iops in database_volumes:
+        param_volume_type = template.add_parameter(Parameter(
+            '%sVolumeType' % name,
+            Description='The EBS volume type of the database %s volume.' % description,
+            Type='String',
+            Default='io1',
+            AllowedValues=['gp2', 'io1', 'io2']
+        ))
+        param_volume_size = template.add_parameter(Parameter(
+            '%sVolumeSize' % name,
+            Description='The size (GiB) of the database %s volume.' % description,
+            Type='Number',
+            Default=default_size,
+            MinValue='4'
+        ))
+        param_volume_iops = template.add_parameter(Parameter(
+            '%sVolumeIops' % name,
+            Description='The provisioned IOPS of the database %s volume (io1 and io2 only). '
+                        'At most 50 per GiB for io1.' % description,
+            Type='Number',
+            Default=default_iops,
+            MinValue='100',
+            MaxValue='64000'
+        ))
+        name_condition = '%sVolumeProvisionedIops' % name
+        template.add_condition(name_condition, Not(Equals(Ref(param_volume_type), 'gp2')))
+        volume_parameters[name] = (param_volume_type, param_volume_size, param_volume_iops, name_condition)
+    return volume_parameters
+
+
+def add_database_volumes(template, resource_instance, volume_parameters):
+    # Adds the database volumes of an instance and their attachments.
+    # Returns the volumes.
+    resource_volumes = []
+    for name, description, device, mount_point, default_size, default_iops in database_volumes:
+        param_volume_type, param_volume_size, param_volume_iops, name_condition = volume_parameters[name]
+        resource_volume = template.add_resource(ec2.Volume(
+            '%s%sVolume' % (resource_instance.title, name),
+            # Keep a snapshot of the database when the stack is deleted.
+            DeletionPolicy='Snapshot',
+            AvailabilityZone=GetAtt(resource_instance, 'AvailabilityZone'),
+            Iops=If(name_condition, Ref(param_volume_iops), Ref('AWS::NoValue')),
+            Size=Ref(param_volume_size),
+            Tags=Tags(Name='%s %s' % (resource_instance.title, description)),
+            VolumeType=Ref(param_volume_type)
+        ))
+        template.add_resource(ec2.VolumeAttachment(
+            '%s%sVolumeAttachment' % (resource_instance.title, name),
+            Device=device,
+            InstanceId=Ref(resource_instance),
+            VolumeId=Ref(resource_volume)
+        ))
+        resource_volumes.append(resource_volume)
+    return resource_volumes
+
+
+def add_database_alarms(template, resource_instance, resource_volumes):
+    # Adds alarms on the CPU, the status checks and the disk queues of the
+    # database server, and the dashboard graphing them.  The CPU credit balance
+    # is reported for burstable (t2, t3) instance types only; without data it
+    # stays OK.
+    param_alarm_topic = add_alarm_topic_parameter(template)
+    param_cpu_threshold = add_threshold_parameter(
+        template, 'Cpu', 'The CPU utilization (percent) of the database server that raises an alarm.', '80')
+    param_cpu_credit_threshold = add_threshold_parameter(
+        template, 'CpuCreditBalance', 'The CPU credit balance of the database server below which an alarm is raised.',
+        '20')
+    instance_dimensions = [cloudwatch.MetricDimension(Name='InstanceId', Value=Ref(resource_instance))]
+    alarms = add_instance_alarms(template, resource_instance.title, 'Database server', 'InstanceId',
+                                 Ref(resource_instance), param_cpu_threshold, param_alarm_topic)
+    alarms.append(
+        add_alarm(template, '%sCpuCreditBalanceAlarm' % resource_instance.title, 'Database server CPU credit balance',
+                  dict(Namespace='AWS/EC2', MetricName='CPUCreditBalance', Dimensions=instance_dimensions,
+                       Statistic='Minimum'),
+                  Ref(param_cpu_credit_threshold), param_alarm_topic, comparison_operator='LessThanThreshold',
+                  period=300, evaluation_periods=1)
+    )
+    if resource_volumes:
+        # A long queue of outstanding I/Os means the queries wait for the disk.
+        param_disk_queue_threshold = add_threshold_parameter(
+            template, 'DiskQueue', 'The queue length of a database volume that raises an alarm.', '10')
+        for resource_volume in resource_volumes:
+            # gp2 volumes report every five minutes.
+            alarms.append(add_alarm(
+                template, '%sQueueAlarm' % resource_volume.title, '%s queue length' % resource_volume.title,
+                dict(Namespace='AWS/EBS', MetricName='VolumeQueueLength',
+                     Dimensions=[cloudwatch.MetricDimension(Name='VolumeId', Value=Ref(resource_volume))],
+                     Statistic='Average'),
+                Ref(param_disk_queue_threshold), param_alarm_topic, period=300, evaluation_periods=3))
+    add_dashboard(template, alarms)
+
+
+def get_volume_init_config():
+    # cfn-init configuration that formats and mounts the database volumes.
+    # It runs before the database configuration, which writes into the data volume.
+    volume_commands = {}
+    for index, (name, description, device, mount_point, default_size, default_iops) in enumerate(database_volumes):
+        volume_commands['%d-mount-%s-volume' % ((index + 1) * 10, name.lower())] = dict(
+            command=' && '.join([
+                # The volumes are attached after the instance starts.
+                'for attempt in $(seq 60); do [ -b %s ] && break; sleep 5; done' % device,
+                '(blkid %s || mkfs -t xfs %s)' % (device, device),
+                'mkdir -p %s' % mount_point,
+                '(grep -q "^%s " /etc/fstab || echo "%s %s xfs defaults,noatime,nofail 0 2" >> /etc/fstab)' % (
+                    device, device, mount_point),
+                'mount %s' % mount_point,
+                'chown postgres:postgres %s' % mount_point,
+                'chmod 700 %s' % mount_point
+            ]),
+            test='! mountpoint -q %s' % mount_point
+        )
+
+    # The database packages create the postgres user that owns the volumes.
+    volume_packages = get_database_packages()
+    volume_packages['yum']['xfsprogs'] = []
+    return cloudformation.InitConfig(
+        packages=volume_packages,
+        commands=volume_commands
+    )
+
+
+def get_database_init(database_config, volume_parameters):
+    # The cfn-init metadata of a database instance, mounting its volumes first if it has them.
+    if volume_parameters is None:
+        return cloudformation.Init({'config': database_config})
+    return cloudformation.Init(
+        cloudformation.InitConfigSets(default=['storage', 'config']),
+        storage=get_volume_init_config(),
+        config=database_config
+    )
+
+
+# Streaming replication: each replica is a hot standby cloned from the primary
+# with pg_basebackup, serving read-only queries.
+replication_user = 'replicator'
+path_replica_recovery_conf = '/var/lib/pgsql9/recovery.conf'
+
+
+def add_database_replicas(template, replica_count, resource_database_server, param_instance_type, param_keyname,
+                          param_vpc_id, param_replication_password, resource_database_security_group,
+                          resource_instance_profile, volume_parameters=None, resource_placement_group=None):
+    # Adds replica_count replica instances of the database server and the ReaderEndpoints output.
+    # The replicas get dedicated database volumes when volume_parameters is given, and join the
+    # placement group of the primary when resource_placement_group is given.
+    param_replica_subnet_ids = Parameter(
+        'ReplicaSubnetIdentifiers',
+        Description='The private subnets (subnet-abcdwxyz) of the read replicas, one per replica, '
+                    'e.g. one per availability zone. Replica n is created in the nth subnet.',
+        Type='List<AWS::EC2::Subnet::Id>'
+    )
+    template.add_parameter(param_replica_subnet_ids)
+
+    primary_address = GetAtt(resource_database_server, 'PrivateIp')
+    replica_endpoints = []
+    for index in range(replica_count):
+        name_replica = 'DatabaseReplica%d' % (index + 1)
+
+        replica_files = get_cfn_hup_files(name_replica)
+        replica_files.update(get_postgresql_sysconfig_files())
+        # recovery.conf is staged outside the data directory, which
+        # pg_basebackup requires to be empty.
+        replica_files[path_replica_recovery_conf] = cloudformation.InitFile(
+            content=Join('', [
+                "standby_mode = 'on'\n",
+                "primary_conninfo = 'host=", primary_address, ' port=5432 user=%s password=' % replication_user,
+                Ref(param_replication_password), "'\n",
+                # Touch this file to promote the replica to a primary.
+                "trigger_file = '/var/lib/pgsql9/data/promote'\n"
+            ]),
+            mode='000600',
+            owner='postgres',
+            group='postgres'
+        )
+
+        replica_commands = {
+            # cfn-init creates the parent of the staged recovery.conf as root;
+            # pg_basebackup runs as postgres.
+            '05-create-data-directory': dict(
+                command='install -d -o postgres -g postgres -m 700 %s %s' % (
+                    os.path.dirname(path_data_directory), path_data_directory),
+                test='test ! -f %s/PG_VERSION' % path_data_directory
+            ),
+            # Clone the primary, including postgresql.conf and pg_hba.conf,
+            # unless an earlier run already did.
+            '10-pg_basebackup': dict(
+                command=Join('', [
+                    'sudo -u postgres PGPASSWORD=', Ref(param_replication_password),
+                    ' /usr/pgsql-9.5/bin/pg_basebackup',
+                    ' --host ', primary_address,
+                    ' --username %s' % replication_user,
+                    ' --pgdata /var/lib/pgsql9/data',
+                    ' --xlog-method=stream',
+                    ' --xlogdir %s' % path_wal_directory if volume_parameters is not None else ''
+                ]),
+                test='test ! -f /var/lib/pgsql9/data/PG_VERSION'
+            ),
+            '20-configure-standby': dict(
+                command='install -o postgres -g postgres -m 600 %s /var/lib/pgsql9/data/recovery.conf'
+                        % path_replica_recovery_conf,
+                test='test ! -f /var/lib/pgsql9/data/recovery.done'
+            ),
+            '30-start-postgresql-on-startup': dict(
+                command='chkconfig %s on' % postgresql_service
+            )
+        }
+
+        resource_replica = ec2.Instance(
+            name_replica,
+            # The primary signals once cfn-init has created the replication user.
+            DependsOn='DatabaseServerWaitCondition',
+            IamInstanceProfile=Ref(resource_instance_profile),
+            Metadata=cloudformation.Metadata(
+                get_database_init(
+                    cloudformation.InitConfig(
+                        packages=get_database_packages(),
+                        files=cloudformation.InitFiles(replica_files),
+                        commands=replica_commands,
+                        services=dict(
+                            sysvinit=cloudformation.InitServices(get_database_services())
+                        )
+                    ),
+                    volume_parameters
+                )
+            ),
+            ImageId=FindInMap('EnvironmentAttributeMap', Ref('AWS::Region'), 'DatabaseServerAmi'),
+            InstanceType=Ref(param_instance_type),
+            KeyName=Ref(param_keyname),
+            SecurityGroupIds=[Ref(resource_database_security_group)],
+            SubnetId=Select(str(index), Ref(param_replica_subnet_ids)),
+            Tags=Tags(Name=name_replica, VPC=Ref(param_vpc_id)),
+            UserData=get_cfn_init_user_data(name_replica)
+        )
+        if resource_placement_group is not None:
+            resource_replica.PlacementGroupName = Ref(resource_placement_group)
+        if volume_parameters is not None:
+            resource_replica.EbsOptimized = FindInMap('InstanceTypeEbsMap', Ref(param_instance_type), 'EbsOptimized')
+            add_database_volumes(template, resource_replica, volume_parameters)
+        template.add_resource(resource_replica)
+        replica_endpoints.append(Join(':', [GetAtt(resource_replica, 'PrivateIp'), '5432']))
+
+    template.add_output(
+        Output('ReaderEndpoints',
+               Description='Comma separated address:port of the read replicas',
+               Value=Join(',', replica_endpoints)
+        )
+    )
+
+
+def generate_stack_template(pgbouncer=False, replica_count=0, ebs_volumes=False, placement_group=False,
+                            monitoring=False):
     template = Template()
 
     generate_description(template)
@@ -65,23 +594,7 @@ def generate_stack_template():
     )
     template.add_parameter(param_keyname)
 
-    param_instance_type = Parameter(
-        'EC2InstanceType',
-        Description='EC2 instance type, reference this parameter to insure consistency',
-        Type='String',
-        Default='t2.medium',  # Prices from (2015-12-03) (Windows, us-west (North CA))
-        AllowedValues=[  # Source :  https://aws.amazon.com/ec2/pricing/
-            't2.small',  # $0.044/hour
-            't2.micro',  # $0.022/hour
-            't2.medium',  # $0.088/hour
-            't2.large',  # $0.166/hour
-            'm3.medium',  # $0.140/hour
-            'm3.large',  # $0.28/hour
-            'c4.large'   # $0.221/hour
-        ],
-        ConstraintDescription='Must be a valid EC2 instance type'
-    )
-    template.add_parameter(param_instance_type)
+    param_instance_type = add_instance_type_parameter(template, 't2.medium', nitro_ami)
 
     param_s3_bucket = Parameter(
         'S3Bucket',
@@ -107,24 +620,28 @@ def generate_stack_template():
     )
     template.add_parameter(param_database_admin_password)
 
+    if replica_count:
+        param_replication_password = Parameter(
+            'ReplicationPassword',
+            Description='The password of the user the read replicas replicate as.',
+            Type='String',
+            NoEcho=True
+        )
+        template.add_parameter(param_replication_password)
+
+    volume_parameters = None
+    if ebs_volumes:
+        volume_parameters = add_volume_parameters(template)
+
     #---Mappings---------------------------------------------------------------
-    mapping_environment_attribute_map = template.add_mapping(
-        'EnvironmentAttributeMap',
-        {
-            'ap-southeast-1': {
-                'DatabaseServerAmi': 'ami-1ddc0b7e'
-            },
-            'ap-southeast-2': {
-                'DatabaseServerAmi': 'ami-0c95b86f'
-            },
-            'us-east-1': {
-                'DatabaseServerAmi': 'ami-a4827dc9'
-            },
-            'us-west-1': {
-                'DatabaseServerAmi': 'ami-f5f41398'
-            }
-        }
-    )
+    mapping_environment_attribute_map = template.add_mapping('EnvironmentAttributeMap', environment_attribute_map)
+
+    # postgresql.conf settings as f(instance type).
+    template.add_mapping('InstanceTypeTuningMap', get_tuning_map())
+
+    if ebs_volumes:
+        # EbsOptimized as f(instance type).
+        template.add_mapping('InstanceTypeEbsMap', get_ebs_optimized_map())
 
     # ---Resources-------------------------------------------------------------
     ref_stack_id = Ref('AWS::StackId')
@@ -134,11 +651,11 @@ def generate_stack_template():
     name_database_server_wait_handle = 'DatabaseServerWaitHandle'
 
     cmd_postgresql_initdb = dict(
-        command='service postgresql-95 initdb'
+        command='service %s initdb' % postgresql_service
     )
 
     cmd_start_postgresql_service = dict(
-        command='service postgresql-95 start'
+        command='service %s start' % postgresql_service
     )
 
     cmd_set_postgres_user_password = dict(
@@ -146,7 +663,7 @@ def generate_stack_template():
     )
 
     cmd_start_postgresql_on_startup = dict(
-        command='chkconfig postgresql on'
+        command='chkconfig %s on' % postgresql_service
     )
 
     cmd_signal_success = dict(
@@ -265,145 +782,134 @@ def generate_stack_template():
         ToPort=str(ssh_port)
     ))
 
+    # Render postgresql.conf with settings sized for the selected instance type.
+    postgresql_conf_content = [
+        '# Generated by postgres_single.py for instance type ', Ref(param_instance_type), '\n'
+    ]
+    for name, value in fixed_settings:
+        postgresql_conf_content.append('%s = %s\n' % (name, value))
+    for name, attribute in tuned_settings:
+        postgresql_conf_content.extend([
+            '%s = ' % name, FindInMap('InstanceTypeTuningMap', Ref(param_instance_type), attribute), '\n'
+        ])
+    if replica_count:
+        for name, value in get_replication_settings(replica_count):
+            postgresql_conf_content.append('%s = %s\n' % (name, value))
+
     # Create the metadata for the database instance.
     name_database_server = 'DatabaseServer'
+    database_packages = get_database_packages()
+
+    database_files = get_cfn_hup_files(name_database_server)
+    database_files.update(get_postgresql_sysconfig_files())
+    database_files.update({
+        # pg_hba.conf retrieval from S3
+        '/var/lib/pgsql9/data/pg_hba.conf': cloudformation.InitFile(
+            source=Join('/', [
+                # Join('', ['https://s3-', ref_region, '.', 'amazonaws.com']),
+                'https://s3.amazonaws.com',
+                Ref(param_s3_bucket),
+                Ref(param_s3_key),
+                'conf'
+                'pg_hba.conf'
+            ]),
+            mode='000400',
+            owner='root',
+            group='root'
+        ),
+        # postgresql.conf tuned for the instance type.
+        # (Must be readable by the postgres server.)
+        '/var/lib/pgsql9/data/postgresql.conf': cloudformation.InitFile(
+            content=Join('', postgresql_conf_content),
+            mode='000600',
+            owner='postgres',
+            group='postgres'
+        ),
+        # pg_ident.conf retrieval from S3
+        '/var/lib/pgsql9/data/pg_ident.conf': cloudformation.InitFile(
+            source=Join('/', [
+                #Join('', ['https://s3-', ref_region, '.', 'amazonaws.com']),
+                'https://s3.amazonaws.com',
+                Ref(param_s3_bucket),
+                Ref(param_s3_key),
+                'conf'
+                'pg_ident.conf'
+            ]),
+            mode='000400',
+            owner='root',
+            group='root'
+        ),
+        # script to set postgresql admin password.
+        # (admin user = 'postgres')
+        path_database_admin_script: cloudformation.InitFile(
+            source=Join('', [
+                'ALTER USER postgres WITH PASSWORD ',
+                Ref(param_database_admin_password),
+                ';',
+                '\n'
+            ])
+        )
+    })
+
+    database_commands = {
+        '10-postgresql_initdb': cmd_postgresql_initdb,
+        '20-start_postgresql_service': cmd_start_postgresql_service,
+        '30-set-postgres-user-password': cmd_set_postgres_user_password,
+        '40-start-postgresql-on-startup': cmd_start_postgresql_on_startup,
+        #'99-signal-success': cmd_signal_success
+    }
+
+    if ebs_volumes:
+        # Move the WAL created by initdb to the WAL volume.
+        database_commands['12-relocate-wal'] = dict(
+            command='mv /var/lib/pgsql9/data/pg_xlog %s && ln -s %s /var/lib/pgsql9/data/pg_xlog' % (
+                path_wal_directory, path_wal_directory),
+            test='test ! -L /var/lib/pgsql9/data/pg_xlog'
+        )
+
+    if replica_count:
+        # Create the user the replicas connect as and admit it from the VPC.
+        path_replication_user_script = 'usr/ec2-user/postgresql/create_replication_user.sql'
+        database_files[path_replication_user_script] = cloudformation.InitFile(
+            content=Join('', [
+                "CREATE ROLE %s WITH REPLICATION LOGIN PASSWORD '" % replication_user,
+                Ref(param_replication_password),
+                "';\n"
+            ]),
+            mode='000400',
+            owner='root',
+            group='root'
+        )
+        database_commands['15-allow-replication'] = dict(
+            command=Join('', [
+                'echo "host replication %s ' % replication_user, Ref(param_vpc_cidr_block),
+                ' md5" >> /var/lib/pgsql9/data/pg_hba.conf'
+            ]),
+            test='! grep -q "^host replication %s " /var/lib/pgsql9/data/pg_hba.conf' % replication_user
+        )
+        database_commands['35-create-replication-user'] = dict(
+            command='psql -U postgres -f %s' % path_replication_user_script,
+            test='! psql -U postgres -tAc "SELECT rolname FROM pg_roles" | grep -qx %s' % replication_user
+        )
+
+    database_services = get_database_services()
+
+    if pgbouncer:
+        add_pgbouncer(template, param_vpc_cidr_block, resource_database_security_group,
+                      param_database_admin_password, database_packages, database_files, database_services)
+
     database_instance_metadata = cloudformation.Metadata(
-        cloudformation.Init({
-            'config': cloudformation.InitConfig(
-                packages={
-                    'rpm': {
-                        'postgresql': 'https://download.postgresql.org/pub/repos/yum/9.5/redhat/rhel-6-x86_64/pgdg-ami201503-95-9.5-2.noarch.rpm'
-                    },
-                    'yum': {
-                        'postgresql95': [],
-                        'postgresql95-libs': [],
-                        'postgresql95-server': [],
-                        'postgresql95-devel': [],
-                        'postgresql95-contrib': [],
-                        'postgresql95-docs': []
-                    }
-                },
-                files=cloudformation.InitFiles({
-                    # cfn-hup.conf initialization
-                    '/etc/cfn/cfn-hup.conf': cloudformation.InitFile(
-                        content=Join('',
-                        [
-                            '[main]\n',
-                            'stack=', ref_stack_id, '\n',
-                            'region=', ref_region, '\n',
-                            'interval=2', '\n',
-                            'verbose=true', '\n'
-
-                        ]),
-                        mode='000400',
-                        owner='root',
-                        group='root'
-                    ),
-                    # cfn-auto-reloader.conf initialization
-                    '/etc/cfn/cfn-auto-reloader.conf': cloudformation.InitFile(
-                        content=Join('', [
-                            '[cfn-auto-reloader-hook]\n',
-                            'triggers=post.update\n',
-                            'path=Resources.%s.Metadata.AWS::CloudFormation::Init\n' % name_database_server,
-                            'action=cfn-init.exe ',
-                            ' --verbose '
-                            ' --stack ', ref_stack_name,
-                            ' --resource %s ' % name_database_server,  # resource that defines the Metadata
-                            ' --region ', ref_region, '\n'
-                        ]),
-                        mode='000400',
-                        owner='root',
-                        group='root'
-                    ),
-                    #
-                    # pg_hba.conf retrieval from S3
-                    '/var/lib/pgsql9/data/pg_hba.conf': cloudformation.InitFile(
-                        source=Join('/', [
-                            # Join('', ['https://s3-', ref_region, '.', 'amazonaws.com']),
-                            'https://s3.amazonaws.com',
-                            Ref(param_s3_bucket),
-                            Ref(param_s3_key),
-                            'conf'
-                            'pg_hba.conf'
-                        ]),
-                        mode='000400',
-                        owner='root',
-                        group='root'
-                    ),
-                    # postgresql.conf retrieval from S3
-                    '/var/lib/pgsql9/data/postgresql.conf': cloudformation.InitFile(
-                        source=Join('/', [
-                            #Join('', ['https://s3-', ref_region, '.', 'amazonaws.com']),
-                            'https://s3.amazonaws.com',
-                            Ref(param_s3_bucket),
-                            Ref(param_s3_key),
-                            'conf'
-                            'postgresql.conf'
-                        ]),
-                        mode='000400',
-                        owner='root',
-                        group='root'
-                    ),
-                    # pg_ident.conf retrieval from S3
-                    '/var/lib/pgsql9/data/pg_ident.conf': cloudformation.InitFile(
-                        source=Join('/', [
-                            #Join('', ['https://s3-', ref_region, '.', 'amazonaws.com']),
-                            'https://s3.amazonaws.com',
-                            Ref(param_s3_bucket),
-                            Ref(param_s3_key),
-                            'conf'
-                            'pg_ident.conf'
-                        ]),
-                        mode='000400',
-                        owner='root',
-                        group='root'
-                    ),
-                    # script to set postgresql admin password.
-                    # (admin user = 'postgres')
-                    path_database_admin_script: cloudformation.InitFile(
-                        source=Join('', [
-                            'ALTER USER postgres WITH PASSWORD ',
-                            Ref(param_database_admin_password),
-                            ';',
-                            '\n'
-                        ])
-                    )
-                }),
-                commands={
-                    '10-postgresql_initdb': cmd_postgresql_initdb,
-                    '20-start_postgresql_service': cmd_start_postgresql_service,
-                    '30-set-postgres-user-password': cmd_set_postgres_user_password,
-                    '40-start-postgresql-on-startup': cmd_start_postgresql_on_startup,
-                    #'99-signal-success': cmd_signal_success
-                },
+        get_database_init(
+            cloudformation.InitConfig(
+                packages=database_packages,
+                files=cloudformation.InitFiles(database_files),
+                commands=database_commands,
                 services=dict(
-                    sysvinit=cloudformation.InitServices(
-                        {
-                            # start cfn-hup service -
-                            # required for CloudFormation stack update
-                            'cfn-hup': cloudformation.InitService(
-                                enabled=True,
-                                ensureRunning=True,
-                                files=[
-                                    '/etc/cfn/cfn-hup.conf',
-                                    '/etc/cfn/hooks.d/cfn-auto-reloader.conf'
-                                ]
-                            ),
-                            # start postgresql service
-                            'postgresql-9.5': cloudformation.InitService(
-                                enabled=True,
-                                ensureRunning=True
-                            ),
-                            # Disable sendmail service - not required.
-                            'sendmail': cloudformation.InitService(
-                                enabled=False,
-                                ensureRunning=False
-                            )
-                        }
-                    )
+                    sysvinit=cloudformation.InitServices(database_services)
                 )
-            )
-        }),
+            ),
+            volume_parameters
+        ),
         cloudformation.Authentication({
             'S3AccessCredentials': cloudformation.AuthenticationBlock(
                 buckets=[Ref(param_s3_bucket)],
@@ -414,21 +920,26 @@ def generate_stack_template():
     )
 
 
-    # Add a wait handle to receive the completion signal.
-    #resource_database_server_wait_handle = template.add_resource(
-    #    cloudformation.WaitConditionHandle(
-    #        name_database_server_wait_handle
-    #    )
-    # )
+    # Hold the replicas back until cfn-init on the primary has succeeded.
+    # The primary signals a wait condition rather than its own creation: its
+    # database volumes are only attached once the instance is created, and
+    # cfn-init waits for them.
+    resource_database_server_wait_handle = None
+    if replica_count:
+        resource_database_server_wait_handle = template.add_resource(
+            cloudformation.WaitConditionHandle(
+                name_database_server_wait_handle
+            )
+        )
 
-    #template.add_resource(
-    #    cloudformation.WaitCondition(
-    #        'DatabaseServerWaitCondition',
-    #        DependsOn=name_database_server,
-    #        Handle=Ref(resource_database_server_wait_handle),
-    #        Timeout=300,
-    #    )
-    #)
+        template.add_resource(
+            cloudformation.WaitCondition(
+                'DatabaseServerWaitCondition',
+                DependsOn=name_database_server,
+                Handle=Ref(resource_database_server_wait_handle),
+                Timeout=1800,
+            )
+        )
 
     resource_database_server = ec2.Instance(
         name_database_server,
@@ -441,27 +952,22 @@ def generate_stack_template():
         SecurityGroupIds=[Ref(resource_database_security_group)],
         SubnetId=Ref(param_database_instance_subnet_id),
         Tags=Tags(Name=name_database_server, VPC=Ref(param_vpc_id)),
-        UserData=Base64(
-            Join(
-                '',
-                [
-                    '#!/bin/bash -xe\n',
-                    'yum update -y aws-cfn-bootstrap\n',
-
-                    '/opt/aws/bin/cfn-init --verbose ',
-                    ' --stack ', ref_stack_name,
-                    ' --resource DatabaseServer ',
-                    ' --region ', ref_region, '\n',
-
-                    '/opt/aws/bin/cfn-signal --exit-code $? ',
-                    ' --stack ', ref_stack_name,
-                    ' --resource ',
-                    name_database_server,
-                    '\n'
-                ]
-            )
-        )
+        UserData=get_cfn_init_user_data(name_database_server, resource_database_server_wait_handle)
     )
+    resource_volumes = []
+    if ebs_volumes:
+        resource_database_server.EbsOptimized = FindInMap(
+            'InstanceTypeEbsMap', Ref(param_instance_type), 'EbsOptimized')
+        resource_volumes = add_database_volumes(template, resource_database_server, volume_parameters)
+    # Pack the primary and the replicas together, for low replication lag.
+    resource_placement_group = None
+    if placement_group:
+        # The replicas are in other availability zones than the primary, out
+        # of reach of a cluster group, and the default instance type may not
+        # join one; spread keeps the instances on distinct hardware.
+        resource_placement_group = add_placement_group(
+            template, param_instance_type, 'spread', ('spread',) if replica_count else ('cluster', 'spread'))
+        resource_database_server.PlacementGroupName = Ref(resource_placement_group)
     template.add_resource(resource_database_server)
     template.add_output(
         Output('DatabaseServer',
@@ -470,25 +976,91 @@ def generate_stack_template():
         )
     )
 
+    if replica_count:
+        add_database_replicas(template, replica_count, resource_database_server, param_instance_type, param_keyname,
+                              param_vpc_id, param_replication_password, resource_database_security_group,
+                              resource_instance_profile, volume_parameters, resource_placement_group)
+
+    if pgbouncer:
+        template.add_output(
+            Output('PooledDatabaseEndpoint',
+                   Description='Address and port of the PgBouncer connection pool',
+                   Value=Join(':', [GetAtt(resource_database_server, 'PrivateIp'), str(pgbouncer_port)])
+            )
+        )
+
+    if monitoring:
+        add_database_alarms(template, resource_database_server, resource_volumes)
+
     return template
 
 # ---Generate CloudFormation template------------------------------------------
 def main():
-    template_path = './PostgresqlSingleInstanceStack.json'
+    option_parser = OptionParser()
+
+    option_parser.add_option(
+        '-m', '--Minify',
+        dest='minify',
+        action='store_true',
+        help='Write compact JSON without indentation.',
+        default=False
+    )
 
-    template = generate_stack_template()
+    option_parser.add_option(
+        '--PgBouncer',
+        dest='pgbouncer',
+        action='store_true',
+        help='Add a PgBouncer connection pool on port %d in front of the database.' % pgbouncer_port,
+        default=False
+    )
+
+    option_parser.add_option(
+        '-n', '--Replicas',
+        dest='replica_count',
+        type='int',
+        help='The number of streaming read replicas. (Default: 0)',
+        default=0
+    )
+
+    option_parser.add_option(
+        '--EbsVolumes',
+        dest='ebs_volumes',
+        action='store_true',
+        help='Keep the database data and WAL on dedicated provisioned IOPS EBS volumes.',
+        default=False
+    )
+
+    option_parser.add_option(
+        '--PlacementGroup',
+        dest='placement_group',
+        action='store_true',
+        help='Launch the database server and replicas in a placement group, spread by default; '
+             'with replicas, which are in other availability zones, always spread.',
+        default=False
+    )
+
+    option_parser.add_option(
+        '--Monitoring',
+        dest='monitoring',
+        action='store_true',
+        help='Add a CloudWatch dashboard and alarms on the CPU, CPU credits and disk queues of the database server.',
+        default=False
+    )
 
-    # Generate JSON.
-    json = template.to_json()
-    # Write JSON to console.
-    print json
+    (options, args) = option_parser.parse_args()
 
-    # Write JSON to a file.
-    file = open(template_path, mode='w')
-    file.writelines(json)
-    file.close()
+    template_path = './%s' % template_file_name()
+    generator_options = dict(pgbouncer=options.pgbouncer, replica_count=options.replica_count,
+                             ebs_volumes=options.ebs_volumes, placement_group=options.placement_group,
+                             monitoring=options.monitoring)
 
-    print 'Generated CloudFormation template is available in %s' % template_path
+    # Regenerate only when the inputs changed; rewrite only when the content changed.
+    if write_cached_template(__file__, generate_stack_template, generator_options,
+                             template_path, minify=options.minify):
+        print 'Generated CloudFormation template is available in %s' % template_path
+    else:
+        print 'Cached CloudFormation template is available in %s' % template_path
+    evict_cache_entries()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,74 @@
+# postgresql.conf settings sized to the EC2 instance type.
+# The settings are derived from the memory and vCPU count of each instance
+# type with the usual rules of thumb for a dedicated database server
+# (shared_buffers = 1/4 of memory, effective_cache_size = 3/4, ...).
+# postgres_single.py emits the result as the InstanceTypeTuningMap mapping and
+# renders postgresql.conf with Fn::FindInMap on the EC2InstanceType parameter.
+# The memory and vCPU count of each instance type come from cfgen/instances.py.
+from cfgen.instances import instance_type_hardware
+
+max_connections = 100
+
+# postgresql.conf setting names and the InstanceTypeTuningMap attribute holding each value.
+# The server runs PostgreSQL 9.5, which has no parallel query; add
+# max_parallel_workers_per_gather (9.6) and max_parallel_workers (10) when it is upgraded.
+tuned_settings = [
+    ('shared_buffers', 'SharedBuffers'),
+    ('effective_cache_size', 'EffectiveCacheSize'),
+    ('work_mem', 'WorkMem'),
+    ('maintenance_work_mem', 'MaintenanceWorkMem'),
+    ('max_worker_processes', 'MaxWorkerProcesses'),
+    ('wal_buffers', 'WalBuffers'),
+    ('min_wal_size', 'MinWalSize'),
+    ('max_wal_size', 'MaxWalSize')
+]
+
+# Settings that do not depend on the instance type.
+fixed_settings = [
+    ('listen_addresses', "'*'"),
+    ('port', '5432'),
+    ('max_connections', str(max_connections)),
+    ('checkpoint_timeout', '15min'),
+    ('checkpoint_completion_target', '0.9'),
+    # EBS volumes are SSD backed.
+    ('random_page_cost', '1.1'),
+    ('effective_io_concurrency', '200')
+]
+
+
+def get_tuning(memory, vcpus):
+    # Returns the InstanceTypeTuningMap attributes for an instance with memory MiB and vcpus.
+    shared_buffers = memory // 4
+    # Each connection may run a few sorts/hashes at once out of the memory left over.
+    work_mem_kb = max((memory - shared_buffers) * 1024 // (max_connections * 3), 1024)
+    return {
+        'SharedBuffers': '%dMB' % shared_buffers,
+        'EffectiveCacheSize': '%dMB' % (memory * 3 // 4),
+        'WorkMem': '%dkB' % work_mem_kb,
+        'MaintenanceWorkMem': '%dMB' % min(memory // 16, 2048),
+        'MaxWorkerProcesses': str(max(vcpus, 8)),
+        'WalBuffers': '%dMB' % max(min(shared_buffers // 32, 16), 1),
+        'MinWalSize': '1GB',
+        'MaxWalSize': '4GB' if memory >= 4096 else '2GB'
+    }
+
+
+def get_tuning_map():
+    return dict(
+        (instance_type, get_tuning(hardware['memory'], hardware['vcpus']))
+        for instance_type, hardware in instance_type_hardware.items()
+    )
+
+
+def get_replication_settings(replica_count):
+    # Settings of a primary streaming WAL to replica_count hot standby replicas.
+    # The replicas copy postgresql.conf from the primary with pg_basebackup.
+    return [
+        ('wal_level', 'hot_standby'),
+        # One sender per replica, plus two for pg_basebackup of a new replica.
+        ('max_wal_senders', str(replica_count + 2)),
+        # 1GB of 16MB segments kept for replicas that fall behind.
+        ('wal_keep_segments', '64'),
+        # Ignored by the primary.
+        ('hot_standby', 'on')
+    ]
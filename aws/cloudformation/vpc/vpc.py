@@ -11,13 +11,86 @@
 # pip install boto3
 # Optional but quite helpful:  Install PyCharm Community Edition (Cost=0)
 from optparse import OptionParser
+import os
+import re
+import sys
+# Make the shared cfgen package (aws/cloudformation/cfgen) importable.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cfgen.cache import evict_cache_entries, write_cached_template
+from cfgen.ingress import cidr_contains, compact_ingress_rules, merge_cidrs, merge_port_ranges
+from cfgen.monitoring import add_alarm, add_alarm_topic_parameter, add_dashboard, add_threshold_parameter
+from cfgen.subnets import plan_subnets
 from troposphere import Base64, FindInMap, GetAtt, GetAZs, Join, Select, Tags
 from troposphere import Output
 from troposphere import Parameter, Ref, Template
+import troposphere.cloudwatch as cloudwatch
 import troposphere.ec2 as ec2
 
-
-def add_content(template, environment, purpose):
+# IP address for Seattle, Palmerston North, and Auckland offices. (Airport codes used as keys.)
+home_network_cidr_dict = dict((('Akl', '121.98.118.142/32'),
+                               ('Pmr', '121.99.230.178/32'),
+                               ('Sea', '67.131.4.94/30')))
+
+# Free entries kept in the home network prefix list for new sites.
+prefix_list_headroom = 5
+
+# Amazon Linux AMI as f(region).
+# Chose the latest with virtualization type hvm.
+# Should review occasionally.
+region_attribute_map = {
+    'ap-southeast-1': {
+        'BastionHostAmi': 'ami-1ddc0b7e'
+    },
+    'ap-southeast-2': {
+        'BastionHostAmi': 'ami-0c95b86f'
+    },
+    'us-east-1': {
+        'BastionHostAmi': 'ami-a4827dc9'
+    },
+    'us-west-1': {
+        'BastionHostAmi': 'ami-11790371'
+    }
+}
+
+vpc_cidr_block = '10.0.0.0/16'
+
+# Subnet tiers as (tier, subnet name suffix, hosts per availability zone).
+# Each tier has a subnet in each zone, named by the zone letter and the
+# suffix: A is the first zone, B the second, ...  Public subnets route to the
+# internet gateway, the others through NAT.  cfgen/subnets.py sizes the
+# subnets for the hosts times the headroom and carves them out of the VPC.
+subnet_tiers = [
+    ('Public', '', 100),
+    ('Private', '1', 100),
+    ('Data', '2', 20)
+]
+default_tier_names = ('Public', 'Private')
+default_zone_count = 2
+default_headroom = 2
+
+# Services reached through gateway VPC endpoints on the private route tables.
+# Gateway endpoints are free, and keep S3 traffic (yum repositories, the
+# files cfn-init downloads, backups) and DynamoDB traffic off the NAT gateways.
+gateway_endpoint_services = ['s3', 'dynamodb']
+
+# Services that may be given interface VPC endpoints in the private subnets.
+# Interface endpoints are billed per hour and GB, so they are only created on request.
+interface_endpoint_services = ['cloudformation', 'ec2messages', 'ecr.api', 'ecr.dkr', 'kms', 'logs', 'monitoring',
+                               'secretsmanager', 'sns', 'sqs', 'ssm', 'ssmmessages', 'sts']
+
+# The subnets of the original two zone layout keep their CIDR blocks, since
+# CloudFormation replaces a subnet whose CIDR block changes.
+pinned_subnet_cidr_dict = {
+    ('Public', 'A'): '10.0.0.0/24',
+    ('Public', 'B'): '10.0.1.0/24',
+    ('Private', 'A1'): '10.0.10.0/24',
+    ('Private', 'B1'): '10.0.11.0/24'
+}
+
+
+def add_content(template, environment, purpose, ingress_rule_mode='sites', nat_gateway_per_az=False,
+                zone_count=default_zone_count, tier_names=default_tier_names, headroom=default_headroom,
+                interface_endpoints=(), monitoring=False):
     # Create parameters here since they must be passed to other functions.
     param_pem_key_name = template.add_parameter(
         Parameter(
@@ -34,45 +107,121 @@ def add_content(template, environment, purpose):
     name_region_attribute_map = 'RegionAttributeMap'
     add_mappings(template, name_region_attribute_map)
 
-    add_resources(template, environment, purpose, name_region_attribute_map, param_pem_key_name)
+    add_resources(template, environment, purpose, name_region_attribute_map, param_pem_key_name,
+                  ingress_rule_mode, nat_gateway_per_az, zone_count, tier_names, headroom, interface_endpoints,
+                  monitoring)
 
 def add_description(template):
     template.add_description('Creates a standard Virtual Private Cloud (VPC).')
 
 
 def add_mappings(template, name_region_attribute_map):
-    template.add_mapping(
-        name_region_attribute_map,
-        {
-            # Amazon Linux AMI as f(region).
-            # Chose the latest with virtualization type hvm.
-            # Should review occasionally.
-            'ap-southeast-1': {
-                'BastionHostAmi': 'ami-1ddc0b7e'
-            },
-            'ap-southeast-2': {
-                'BastionHostAmi': 'ami-0c95b86f'
-            },
-            'us-east-1': {
-                'BastionHostAmi': 'ami-a4827dc9'
-            },
-            'us-west-1': {
-                'BastionHostAmi': 'ami-11790371'
-            }
-        }
-    )
+    template.add_mapping(name_region_attribute_map, region_attribute_map)
+
+def get_subnet_availability_zone(subnet):
+    return Select(str(ord(subnet[0]) - ord('A')), GetAZs(''))
+
+# Logical ID fragments that stay stable as sites are added or removed.
+def get_rule_name(protocol, from_port, to_port):
+    if from_port == -1:
+        return '%sAll' % protocol.capitalize()
+    if from_port == to_port:
+        return '%s%d' % (protocol.capitalize(), from_port)
+    return '%s%dTo%d' % (protocol.capitalize(), from_port, to_port)
+
+def get_cidr_name(cidr):
+    address, prefix_length = cidr.split('/')
+    return '%sN%s' % (''.join('%03d' % int(octet) for octet in address.split('.')), prefix_length)
+
+def add_site_ingress_rules(template, environment, purpose, resource_security_group, site_rules, ingress_rule_mode):
+    # 'sites':  One ingress resource per site and rule.
+    if ingress_rule_mode == 'sites':
+        for name, protocol, from_port, to_port in site_rules:
+            for site in home_network_cidr_dict.keys():
+                template.add_resource(ec2.SecurityGroupIngress(
+                    'SecurityGroupIngress%s%s%s%s' % (name, purpose, environment, site),
+                    IpProtocol=protocol,
+                    FromPort=str(from_port),
+                    ToPort=str(to_port),
+                    CidrIp=home_network_cidr_dict[site],
+                    GroupId=Ref(resource_security_group)
+                ))
+
+    # 'aggregate':  Merge adjacent or overlapping site CIDRs and port ranges
+    # into the fewest equivalent rules.
+    elif ingress_rule_mode == 'aggregate':
+        rules = compact_ingress_rules([
+            (protocol, from_port, to_port, cidr)
+            for name, protocol, from_port, to_port in site_rules
+            for cidr in home_network_cidr_dict.values()
+        ])
+        for protocol, from_port, to_port, cidr in rules:
+            template.add_resource(ec2.SecurityGroupIngress(
+                'SecurityGroupIngressSites%sFrom%s%s%s' % (
+                    get_rule_name(protocol, from_port, to_port), get_cidr_name(cidr), purpose, environment),
+                IpProtocol=protocol,
+                FromPort=str(from_port),
+                ToPort=str(to_port),
+                CidrIp=cidr,
+                GroupId=Ref(resource_security_group)
+            ))
+
+    # 'prefix-list':  Put the site CIDRs in a managed prefix list and
+    # reference it once per protocol and port range, so a new site adds an
+    # entry rather than resources.
+    elif ingress_rule_mode == 'prefix-list':
+        name_prefix_list = 'HomeNetworkPrefixList%s%s' % (purpose, environment)
+        entries = []
+        for cidr in merge_cidrs(home_network_cidr_dict.values()):
+            sites = sorted(site for site in home_network_cidr_dict.keys()
+                           if cidr_contains(cidr, home_network_cidr_dict[site]))
+            entries.append(ec2.Entry(Cidr=cidr, Description=' '.join(sites)))
+        resource_prefix_list = ec2.PrefixList(
+            name_prefix_list,
+            AddressFamily='IPv4',
+            Entries=entries,
+            # Every rule that references the list counts MaxEntries rules
+            # against the security group quota, so keep the headroom small.
+            MaxEntries=len(entries) + prefix_list_headroom,
+            PrefixListName=name_prefix_list,
+            Tags=Tags(Name=name_prefix_list, Purpose=purpose, Environment=environment)
+        )
+        template.add_resource(resource_prefix_list)
+        template.add_output(
+            Output(
+                name_prefix_list,
+                Description='Managed prefix list of home network CIDR blocks',
+                Value=Ref(resource_prefix_list)
+            )
+        )
+
+        port_ranges_by_protocol = dict()
+        for name, protocol, from_port, to_port in site_rules:
+            port_ranges_by_protocol.setdefault(protocol, []).append((from_port, to_port))
+        for protocol in sorted(port_ranges_by_protocol.keys()):
+            for from_port, to_port in merge_port_ranges(port_ranges_by_protocol[protocol]):
+                template.add_resource(ec2.SecurityGroupIngress(
+                    'SecurityGroupIngressPrefixList%s%s%s' % (
+                        get_rule_name(protocol, from_port, to_port), purpose, environment),
+                    IpProtocol=protocol,
+                    FromPort=str(from_port),
+                    ToPort=str(to_port),
+                    SourcePrefixListId=Ref(resource_prefix_list),
+                    GroupId=Ref(resource_security_group)
+                ))
 
-def add_resources(template, environment, purpose, name_region_attribute_map, param_pem_key_name):
-    # IP address for Seattle, Palmerston North, and Auckland offices. (Airport codes used as keys.)
-    home_network_cidr_dict = dict((('Akl', '121.98.118.142/32'),
-                                   ('Pmr', '121.99.230.178/32'),
-                                   ('Sea', '67.131.4.94/30')))
+    else:
+        raise ValueError('Unknown ingress rule mode: %s' % ingress_rule_mode)
 
+def add_resources(template, environment, purpose, name_region_attribute_map, param_pem_key_name,
+                  ingress_rule_mode='sites', nat_gateway_per_az=False, zone_count=default_zone_count,
+                  tier_names=default_tier_names, headroom=default_headroom, interface_endpoints=(),
+                  monitoring=False):
     # PostgresSQL database port
     database_port_number = 5432
 
     # Create the VPC.
-    cidr_block_vpc = '10.0.0.0/16'
+    cidr_block_vpc = vpc_cidr_block
     name_vpc = 'Vpc%s%s' % (purpose, environment)
     resource_vpc = ec2.VPC(
         name_vpc,
@@ -112,16 +261,14 @@ def add_resources(template, environment, purpose, name_region_attribute_map, par
     )
 
     # Add security group ingress rules.
-    # ICMP from home networks.
-    for site in home_network_cidr_dict.keys():
-        template.add_resource(ec2.SecurityGroupIngress(
-            'SecurityGroupIngressIcmp%s%s%s' % (purpose, environment, site),
-            IpProtocol='icmp',
-            FromPort='-1',
-            ToPort='-1',
-            CidrIp=home_network_cidr_dict[site],
-            GroupId=Ref(resource_security_group_vpc)
-        ))
+    # Rules for traffic from home networks, as (name, protocol, from port, to port).
+    # ICMP and SSH from home networks.
+    site_rules = [('Icmp', 'icmp', -1, -1), ('Ssh', 'tcp', 22, 22)]
+    # For dev environments, restrict http(s) to home networks.
+    if environment.lower() == 'dev':
+        site_rules += [('Http', 'tcp', 80, 80), ('Https', 'tcp', 443, 443)]
+    add_site_ingress_rules(template, environment, purpose, resource_security_group_vpc, site_rules,
+                           ingress_rule_mode)
 
     # ICMP from within the VPC.
     template.add_resource(ec2.SecurityGroupIngress(
@@ -133,17 +280,6 @@ def add_resources(template, environment, purpose, name_region_attribute_map, par
         GroupId=Ref(resource_security_group_vpc)
     ))
 
-    # SSH from home networks
-    for site in home_network_cidr_dict.keys():
-        template.add_resource(ec2.SecurityGroupIngress(
-            'SecurityGroupIngressSsh%s%s%s' % (purpose, environment, site),
-            IpProtocol='tcp',
-            FromPort='22',
-            ToPort='22',
-            CidrIp=home_network_cidr_dict[site],
-            GroupId=Ref(resource_security_group_vpc)
-        ))
-
     # SSH from within the VPC.
     template.add_resource(ec2.SecurityGroupIngress(
         'SecurityGroupIngressVpcSsh%s%s' % (purpose, environment),
@@ -154,32 +290,8 @@ def add_resources(template, environment, purpose, name_region_attribute_map, par
         GroupId=Ref(resource_security_group_vpc)
     ))
 
-    # For dev environments, restrict http(s) to home networks.
-    if environment.lower() == 'dev':
-        # HTTP from home networks.
-        for site in home_network_cidr_dict.keys():
-            template.add_resource((ec2.SecurityGroupIngress(
-                'SecurityGroupIngressHttp%s%s%s' % (purpose, environment, site),
-                IpProtocol='tcp',
-                FromPort='80',
-                ToPort='80',
-                CidrIp=home_network_cidr_dict[site],
-                GroupId=Ref(resource_security_group_vpc)
-            )))
-
-        # HTTPS from home networks.
-        for site in home_network_cidr_dict.keys():
-            template.add_resource((ec2.SecurityGroupIngress(
-                'SecurityGroupIngressHttps%s%s%s' % (purpose, environment, site),
-                IpProtocol='tcp',
-                FromPort='443',
-                ToPort='443',
-                CidrIp=home_network_cidr_dict[site],
-                GroupId=Ref(resource_security_group_vpc)
-            )))
-
     # For non-dev environments, open HTTP(s) to the internet.
-    else:
+    if environment.lower() != 'dev':
         # HTTP from anywhere.
         template.add_resource(ec2.SecurityGroupIngress(
             'SecurityGroupIngressHttp%s%s' % (purpose, environment),
@@ -227,107 +339,42 @@ def add_resources(template, environment, purpose, name_region_attribute_map, par
     )
     template.add_resource(resource_internet_gateway_attachment)
 
-    # Create a public and private subnet in two availability zones
-    # for a total of four subnets.
-    # TODO:  Get the subnet CIDR blocks correct, i.e.,
-    # appropriately sized to anticipate future growth.
-    # What is here now is just a SWAG.
-    public_subnet_cidr_dict = dict(A='10.0.0.0/24', B='10.0.1.0/24')
-    private_subnet_cidr_dict = dict(A1='10.0.10.0/24', B1='10.0.11.0/24')
-
-    # Create public subnet A.
-    name_subnet = 'SubnetPublicA%s%s' % (purpose, environment)
-    resource_subnet_public_a = ec2.Subnet(
-        name_subnet,
-        AvailabilityZone=Select('0', GetAZs('')),
-        CidrBlock=public_subnet_cidr_dict['A'],
-        Tags=Tags(Name=name_subnet, Purpose=purpose, Environment=environment),
-        VpcId=Ref(resource_vpc)
-    )
-    template.add_resource(resource_subnet_public_a)
-    template.add_output(
-        Output(
+    # Create a subnet of each tier in each availability zone.
+    if 'Public' not in tier_names:
+        raise ValueError('The Public tier is required for the NAT gateway and bastion host.')
+    tiers = [tier for tier in subnet_tiers if tier[0] in tier_names]
+    public_subnet_resource_dict = dict()
+    private_subnet_resource_dict = dict()
+    # Public subnet names in zone order.
+    public_subnets = []
+    interface_endpoint_subnets = []
+    for tier, subnet, zone_index, cidr_block in plan_subnets(cidr_block_vpc, zone_count, tiers, headroom,
+                                                             pinned_subnet_cidr_dict):
+        name_subnet = 'Subnet%s%s%s%s' % (tier, subnet, purpose, environment)
+        resource_subnet = ec2.Subnet(
             name_subnet,
-            Description='Public Subnet A',
-            Value=Ref(resource_subnet_public_a)
+            AvailabilityZone=get_subnet_availability_zone(subnet),
+            CidrBlock=cidr_block,
+            Tags=Tags(Name=name_subnet, Purpose=purpose, Environment=environment),
+            VpcId=Ref(resource_vpc)
         )
-    )
-
-    # Create public subnet B.
-    name_subnet = 'SubnetPublicB%s%s' % (purpose, environment)
-    resource_subnet_public_b = ec2.Subnet(
-        name_subnet,
-        AvailabilityZone=Select('1', GetAZs('')),
-        CidrBlock=public_subnet_cidr_dict['B'],
-        Tags=Tags(Name=name_subnet, Purpose=purpose, Environment=environment),
-        VpcId=Ref(resource_vpc)
-    )
-    template.add_resource(resource_subnet_public_b)
-    template.add_output(
-        Output(
-            name_subnet,
-            Description='Public subnet B',
-            Value=Ref(resource_subnet_public_b)
-        )
-    )
-
-    # Create the private subnet A1.
-    name_subnet = 'SubnetPrivateA1%s%s' % (purpose, environment)
-    resource_subnet_private_a1 = ec2.Subnet(
-        name_subnet,
-        AvailabilityZone=Select('0', GetAZs('')),
-        CidrBlock=private_subnet_cidr_dict['A1'],
-        Tags=Tags(Name=name_subnet, Purpose=purpose, Environment=environment),
-        VpcId=Ref(resource_vpc)
-    )
-    template.add_resource(resource_subnet_private_a1)
-    template.add_output(
-        Output(
-            name_subnet,
-            Description='Private subnet A1',
-            Value=Ref(resource_subnet_private_a1)
-        )
-    )
-
-    # Create the private subnet B1.
-    name_subnet = 'SubnetPrivateB1%s%s' % (purpose, environment)
-    resource_subnet_private_b1 = ec2.Subnet(
-        name_subnet,
-        AvailabilityZone=Select('1', GetAZs('')),
-        CidrBlock=private_subnet_cidr_dict['B1'],
-        Tags=Tags(Name=name_subnet, Purpose=purpose, Environment=environment),
-        VpcId=Ref(resource_vpc)
-    )
-    template.add_resource(resource_subnet_private_b1)
-    template.add_output(
-        Output(
-            name_subnet,
-            Description='Private subnet B1',
-            Value=Ref(resource_subnet_private_b1)
+        template.add_resource(resource_subnet)
+        template.add_output(
+            Output(
+                name_subnet,
+                Description='%s subnet %s' % (tier, subnet),
+                Value=Ref(resource_subnet)
+            )
         )
-    )
-
-    # Subnets are created at this point.  Create dictionaries for iteration.
-    public_subnet_resource_dict = dict(A=resource_subnet_public_a, B=resource_subnet_public_b)
-    private_subnet_resource_dict = dict(A1=resource_subnet_private_a1, B1=resource_subnet_private_b1)
-
-    # Create an Elastic IP for the NAT gateway.
-    name_nat_eip = 'NatEip%s%s' % (purpose, environment)
-    resource_nat_eip = ec2.EIP(
-        name_nat_eip,
-        Domain=name_vpc
-    )
-    template.add_resource(resource_nat_eip)
-
-    # Create the NAT gateway in public subnet B.
-    name_nat_gateway = 'NatGateway%s%s' % (purpose, environment)
-    resource_nat_gateway = ec2.NatGateway(
-        name_nat_gateway,
-        AllocationId=GetAtt(name_nat_eip, 'AllocationId'),
-        DependsOn=name_vpc_internet_gateway_attachment,
-        SubnetId=Ref(resource_subnet_public_b),
-    )
-    template.add_resource(resource_nat_gateway)
+        # Subnets of the tiers other than Public share the private route tables.
+        if tier == 'Public':
+            public_subnet_resource_dict[subnet] = resource_subnet
+            public_subnets.append(subnet)
+        else:
+            private_subnet_resource_dict[subnet] = resource_subnet
+        # Interface endpoints get one subnet per zone.
+        if tier == 'Private':
+            interface_endpoint_subnets.append(subnet)
 
     # Create the public subnet route table.
     name_route_table = 'RouteTablePublic%s%s' % (purpose, environment)
@@ -347,7 +394,7 @@ def add_resources(template, environment, purpose, name_region_attribute_map, par
         RouteTableId=Ref(resource_route_table_public),
     ))
 
-    # Associate the route table with the AZ-A, AZ-B subnets.
+    # Associate the route table with the public subnets.
     for subnet in public_subnet_resource_dict.keys():
         template.add_resource(ec2.SubnetRouteTableAssociation(
             'RouteTableAssocPublicSubnet%s%s%s' % (subnet, purpose, environment),
@@ -355,31 +402,78 @@ def add_resources(template, environment, purpose, name_region_attribute_map, par
             SubnetId=Ref(public_subnet_resource_dict[subnet])
         ))
 
-    # Create the private subnet route table.
-    name_route_table = 'RouteTablePrivate%s%s' % (purpose, environment)
-    resource_route_table_private = ec2.RouteTable(
-        name_route_table,
-        Tags=Tags(Name=name_route_table, Purpose=purpose, Environment=environment),
-        VpcId=Ref(resource_vpc)
-    )
-    template.add_resource(resource_route_table_private)
+    # Create the NAT gateways and the private subnet route tables routing to
+    # the internet through them.  By default a single NAT gateway serves every
+    # private subnet, from the public subnet of the second zone (B), where it
+    # has always been, or of the only zone.  With nat_gateway_per_az each
+    # availability zone gets its own NAT gateway and route table, so private
+    # subnets egress without crossing zones and NAT bandwidth grows with the
+    # number of zones.  The zone letter is then part of the resource names.
+    if nat_gateway_per_az:
+        nat_zones = sorted(set(subnet[0] for subnet in private_subnet_resource_dict.keys()))
+    else:
+        nat_zones = ['']
+    private_route_tables = []
+    nat_gateways = []
+    for zone in nat_zones:
+        nat_subnet = zone or (public_subnets[1] if len(public_subnets) > 1 else public_subnets[0])
+        if nat_subnet not in public_subnet_resource_dict:
+            raise ValueError('No public subnet for the NAT gateway of availability zone %s' % nat_subnet)
+
+        # Create an Elastic IP for the NAT gateway.
+        name_nat_eip = 'NatEip%s%s%s' % (zone, purpose, environment)
+        resource_nat_eip = ec2.EIP(
+            name_nat_eip,
+            Domain=name_vpc
+        )
+        template.add_resource(resource_nat_eip)
+
+        # Create the NAT gateway in the public subnet.
+        name_nat_gateway = 'NatGateway%s%s%s' % (zone, purpose, environment)
+        resource_nat_gateway = ec2.NatGateway(
+            name_nat_gateway,
+            AllocationId=GetAtt(name_nat_eip, 'AllocationId'),
+            DependsOn=name_vpc_internet_gateway_attachment,
+            SubnetId=Ref(public_subnet_resource_dict[nat_subnet]),
+        )
+        template.add_resource(resource_nat_gateway)
+        nat_gateways.append(resource_nat_gateway)
+
+        # Create the private subnet route table.
+        name_route_table = 'RouteTablePrivate%s%s%s' % (zone, purpose, environment)
+        resource_route_table_private = ec2.RouteTable(
+            name_route_table,
+            Tags=Tags(Name=name_route_table, Purpose=purpose, Environment=environment),
+            VpcId=Ref(resource_vpc)
+        )
+        template.add_resource(resource_route_table_private)
+        private_route_tables.append(resource_route_table_private)
+
+        # Add route to internet via NAT.
+        template.add_resource(ec2.Route(
+            'RouteToInternetPrivateSubnet%s%s%s' % (zone, purpose, environment),
+            DependsOn=name_vpc_internet_gateway_attachment,
+            DestinationCidrBlock='0.0.0.0/0',
+            NatGatewayId=Ref(resource_nat_gateway),
+            RouteTableId=Ref(resource_route_table_private)
+        ))
 
-    # Add route to internet via NAT.
-    template.add_resource(ec2.Route(
-        'RouteToInternetPrivateSubnet%s%s' % (purpose, environment),
-        DependsOn=name_vpc_internet_gateway_attachment,
-        DestinationCidrBlock='0.0.0.0/0',
-        NatGatewayId=Ref(resource_nat_gateway),
-        RouteTableId=Ref(resource_route_table_private)
-    ))
+        # Associate the route table with the private subnets of the zone (all of them for a single NAT gateway).
+        for subnet in private_subnet_resource_dict.keys():
+            if not subnet.startswith(zone):
+                continue
+            template.add_resource(ec2.SubnetRouteTableAssociation(
+                'RouteTableAssocPrivateSubnet%s%s%s' % (subnet, purpose, environment),
+                RouteTableId=Ref(resource_route_table_private),
+                SubnetId=Ref(private_subnet_resource_dict[subnet])
+            ))
 
-    # Associate the route table with the AZ-A1, AZ-B1 subnets.
-    for subnet in private_subnet_resource_dict.keys():
-        template.add_resource(ec2.SubnetRouteTableAssociation(
-            'RouteTableAssocPrivateSubnet%s%s%s' % (subnet, purpose, environment),
-            RouteTableId=Ref(resource_route_table_private),
-            SubnetId=Ref(private_subnet_resource_dict[subnet])
-        ))
+    add_vpc_endpoints(template, environment, purpose, resource_vpc, private_route_tables,
+                      [private_subnet_resource_dict[subnet] for subnet in sorted(interface_endpoint_subnets)],
+                      interface_endpoints)
+
+    if monitoring:
+        add_nat_gateway_alarms(template, nat_gateways)
 
     # Create the bastion host.
     name_bastion_host = 'BastionHost%s%s' % (purpose, environment)
@@ -396,7 +490,7 @@ def add_resources(template, environment, purpose, name_region_attribute_map, par
                 Description='Bastion host network interface for %s%s' % (purpose, environment),
                 DeviceIndex=str(0),
                 GroupSet=[Ref(resource_security_group_vpc)],
-                SubnetId=Ref(resource_subnet_public_a),
+                SubnetId=Ref(public_subnet_resource_dict[public_subnets[0]]),
             )
         ],
         Tags=Tags(Name=name_bastion_host, Purpose=purpose, Environment=environment),
@@ -411,10 +505,101 @@ def add_resources(template, environment, purpose, name_region_attribute_map, par
         )
     )
 
+def add_nat_gateway_alarms(template, nat_gateways):
+    # Adds alarms on the traffic and dropped packets of each NAT gateway, and
+    # the dashboard graphing them.  A NAT gateway carries 5 Gbps, bursting to
+    # 100 Gbps; the default traffic threshold is 4 Gbps sustained.  Dropped
+    # packets mean the gateway is saturated (ports or bandwidth).
+    param_alarm_topic = add_alarm_topic_parameter(template)
+    param_bytes_threshold = add_threshold_parameter(
+        template, 'NatBytes', 'The bytes per minute a NAT gateway sends to the internet that raise an alarm.',
+        '30000000000')
+    param_packets_drop_threshold = add_threshold_parameter(
+        template, 'NatPacketsDrop', 'The packets per minute a NAT gateway drops that raise an alarm.', '100')
+    alarms = []
+    for resource_nat_gateway in nat_gateways:
+        dimensions = [cloudwatch.MetricDimension(Name='NatGatewayId', Value=Ref(resource_nat_gateway))]
+        alarms.append(add_alarm(
+            template, '%sBytesAlarm' % resource_nat_gateway.title, '%s bytes out' % resource_nat_gateway.title,
+            dict(Namespace='AWS/NATGateway', MetricName='BytesOutToDestination', Dimensions=dimensions,
+                 Statistic='Sum'),
+            Ref(param_bytes_threshold), param_alarm_topic))
+        alarms.append(add_alarm(
+            template, '%sPacketsDropAlarm' % resource_nat_gateway.title,
+            '%s dropped packets' % resource_nat_gateway.title,
+            dict(Namespace='AWS/NATGateway', MetricName='PacketsDropCount', Dimensions=dimensions, Statistic='Sum'),
+            Ref(param_packets_drop_threshold), param_alarm_topic))
+    add_dashboard(template, alarms)
+
+def get_endpoint_name(service):
+    # Logical ID fragment of a service, e.g. EcrApi for ecr.api.
+    return ''.join(part.capitalize() for part in re.split('[^a-z0-9]', service))
+
+def add_vpc_endpoints(template, environment, purpose, resource_vpc, private_route_tables, private_subnets,
+                      interface_endpoints):
+    # Gateway endpoints add routes to the service prefix lists to the private route tables.
+    for service in gateway_endpoint_services:
+        template.add_resource(ec2.VPCEndpoint(
+            'VpcEndpoint%s%s%s' % (get_endpoint_name(service), purpose, environment),
+            RouteTableIds=[Ref(route_table) for route_table in private_route_tables],
+            ServiceName=Join('', ['com.amazonaws.', Ref('AWS::Region'), '.%s' % service]),
+            VpcEndpointType='Gateway',
+            VpcId=Ref(resource_vpc)
+        ))
+
+    if not interface_endpoints:
+        return
+    if not private_subnets:
+        raise ValueError('Interface endpoints need the Private tier.')
+
+    # Interface endpoints are network interfaces in the private subnets,
+    # reached over HTTPS from within the VPC.  Private DNS resolves the public
+    # service name to them, so clients need no configuration.
+    name_security_group = 'VpcEndpointSecurityGroup%s%s' % (purpose, environment)
+    resource_security_group = template.add_resource(ec2.SecurityGroup(
+        name_security_group,
+        GroupDescription=Join(' ', ['Security group for interface endpoints of VPC', Ref(resource_vpc)]),
+        SecurityGroupIngress=[
+            ec2.SecurityGroupRule(
+                IpProtocol='tcp',
+                FromPort='443',
+                ToPort='443',
+                CidrIp=GetAtt(resource_vpc, 'CidrBlock')
+            )
+        ],
+        Tags=Tags(Name=name_security_group, Purpose=purpose, Environment=environment),
+        VpcId=Ref(resource_vpc)
+    ))
+    for service in interface_endpoints:
+        template.add_resource(ec2.VPCEndpoint(
+            'VpcEndpoint%s%s%s' % (get_endpoint_name(service), purpose, environment),
+            PrivateDnsEnabled=True,
+            SecurityGroupIds=[Ref(resource_security_group)],
+            ServiceName=Join('', ['com.amazonaws.', Ref('AWS::Region'), '.%s' % service]),
+            SubnetIds=[Ref(subnet) for subnet in private_subnets],
+            VpcEndpointType='Interface',
+            VpcId=Ref(resource_vpc)
+        ))
+
 def add_version(template):
     template.add_version(version='2010-09-09')
 
 
+def template_file_name(environment, purpose):
+    return 'Vpc%s%s.json' % (purpose, environment)
+
+
+def generate_stack_template(environment, purpose, ingress_rule_mode='sites', nat_gateway_per_az=False,
+                            zone_count=default_zone_count, tier_names=default_tier_names, headroom=default_headroom,
+                            interface_endpoints=(), monitoring=False):
+    template = Template()
+
+    add_content(template, environment, purpose, ingress_rule_mode, nat_gateway_per_az, zone_count, tier_names,
+                headroom, interface_endpoints, monitoring)
+
+    return template
+
+
 # ---Generate CloudFormation template------------------------------------------
 def main():
     option_parser = OptionParser()
@@ -433,26 +618,98 @@ def main():
         default='Platform'
     )
 
-    (options, args) = option_parser.parse_args()
-    environment = options.environment
-    purpose = options.purpose
-    template_path = './Vpc%s%s.json' % (purpose, environment)
+    option_parser.add_option(
+        '-m', '--Minify',
+        dest='minify',
+        action='store_true',
+        help='Write compact JSON without indentation.',
+        default=False
+    )
 
-    template = Template()
+    option_parser.add_option(
+        '-i', '--IngressRules',
+        dest='ingress_rule_mode',
+        type='choice',
+        choices=['sites', 'aggregate', 'prefix-list'],
+        help='How home network ingress rules are emitted: sites (one per site), aggregate or prefix-list.',
+        default='sites'
+    )
+
+    option_parser.add_option(
+        '--NatGatewayPerAz',
+        dest='nat_gateway_per_az',
+        action='store_true',
+        help='Create a NAT gateway and private route table in each availability zone rather than one shared NAT gateway.',
+        default=False
+    )
+
+    option_parser.add_option(
+        '-z', '--Zones',
+        dest='zone_count',
+        type='int',
+        help='The number of availability zones with subnets. (Default: %d)' % default_zone_count,
+        default=default_zone_count
+    )
 
-    add_content(template, environment, purpose)
+    option_parser.add_option(
+        '--Tiers',
+        dest='tier_names',
+        help='Comma separated subnet tiers: %s. (Default: %s)' % (
+            ', '.join(tier[0] for tier in subnet_tiers), ','.join(default_tier_names)),
+        default=','.join(default_tier_names)
+    )
 
-    # Generate JSON.
-    json = template.to_json()
-    # Write JSON to console.
-    print json
+    option_parser.add_option(
+        '--Headroom',
+        dest='headroom',
+        type='float',
+        help='Growth factor applied to the hosts per zone of each tier when sizing subnets. (Default: %g)'
+             % default_headroom,
+        default=default_headroom
+    )
 
-    # Write JSON to a file.
-    file = open(template_path, mode='w')
-    file.writelines(json)
-    file.close()
+    option_parser.add_option(
+        '--InterfaceEndpoints',
+        dest='interface_endpoints',
+        help='Comma separated services to create interface VPC endpoints for, from: %s. (Default: none)'
+             % ', '.join(interface_endpoint_services),
+        default=''
+    )
 
-    print 'Generated CloudFormation template is available in %s' % template_path
+    option_parser.add_option(
+        '--Monitoring',
+        dest='monitoring',
+        action='store_true',
+        help='Add a CloudWatch dashboard and alarms on the traffic and dropped packets of the NAT gateways.',
+        default=False
+    )
+
+    (options, args) = option_parser.parse_args()
+    if not 1 <= options.zone_count <= 26:
+        option_parser.error('--Zones must be from 1 to 26, not %d.' % options.zone_count)
+    tier_names = [name.strip() for name in options.tier_names.split(',') if name.strip()]
+    unknown_tier_names = set(tier_names) - set(tier[0] for tier in subnet_tiers)
+    if unknown_tier_names:
+        option_parser.error('Unknown tiers: %s' % ', '.join(sorted(unknown_tier_names)))
+    interface_endpoints = [name.strip() for name in options.interface_endpoints.split(',') if name.strip()]
+    unknown_services = set(interface_endpoints) - set(interface_endpoint_services)
+    if unknown_services:
+        option_parser.error('No interface endpoints for: %s' % ', '.join(sorted(unknown_services)))
+    environment = options.environment
+    purpose = options.purpose
+    template_path = './%s' % template_file_name(environment, purpose)
+
+    # Regenerate only when the inputs changed; rewrite only when the content changed.
+    generator_options = dict(environment=environment, purpose=purpose, ingress_rule_mode=options.ingress_rule_mode,
+                             nat_gateway_per_az=options.nat_gateway_per_az, zone_count=options.zone_count,
+                             tier_names=tier_names, headroom=options.headroom,
+                             interface_endpoints=interface_endpoints, monitoring=options.monitoring)
+    if write_cached_template(__file__, generate_stack_template, generator_options,
+                             template_path, minify=options.minify):
+        print 'Generated CloudFormation template is available in %s' % template_path
+    else:
+        print 'Cached CloudFormation template is available in %s' % template_path
+    evict_cache_entries()
 
 
 if __name__ == '__main__':
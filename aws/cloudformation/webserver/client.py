@@ -10,11 +10,50 @@
 # This script uses the boto3 library to get build versions from S3.
 # pip install boto3
 # Optional but quite helpful:  Install PyCharm Community Edition (Cost=0)
+from optparse import OptionParser
+import os
+import sys
+# Make the shared cfgen package (aws/cloudformation/cfgen) importable.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# Make the sibling modules importable when loaded by the batch build.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from cfgen.cache import evict_cache_entries, write_cached_template
+from cfgen.cdn import add_distribution
+from cfgen.instances import add_instance_type_parameter
+from cfgen.monitoring import add_alarm_topic_parameter, add_dashboard, add_instance_alarms, add_threshold_parameter
+from cfgen.packer import get_unless_baked_user_data
+from nginx_config import get_authorapp_conf, get_nginx_conf, get_worker_tuning_map, micro_cached_locations
+from nginx_config import path_micro_cache, path_static_root, render
 from troposphere import Base64, FindInMap, GetAtt, Join, Tags
 from troposphere import Output
 from troposphere import Parameter, Ref, Template
+from awacs.aws import (Allow,
+                       Statement,
+                       Principal,
+                       Policy)
+from awacs.sts import AssumeRole
 import troposphere.cloudformation as cloudformation
 import troposphere.ec2 as ec2
+import troposphere.iam as iam
+
+# Web server AMI as f(region).
+environment_attribute_map = {
+    'ap-southeast-1': {
+        'WebServerAmi': 'ami-1ddc0b7e'
+    },
+    'ap-southeast-2': {
+        'WebServerAmi': 'ami-0c95b86f'
+    },
+    'us-east-1': {
+        'WebServerAmi': 'ami-a4827dc9'
+    },
+    'us-west-1': {
+        'WebServerAmi': 'ami-f5f41398'
+    }
+}
+
+# Set when the AMIs above have the ENA and NVMe drivers of the Nitro instance types.
+nitro_ami = False
 
 
 def generate_description(template):
@@ -23,7 +62,10 @@ def generate_description(template):
 def generate_version(template):
     template.add_version(version='2010-09-09')
 
-def generate_stack_template():
+def template_file_name():
+    return 'ClientStack.json'
+
+def generate_stack_template(api_micro_cache=False, cdn=False, monitoring=False):
     template = Template()
 
     generate_description(template)
@@ -59,43 +101,55 @@ def generate_stack_template():
     )
     template.add_parameter(param_keyname)
 
-    param_instance_type = Parameter(
-        'EC2InstanceType',
-        Description='EC2 instance type, reference this parameter to insure consistency',
-        Type='String',
-        Default='t2.medium',  # Prices from (2015-12-03) (Windows, us-west (North CA))
-        AllowedValues=[  # Source :  https://aws.amazon.com/ec2/pricing/
-            't2.small',  # $0.044/hour
-            't2.micro',  # $0.022/hour
-            't2.medium',  # $0.088/hour
-            't2.large',  # $0.166/hour
-            'm3.medium',  # $0.140/hour
-            'm3.large',  # $0.28/hour
-            'c4.large'   # $0.221/hour
-        ],
-        ConstraintDescription='Must be a valid EC2 instance type'
+    param_instance_type = add_instance_type_parameter(template, 't2.medium', nitro_ami)
+
+    param_api_backends = Parameter(
+        'ApiBackends',
+        Description='The API servers (host:port, comma separated) the web server proxies /api to.',
+        Type='CommaDelimitedList',
+        Default='10.50.50.1:3000'
     )
-    template.add_parameter(param_instance_type)
+    template.add_parameter(param_api_backends)
 
+    param_api_keepalive = Parameter(
+        'ApiKeepaliveConnections',
+        Description='Idle connections to the API servers each nginx worker keeps open.',
+        Type='Number',
+        Default='32',
+        # nginx rejects keepalive 0.
+        MinValue='1'
+    )
+    template.add_parameter(param_api_keepalive)
+
+    micro_cache_parameters = None
+    if api_micro_cache:
+        param_cache_size = Parameter(
+            'ApiCacheSizeMB',
+            Description='The size (MB) of the tmpfs holding the API micro-cache.',
+            Type='Number',
+            Default='64',
+            MinValue='16'
+        )
+        template.add_parameter(param_cache_size)
+
+        cache_ttl_parameters = {}
+        for location, prefix, default_ttl in micro_cached_locations:
+            param_cache_ttl = Parameter(
+                '%sCacheTtl' % prefix,
+                Description='Seconds a %s response is served from the micro-cache.' % location,
+                Type='Number',
+                Default=default_ttl,
+                MinValue='1'
+            )
+            template.add_parameter(param_cache_ttl)
+            cache_ttl_parameters[location] = param_cache_ttl
+        micro_cache_parameters = (param_cache_size, cache_ttl_parameters)
 
     #---Mappings---------------------------------------------------------------
-    mapping_environment_attribute_map = template.add_mapping(
-        'EnvironmentAttributeMap',
-        {
-            'ap-southeast-1': {
-                'WebServerAmi': 'ami-1ddc0b7e'
-            },
-            'ap-southeast-2': {
-                'WebServerAmi': 'ami-0c95b86f'
-            },
-            'us-east-1': {
-                'WebServerAmi': 'ami-a4827dc9'
-            },
-            'us-west-1': {
-                'WebServerAmi': 'ami-f5f41398'
-            }
-        }
-    )
+    mapping_environment_attribute_map = template.add_mapping('EnvironmentAttributeMap', environment_attribute_map)
+
+    # nginx worker settings as f(instance type).
+    template.add_mapping('InstanceTypeNginxMap', get_worker_tuning_map())
 
     # ---Resources-------------------------------------------------------------
     ref_region = Ref('AWS::Region')
@@ -103,64 +157,143 @@ def generate_stack_template():
 
     # Create the metadata for the server instance.
     name_web_server = 'WebServer'
-    webserver_instance_metadata = cloudformation.Metadata(
-        cloudformation.Init({
-            'config': cloudformation.InitConfig(
-                packages={
-                    'yum': {
-                        'nginx': [],
-                        'git': []
-                    }
-                },
-                files=cloudformation.InitFiles({
-                    # cfn-hup.conf initialization
-                    '/etc/cfn/authorapp.conf': cloudformation.InitFile(
-                        content=Join('',
-                        [
-                            'server {', '\n',
-                            '	listen 3030 ssl http2;', '\n',
-                            '	root /var/www/authorapp;', '\n',
-                            '\n',
-                            '	ssl_certificate       /vagrant/ssl/ca.crt;', '\n',
-                            '	ssl_certificate_key   /vagrant/ssl/ca.key;', '\n',
-                            '\n',
-                            '	location / {', '\n',
-                            '	}', '\n',
-                            '\n',
-                            '	location /api {', '\n',
-                            '		proxy_pass http://10.50.50.1:3000;', '\n',
-                            '	}', '\n',
-                            '}', '\n',
-                        ]),
-                        mode='000400',
-                        owner='root',
-                        group='root'
+    webserver_config = cloudformation.InitConfig(
+        packages={
+            'yum': {
+                'nginx': [],
+                'git': []
+            }
+        },
+        files=cloudformation.InitFiles({
+            # nginx.conf with workers sized for the instance type.
+            '/etc/nginx/nginx.conf': cloudformation.InitFile(
+                content=Join('', render(get_nginx_conf(param_instance_type))),
+                mode='000644',
+                owner='root',
+                group='root'
+            ),
+            # The authorapp server and the API upstream.
+            '/etc/nginx/conf.d/authorapp.conf': cloudformation.InitFile(
+                content=Join('', render(get_authorapp_conf(param_api_backends, param_api_keepalive,
+                                                           micro_cache_parameters))),
+                mode='000644',
+                owner='root',
+                group='root'
+            )
+        }),
+        services=dict(
+            sysvinit=cloudformation.InitServices(
+                {
+                    # start cfn-hup service -
+                    # required for CloudFormation stack update
+                    'cfn-hup': cloudformation.InitService(
+                        enabled=True,
+                        ensureRunning=True,
+                        files=[
+                            '/etc/cfn/cfn-hup.conf',
+                            '/etc/cfn/hooks.d/cfn-auto-reloader.conf'
+                        ]
+                    ),
+                    # start nginx service, restarting it when its configuration changes.
+                    'nginx': cloudformation.InitService(
+                        enabled=True,
+                        ensureRunning=True,
+                        files=[
+                            '/etc/nginx/nginx.conf',
+                            '/etc/nginx/conf.d/authorapp.conf'
+                        ]
                     ),
+                    # Disable sendmail service - not required.
+                    'sendmail': cloudformation.InitService(
+                        enabled=False,
+                        ensureRunning=False
+                    )
+                }
+            )
+        )
+    )
+
+    if api_micro_cache:
+        # Keep the micro-cache in memory, across reboots too.
+        # (nginx gives the cache directory to its worker user at startup.)
+        webserver_config.commands = {
+            '10-mount-micro-cache': dict(
+                command=Join('', [
+                    'mkdir -p %s && echo "tmpfs %s tmpfs size=' % (path_micro_cache, path_micro_cache),
+                    Ref(param_cache_size),
+                    'm 0 0" >> /etc/fstab && mount %s' % path_micro_cache
+                ]),
+                test='! grep -q " %s " /etc/fstab' % path_micro_cache
+            )
+        }
 
-                }),
-                services=dict(
-                    sysvinit=cloudformation.InitServices(
-                        {
-                            # start cfn-hup service -
-                            # required for CloudFormation stack update
-                            'cfn-hup': cloudformation.InitService(
-                                enabled=True,
-                                ensureRunning=True,
-                                files=[
-                                    '/etc/cfn/cfn-hup.conf',
-                                    '/etc/cfn/hooks.d/cfn-auto-reloader.conf'
-                                ]
-                            ),
-                            # Disable sendmail service - not required.
-                            'sendmail': cloudformation.InitService(
-                                enabled=False,
-                                ensureRunning=False
-                            )
-                        }
+    init_configs = {'config': webserver_config}
+    if cdn:
+        # CloudFront serves /api from nginx, and the static content from a
+        # bucket the web server publishes /var/www/authorapp to every few minutes.
+        # nginx has a self-signed certificate, which CloudFront rejects for
+        # the instance's DNS name, so the stack must name a domain whose
+        # certificate nginx serves.
+        distribution, static_bucket = add_distribution(template, name_web_server, origin_https_port=3030)
+        init_configs['configSets'] = cloudformation.InitConfigSets(default=['config', 'static'])
+        init_configs['static'] = cloudformation.InitConfig(
+            files=cloudformation.InitFiles({
+                '/etc/cron.d/authorapp-static': cloudformation.InitFile(
+                    content=Join('', [
+                        '*/5 * * * * root aws s3 sync --delete --region ', ref_region,
+                        ' %s s3://' % path_static_root, Ref(static_bucket), '\n'
+                    ]),
+                    mode='000644',
+                    owner='root',
+                    group='root'
+                )
+            })
+        )
+
+        # Create an instance of AWS::IAM::Role for the instance.
+        # This allows publishing the static content to the bucket.
+        resource_instance_role = template.add_resource(iam.Role(
+            'WebServerRole',
+            AssumeRolePolicyDocument=Policy(
+                Statement=[
+                    Statement(
+                        Action=[AssumeRole],
+                        Effect=Allow,
+                        Principal=Principal(
+                            'Service', ['ec2.amazonaws.com']
+                        )
                     )
+                ]
+            ),
+            Path='/',
+            Policies=[
+                iam.Policy(
+                    PolicyName='StaticContentSync',
+                    PolicyDocument={
+                        'Statement': [
+                            {
+                                'Effect': 'Allow',
+                                'Action': ['s3:ListBucket'],
+                                'Resource': GetAtt(static_bucket, 'Arn')
+                            },
+                            {
+                                'Effect': 'Allow',
+                                'Action': ['s3:DeleteObject', 's3:PutObject'],
+                                'Resource': Join('', [GetAtt(static_bucket, 'Arn'), '/*'])
+                            }
+                        ]
+                    }
                 )
-            )
-        })
+            ]
+        ))
+        resource_instance_profile = template.add_resource(iam.InstanceProfile(
+            'WebServerInstanceProfile',
+            Path='/',
+            Roles=[Ref(resource_instance_role)]
+        ))
+
+    webserver_instance_metadata = cloudformation.Metadata(
+        cloudformation.Init(init_configs)
     )
 
     resource_web_server = ec2.Instance(
@@ -183,12 +316,11 @@ def generate_stack_template():
         UserData=Base64(
             Join(
                 '',
-                [
-                    '#!/bin/bash -xe\n',
+                ['#!/bin/bash -xe\n'] + get_unless_baked_user_data([
                     'yum update -y aws-cfn-bootstrap\n',
 
                     'yum update -y', '\n'
-
+                ]) + [
                     '/opt/aws/bin/cfn-init --verbose ',
                     ' --stack ', ref_stack_name,
                     ' --resource %s ' % name_web_server,
@@ -203,6 +335,8 @@ def generate_stack_template():
             )
         )
     )
+    if cdn:
+        resource_web_server.IamInstanceProfile = Ref(resource_instance_profile)
     template.add_resource(resource_web_server)
     template.add_output(
         Output('WebServer',
@@ -211,25 +345,66 @@ def generate_stack_template():
         )
     )
 
+    if monitoring:
+        param_alarm_topic = add_alarm_topic_parameter(template)
+        param_cpu_threshold = add_threshold_parameter(
+            template, 'Cpu', 'The CPU utilization (percent) of the web server that raises an alarm.', '80')
+        add_dashboard(template, add_instance_alarms(template, name_web_server, 'Web server', 'InstanceId',
+                                                    Ref(resource_web_server), param_cpu_threshold,
+                                                    param_alarm_topic))
+
     return template
 
 # ---Generate CloudFormation template------------------------------------------
 def main():
-    template_path = './ClientStack.json'
+    option_parser = OptionParser()
+
+    option_parser.add_option(
+        '-m', '--Minify',
+        dest='minify',
+        action='store_true',
+        help='Write compact JSON without indentation.',
+        default=False
+    )
 
-    template = generate_stack_template()
+    option_parser.add_option(
+        '--ApiMicroCache',
+        dest='api_micro_cache',
+        action='store_true',
+        help='Cache /api responses for a few seconds in nginx.',
+        default=False
+    )
+
+    option_parser.add_option(
+        '--CloudFront',
+        dest='cdn',
+        action='store_true',
+        help='Serve the site through a CloudFront distribution: %s from an S3 bucket, /api from nginx, '
+             'which the WebServerOriginDomainName parameter must name by a domain its certificate matches.'
+             % path_static_root,
+        default=False
+    )
+
+    option_parser.add_option(
+        '--Monitoring',
+        dest='monitoring',
+        action='store_true',
+        help='Add a CloudWatch dashboard and alarms on the CPU and status checks of the web server.',
+        default=False
+    )
 
-    # Generate JSON.
-    json = template.to_json()
-    # Write JSON to console.
-    print json
+    (options, args) = option_parser.parse_args()
 
-    # Write JSON to a file.
-    file = open(template_path, mode='w')
-    file.writelines(json)
-    file.close()
+    template_path = './%s' % template_file_name()
+    generator_options = dict(api_micro_cache=options.api_micro_cache, cdn=options.cdn, monitoring=options.monitoring)
 
-    print 'Generated CloudFormation template is available in %s' % template_path
+    # Regenerate only when the inputs changed; rewrite only when the content changed.
+    if write_cached_template(__file__, generate_stack_template, generator_options,
+                             template_path, minify=options.minify):
+        print 'Generated CloudFormation template is available in %s' % template_path
+    else:
+        print 'Cached CloudFormation template is available in %s' % template_path
+    evict_cache_entries()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,211 @@
+# nginx configuration for the client.py web server.
+# A configuration is built as a list of directives and blocks and rendered to
+# the parts of an Fn::Join, so that values may be template parameters or
+# mapping lookups as well as strings.  client.py writes the rendered files
+# with cfn-init: nginx.conf with the worker and http settings, and
+# conf.d/authorapp.conf with the API upstream and the server.
+# Worker settings are sized to the EC2 instance type; client.py emits them as
+# the InstanceTypeNginxMap mapping.
+# The optional micro-cache keeps API responses for a few seconds in a tmpfs
+# backed proxy_cache, so that a burst of identical GETs costs the backends one
+# request per TTL.  One request per key refreshes an entry while the others
+# are answered from the stale copy.  Only anonymous requests, without
+# credentials or cookies, are cached, and responses the backends mark as
+# per-user are not.
+from cfgen.instances import instance_type_hardware
+from troposphere import FindInMap, Join, Ref
+
+# Connections each worker accepts; a proxied request uses two.
+worker_connections = 4096
+
+path_static_root = '/var/www/authorapp'
+
+# Long-lived cache headers for static assets; the application references them by versioned URLs.
+static_asset_pattern = r'\.(css|js|map|png|jpe?g|gif|svg|ico|woff2?|ttf|eot)$'
+static_asset_expires = '30d'
+
+path_micro_cache = '/var/cache/nginx/microcache'
+
+# Micro-cached API locations: (location, parameter name prefix, default TTL seconds).
+# Hot endpoints may get a TTL of their own, e.g. ('/api/catalog', 'ApiCatalog', '30').
+micro_cached_locations = [
+    ('/api', 'Api', '5')
+]
+
+
+def get_worker_tuning(vcpus):
+    # Returns the InstanceTypeNginxMap attributes for an instance with vcpus.
+    return {
+        'WorkerProcesses': str(vcpus),
+        'WorkerConnections': str(worker_connections),
+        # Each connection holds up to two file descriptors (client and upstream or file).
+        'WorkerRlimitNofile': str(worker_connections * 2)
+    }
+
+
+def get_worker_tuning_map():
+    return dict(
+        (instance_type, get_worker_tuning(hardware['vcpus']))
+        for instance_type, hardware in instance_type_hardware.items()
+    )
+
+
+def directive(name, *values):
+    return ('directive', name, values)
+
+
+def block(name, items):
+    # items may hold None for directives left out.
+    return ('block', name, items)
+
+
+def render(items, depth=0):
+    # Returns the Fn::Join parts of the items, merging adjacent strings.
+    parts = []
+
+    def append(value):
+        if isinstance(value, str) and parts and isinstance(parts[-1], str):
+            parts[-1] += value
+        else:
+            parts.append(value)
+
+    indent = '    ' * depth
+    for item in items:
+        if item is None:
+            continue
+        kind, name, contents = item
+        if kind == 'directive':
+            append(indent + name)
+            for value in contents:
+                append(' ')
+                append(value)
+            append(';\n')
+        else:
+            append('%s%s {\n' % (indent, name))
+            for part in render(contents, depth + 1):
+                append(part)
+            append('%s}\n' % indent)
+    return parts
+
+
+def get_nginx_conf(param_instance_type):
+    # Main configuration: workers sized to the instance type, and the http
+    # settings shared by every server.
+    def worker_setting(attribute):
+        return FindInMap('InstanceTypeNginxMap', Ref(param_instance_type), attribute)
+
+    return [
+        directive('user', 'nginx'),
+        directive('worker_processes', worker_setting('WorkerProcesses')),
+        directive('worker_rlimit_nofile', worker_setting('WorkerRlimitNofile')),
+        directive('error_log', '/var/log/nginx/error.log'),
+        directive('pid', '/var/run/nginx.pid'),
+        block('events', [
+            directive('worker_connections', worker_setting('WorkerConnections')),
+            directive('multi_accept', 'on')
+        ]),
+        block('http', [
+            directive('include', '/etc/nginx/mime.types'),
+            directive('default_type', 'application/octet-stream'),
+            directive('access_log', '/var/log/nginx/access.log'),
+            directive('sendfile', 'on'),
+            directive('tcp_nopush', 'on'),
+            directive('tcp_nodelay', 'on'),
+            directive('keepalive_timeout', '65'),
+            directive('keepalive_requests', '1000'),
+            directive('server_tokens', 'off'),
+            # Compress text responses; small ones are not worth the CPU.
+            directive('gzip', 'on'),
+            directive('gzip_comp_level', '5'),
+            directive('gzip_min_length', '1024'),
+            directive('gzip_proxied', 'any'),
+            directive('gzip_vary', 'on'),
+            directive('gzip_types', 'text/plain', 'text/css', 'text/javascript', 'application/javascript',
+                      'application/json', 'application/xml', 'image/svg+xml'),
+            # Cache open file descriptors and metadata of static files.
+            directive('open_file_cache', 'max=10000', 'inactive=60s'),
+            directive('open_file_cache_valid', '120s'),
+            directive('open_file_cache_min_uses', '2'),
+            directive('open_file_cache_errors', 'on'),
+            directive('include', '/etc/nginx/conf.d/*.conf')
+        ])
+    ]
+
+
+def get_api_proxy_items():
+    # Proxy settings of a location forwarding to the API upstream over kept-alive connections.
+    return [
+        directive('proxy_pass', 'http://authorapp_api'),
+        directive('proxy_http_version', '1.1'),
+        # Clear Connection: close so that the upstream connection is kept alive.
+        directive('proxy_set_header', 'Connection', '""'),
+        directive('proxy_set_header', 'Host', '$host'),
+        directive('proxy_set_header', 'X-Real-IP', '$remote_addr'),
+        directive('proxy_set_header', 'X-Forwarded-For', '$proxy_add_x_forwarded_for'),
+        directive('proxy_set_header', 'X-Forwarded-Proto', '$scheme')
+    ]
+
+
+def get_micro_cache_items(param_cache_ttl):
+    # Cache settings of a micro-cached location.
+    return [
+        directive('proxy_cache', 'microcache'),
+        directive('proxy_cache_valid', '200', '301', '302', Join('', [Ref(param_cache_ttl), 's'])),
+        # Send one request per key to the backends while the entry is filled.
+        directive('proxy_cache_lock', 'on'),
+        directive('proxy_cache_lock_timeout', '5s'),
+        # Serve the stale entry while it is refreshed, or while the backends fail.
+        directive('proxy_cache_use_stale', 'updating', 'error', 'timeout', 'http_500', 'http_502', 'http_503',
+                  'http_504'),
+        directive('proxy_cache_background_update', 'on'),
+        # Leave requests that carry credentials or a session cookie to the backends.
+        directive('proxy_cache_bypass', '$http_authorization', '$http_cookie'),
+        directive('proxy_no_cache', '$http_authorization', '$http_cookie'),
+        # Responses with Set-Cookie or Cache-Control private, no-cache or
+        # no-store are not cached as long as these headers are not listed in
+        # proxy_ignore_headers; keep it unset.
+        directive('add_header', 'X-Cache-Status', '$upstream_cache_status')
+    ]
+
+
+def get_authorapp_conf(param_api_backends, param_api_keepalive, micro_cache_parameters=None):
+    # The API upstream and the authorapp server.
+    # param_api_backends is a CommaDelimitedList of host:port.
+    # micro_cache_parameters, if given, holds the cache size parameter and
+    # {location: TTL parameter} for the locations in micro_cached_locations.
+    if micro_cache_parameters is None:
+        api_locations = [block('location /api', get_api_proxy_items())]
+        cache_path = None
+    else:
+        param_cache_size, cache_ttl_parameters = micro_cache_parameters
+        api_locations = [
+            block('location %s' % location, get_api_proxy_items() + get_micro_cache_items(cache_ttl_parameters[location]))
+            for location, prefix, default_ttl in micro_cached_locations
+        ]
+        cache_path = directive(
+            'proxy_cache_path', path_micro_cache, 'levels=1:2', 'keys_zone=microcache:10m',
+            Join('', ['max_size=', Ref(param_cache_size), 'm']), 'inactive=1m', 'use_temp_path=off'
+        )
+
+    return [
+        cache_path,
+        block('upstream authorapp_api', [
+            directive('server', Join(';\n    server ', Ref(param_api_backends))),
+            # Idle connections to the backends each worker keeps open.
+            directive('keepalive', Ref(param_api_keepalive))
+        ]),
+        block('server', [
+            directive('listen', '3030', 'ssl', 'http2'),
+            directive('root', path_static_root),
+            directive('ssl_certificate', '/vagrant/ssl/ca.crt'),
+            directive('ssl_certificate_key', '/vagrant/ssl/ca.key'),
+            directive('ssl_session_cache', 'shared:SSL:10m'),
+            directive('ssl_session_timeout', '1h'),
+            block('location /', []),
+            block('location ~* %s' % static_asset_pattern, [
+                directive('expires', static_asset_expires),
+                directive('add_header', 'Cache-Control', 'public'),
+                directive('access_log', 'off')
+            ])
+        ] + api_locations)
+    ]